@@ -30,11 +30,10 @@ This package contains protocols for creating and using ConPLex models for virtua
 """
 
 # General imports
-import os, subprocess, json
+import os, subprocess, json, socket, time
 
 # Scipion em imports
 import pwem
-from scipion.install.funcs import InstallHelper
 
 # Plugin imports
 from .bibtex import _bibtexStr
@@ -51,6 +50,8 @@ class Plugin(pwem.Plugin):
 	@classmethod
 	def _defineVariables(cls):
 		cls._defineEmVar(ESM_DIC['home'], cls._dfdHome)
+		cls._defineVar(CACHE_SIZE_VAR, DEFAULT_CACHE_SIZE)
+		cls._defineVar(LM_CACHE_SIZE_VAR, DEFAULT_LM_CACHE_SIZE)
 
 	@classmethod
 	def defineBinaries(cls, env):
@@ -62,6 +63,7 @@ class Plugin(pwem.Plugin):
 	@classmethod
 	def addEsmPackage(cls, env, default=True):
 		""" This function provides the neccessary commands for installing AutoDock. """
+		from scipion.install.funcs import InstallHelper
 		# Instantiating the install helper
 		installer = InstallHelper(ESM_DIC['name'], packageHome=cls.getVar(ESM_DIC['home']),
 															packageVersion=ESM_DIC['version'])
@@ -74,16 +76,28 @@ class Plugin(pwem.Plugin):
 									f'pip install "fair-esm[esmfold]" && pip install "dllogger @ git+https://github.com/NVIDIA/dllogger.git" && '
 									f'pip install "openfold @ git+https://github.com/aqlaboratory/openfold.git@4b41059694619831a7db195b7e0988fc4ff3a307" ',
 									'ESMFOLD_INSTALLED')\
+			.addCommand(f'{cls.getEnvActivationCommand(ESM_DIC)} && python {cls.getScriptsDir("modelStore.py")} '
+									f'-m {" ".join(STORED_MODELS)} -o {cls.getModelStoreDir()}', 'ESMFOLD_MODEL_STORE')\
 			.addPackage(env, ['git', 'conda', 'pip'], default=default)
 
 
 	# ---------------------------------- Protocol functions-----------------------
 	@classmethod
 	def getPluginHome(cls, path=""):
-		import esm
-		fnDir = os.path.split(esm.__file__)[0]
+		# Resolved from this file, not by importing 'esm', which may be the fair-esm library
+		fnDir = os.path.dirname(os.path.abspath(__file__))
 		return os.path.join(fnDir, path)
 
+	@classmethod
+	def getScriptEnviron(cls):
+		""" Returns the environment the ESM scripts run in. The directory containing this plugin package is removed
+		from the PYTHONPATH, so 'import esm' in the ESM environment always loads the fair-esm library. """
+		env = dict(cls.getEnviron() or os.environ)
+		pluginRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+		env['PYTHONPATH'] = os.pathsep.join(path for path in env.get('PYTHONPATH', '').split(os.pathsep)
+																				if path and os.path.abspath(path) != pluginRoot)
+		return env
+
 	@classmethod
 	def getEnvName(cls, packageDictionary):
 		""" This function returns the name of the conda enviroment for a given package. """
@@ -100,11 +114,111 @@ class Plugin(pwem.Plugin):
 		return cls.getPluginHome('scripts/%s' % scriptName)
 
 	@classmethod
-	def runScript(cls, protocol, scriptName, args, envDict, cwd=None, isSubprocess=False):
-		""" Run ESM script from a given protocol. """
+	def runScript(cls, protocol, scriptName, args, envDict, cwd=None, isSubprocess=False, useWorker=False):
+		""" Run ESM script from a given protocol.
+		If useWorker and a persistent worker is idle, the job is submitted to it instead of launching a new process.
+		The worker runs one job at a time, so if it is busy the job runs in a new process rather than waiting for it. """
+		if useWorker and scriptName in WORKER_SCRIPTS and cls.getWorkerStatus() == 'idle':
+			cls.submitToWorker(scriptName, args)
+			return
+
 		scriptName = cls.getScriptsDir(scriptName)
 		fullProgram = '%s && %s %s' % (cls.getEnvActivationCommand(envDict), 'python', scriptName)
 		if not isSubprocess:
-			protocol.runJob(fullProgram, args, env=cls.getEnviron(), cwd=cwd)
+			protocol.runJob(fullProgram, args, env=cls.getScriptEnviron(), cwd=cwd)
 		else:
-			subprocess.check_call(f'{fullProgram} {args}', cwd=cwd, shell=True)
+			subprocess.check_call(f'{fullProgram} {args}', cwd=cwd, shell=True, env=cls.getScriptEnviron())
+
+	@classmethod
+	def getModelStoreDir(cls):
+		""" Returns the directory of the local memory-mappable store of model weights. """
+		return os.path.join(cls.getVar(ESM_DIC['home']), MODEL_STORE_DIR)
+
+	@classmethod
+	def getPredictionCache(cls):
+		""" Returns the cache of ESMFold predictions shared by all the projects, stored under ESM_HOME. """
+		from .utils import PredictionCache
+		maxSize = float(cls.getVar(CACHE_SIZE_VAR)) * 1024 ** 3
+		return PredictionCache(os.path.join(cls.getVar(ESM_DIC['home']), CACHE_DIR), maxSize)
+
+	@classmethod
+	def getLMCacheArgs(cls):
+		""" Returns the script arguments to use the language model cache shared by the folding and embedding
+		protocols of all the projects, stored under ESM_HOME. """
+		cacheDir = os.path.join(cls.getVar(ESM_DIC['home']), LM_CACHE_DIR)
+		return f' -lc {cacheDir} -lcs {cls.getVar(LM_CACHE_SIZE_VAR)}'
+
+	# ---------------------------------- Persistent worker -----------------------
+	@classmethod
+	def getWorkerSocket(cls):
+		return os.path.join(cls.getVar(ESM_DIC['home']), WORKER_SOCKET)
+
+	@classmethod
+	def _workerRequest(cls, request, timeout=None):
+		""" Sends a request to the worker and yields its JSON line responses. """
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+			sock.settimeout(timeout)
+			sock.connect(cls.getWorkerSocket())
+			sock.sendall((json.dumps(request) + '\n').encode())
+			for line in sock.makefile():
+				yield json.loads(line)
+
+	@classmethod
+	def getWorkerStatus(cls):
+		""" Returns the status of the persistent worker: 'idle' if it answers, 'busy' if it accepted the connection but is
+		running a job (it serves one job at a time), or None if no worker is running. """
+		try:
+			if any(response.get('status') == 'alive' for response in cls._workerRequest({'cmd': 'ping'}, timeout=5)):
+				return 'idle'
+			return None
+		except socket.timeout:
+			return 'busy'
+		except (OSError, ValueError):
+			return None
+
+	@classmethod
+	def isWorkerRunning(cls):
+		""" Checks whether a persistent worker is running, idle or busy with a job. """
+		return cls.getWorkerStatus() is not None
+
+	@classmethod
+	def startWorker(cls, envDict=ESM_DIC, idleTimeout=WORKER_IDLE_TIMEOUT):
+		""" Starts a long-lived worker that keeps the ESMFold models in memory, if none is running.
+		The worker exits after idleTimeout seconds without jobs. """
+		if cls.isWorkerRunning():
+			return
+
+		workerScript = cls.getScriptsDir('esmFoldWorker.py')
+		cmd = f'{cls.getEnvActivationCommand(envDict)} && python {workerScript} ' \
+					f'-s {cls.getWorkerSocket()} -t {idleTimeout}'
+		with open(os.path.join(cls.getVar(ESM_DIC['home']), WORKER_LOG), 'a') as log:
+			subprocess.Popen(cmd, shell=True, env=cls.getScriptEnviron(), cwd=os.path.join(cls.getVar(ESM_DIC['home']), 'esm'),
+											stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+		startTime = time.time()
+		while not cls.isWorkerRunning():
+			if time.time() - startTime > WORKER_START_TIMEOUT:
+				raise TimeoutError(f'The ESMFold worker did not start in {WORKER_START_TIMEOUT} s. '
+														 f'Check {os.path.join(cls.getVar(ESM_DIC["home"]), WORKER_LOG)}')
+			time.sleep(2)
+
+	@classmethod
+	def stopWorker(cls):
+		""" Stops the persistent worker, if running. """
+		if cls.isWorkerRunning():
+			for _ in cls._workerRequest({'cmd': 'stop'}):
+				pass
+
+	@classmethod
+	def submitToWorker(cls, scriptName, args):
+		""" Runs a script job in the persistent worker, printing its output as it arrives. """
+		print(f'Submitting job to the ESMFold worker: {scriptName} {args}', flush=True)
+		status = None
+		for response in cls._workerRequest({'cmd': 'run', 'script': scriptName, 'args': args}):
+			if 'log' in response:
+				print(response['log'], flush=True)
+			else:
+				status = response
+
+		if status is None or status['status'] != 'done':
+			raise Exception(f'ESMFold worker job failed: {status.get("error") if status else "connection lost"}')
@@ -30,3 +30,30 @@ DEFAULT_VERSION = '1.0'
 
 # Package dictionaries
 ESM_DIC =  {'name': 'ESM',    'version': '1.0',         'home': 'ESM_HOME'}
+
+# Persistent ESMFold worker
+WORKER_SOCKET = 'esmfold_worker.sock'
+WORKER_LOG = 'esmfold_worker.log'
+WORKER_IDLE_TIMEOUT = 1800  # seconds without jobs before the worker exits, releasing the model memory
+WORKER_START_TIMEOUT = 300  # seconds to wait for a new worker to accept connections
+WORKER_SCRIPTS = ['runESMFold.py']  # scripts the worker can run
+
+# Output set streaming
+OUTPUT_POLL_INTERVAL = 10  # seconds between checks of the new predictions to add to the output set
+
+# Job array submission
+JOB_ARRAY_POLL_INTERVAL = 30  # seconds between checks of the finished tasks
+
+# Prediction cache
+CACHE_DIR = 'predictionCache'
+CACHE_SIZE_VAR = 'ESM_CACHE_SIZE'  # maximum size of the prediction cache, in GB
+DEFAULT_CACHE_SIZE = 20
+
+# Language model representations cache, shared by the folding and embedding protocols
+LM_CACHE_DIR = 'lmCache'
+LM_CACHE_SIZE_VAR = 'ESM_LM_CACHE_SIZE'  # maximum size of the language model cache, in GB
+DEFAULT_LM_CACHE_SIZE = 50
+
+# Local store of memory-mappable model weights, under ESM_HOME
+MODEL_STORE_DIR = 'models'
+STORED_MODELS = ['esmfold_v1']
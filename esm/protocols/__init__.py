@@ -25,4 +25,6 @@
 # **************************************************************************
 
 from .protocol_esm_structurePrediction import ProtESMFoldPrediction
-
+from .protocol_esm_embeddings import ProtESMEmbeddings
+from .protocol_esm_variantScan import ProtESMVariantScan
+from .protocol_esm_filter import ProtESMFoldFilter
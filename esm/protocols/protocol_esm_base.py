@@ -0,0 +1,116 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import re
+
+from pyworkflow.protocol import params
+from pwem.protocols import EMProtocol
+from pwem.objects import SetOfSequences
+
+from .. import Plugin as esmPlugin
+from ..constants import LM_CACHE_SIZE_VAR
+
+def sanitizeName(name):
+  """Returns a version of a sequence name that can be safely used as a file name"""
+  return re.sub(r'[^\w.-]', '_', name or '') or 'sequence'
+
+class ProtESMBase(EMProtocol):
+  """Base class of the ESM protocols running over a sequence or a set of sequences (inputSequence).
+  It handles the input entries and the device, threads and sharding options: the sequences are split in shards,
+  one per listed GPU or per CPU worker, each processed in a parallel step"""
+
+  def __init__(self, **kwargs):
+    EMProtocol.__init__(self, **kwargs)
+    self.stepsExecutionMode = params.STEPS_PARALLEL
+
+  def _defineDeviceParams(self, group):
+    group.addParam('device', params.EnumParam, choices=['auto', 'cuda', 'cpu'], label='Device: ', default=0,
+                   help='Device to run the model on. auto uses the GPU if available and the CPU otherwise.\n'
+                        'On CPU, the number of threads of the protocol is used for the intra-op thread pool '
+                        '(and a quarter of them for the inter-op pool).')
+    group.addParam('cpuWorkers', params.IntParam, label='CPU workers: ', default=1, condition='device==2',
+                   help='Number of CPU processes the sequences are split among, each running as a parallel step. '
+                        'The protocol threads are divided among them. With GPUs, the sequences are split among '
+                        'all the listed GPU ids instead.')
+
+  def _defineLMCacheParams(self, group):
+    group.addParam('useLMCache', params.BooleanParam, label='Share language model cache: ', default=False,
+                   expertLevel=params.LEVEL_ADVANCED,
+                   help='Read the ESM-2 representations of the sequences from a cache shared by the ESMFold and '
+                        'ESM-2 embedding protocols of every project, and store the ones computed. ESMFold runs the '
+                        'esm2_t36_3B_UR50D model as its first stage, so sequences folded and embedded with it only '
+                        'go through the language model once. Representations are only reused with the same numerics '
+                        '(dtype and device type): on GPU, ESMFold runs the language model in float16 and the '
+                        'embedding protocol in float32, so they only share it on CPU. The representations of all the '
+                        'layers are stored (about 190 KB per residue for the 3B model), in a cache under ESM_HOME '
+                        'whose size is limited by the %s variable (GB).' % LM_CACHE_SIZE_VAR)
+
+  ########################### UTILS ###########################
+  def isInputSet(self):
+    return isinstance(self.inputSequence.get(), SetOfSequences)
+
+  def getInputEntries(self):
+    """Returns a list of (name, sequence) for the input sequences. Names are sanitized to be used as file names
+    and made unique within the input."""
+    if not self.isInputSet():
+      return [(self.getInputName(), self.getInputSequence())]
+
+    entries, usedNames = [], set()
+    for seq in self.inputSequence.get():
+      name = sanitizeName(seq.getSeqName())
+      if name in usedNames:
+        name = f'{name}_{seq.getObjId()}'
+      usedNames.add(name)
+      entries.append((name, seq.getSequence()))
+    return entries
+
+  def getShardDevices(self):
+    """Returns the device of each shard: a GPU id for each listed GPU, or 'cpu' for each CPU worker"""
+    if self.getEnumText('device') == 'cpu':
+      return ['cpu'] * max(1, self.cpuWorkers.get())
+    return [gpuId.strip() for gpuId in self.gpuList.get().split(',') if gpuId.strip()] or ['0']
+
+  def getShardThreads(self):
+    """Returns the CPU threads of each shard, splitting the protocol threads among the CPU workers"""
+    nShards = len(self.getShardDevices()) if self.getEnumText('device') == 'cpu' else 1
+    return max(1, self.numberOfThreads.get() // nShards)
+
+  def getShardFasta(self, shardId):
+    return self._getExtraPath(f'inputSequences_{shardId}.fasta')
+
+  def getDeviceArgs(self, device):
+    """Returns the device and thread arguments of the ESM scripts for a shard device"""
+    threads = self.getShardThreads()
+    args = f' -t {threads} -it {max(1, threads // 4)}'
+    return args + (' -d cpu' if device == 'cpu' else f' -d {self.getEnumText("device")} -g {device}')
+
+  def getLMCacheArgs(self):
+    return esmPlugin.getLMCacheArgs() if self.useLMCache.get() else ''
+
+  def getInputSequence(self):
+    return self.inputSequence.get().getSequence()
+
+  def getInputName(self):
+    return sanitizeName(self.inputSequence.get().getSeqName())
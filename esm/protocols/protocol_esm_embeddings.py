@@ -0,0 +1,151 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+
+from pyworkflow.protocol import params
+from pyworkflow.object import String, Integer
+from pwem.objects import SetOfSequences
+
+from .. import Plugin as esmPlugin
+from ..constants import ESM_DIC
+from ..scripts.embeddingStore import EmbeddingStore, hasEmbeddingStore
+from ..utils import writeFasta, splitInShards
+from .protocol_esm_base import ProtESMBase
+
+scriptName = 'runESMEmbeddings.py'
+
+class ProtESMEmbeddings(ProtESMBase):
+  """Extract the per residue and mean pooled ESM-2 embeddings of a protein sequence or a set of sequences.
+  The embeddings are stored in memory-mapped .npy files, so a single sequence embedding can be read without
+  loading the whole store"""
+  _label = 'ESM-2 embeddings'
+  _OUTNAME = 'outputSequences'
+  _possibleOutputs = {_OUTNAME: SetOfSequences}
+
+  def _defineParams(self, form):
+    form.addHidden(params.GPU_LIST, params.StringParam, default='0', label="Choose GPU IDs",
+                   help="Add a list of GPU device that can be used. The input sequences are split among them, "
+                        "each GPU running its share in a parallel step (the protocol needs as many threads)")
+    form.addSection(label='Input')
+    iGroup = form.addGroup('Input')
+    iGroup.addParam('inputSequence', params.PointerParam, pointerClass="Sequence, SetOfSequences",
+                    label='Input protein sequence(s): ',
+                    help="Protein sequence or set of sequences to extract the embeddings from")
+
+    mGroup = form.addGroup('Model')
+    mGroup.addParam('modelName', params.EnumParam,
+                    choices=['esm2_t6_8M_UR50D', 'esm2_t12_35M_UR50D', 'esm2_t30_150M_UR50D', 'esm2_t33_650M_UR50D',
+                             'esm2_t36_3B_UR50D', 'esm2_t48_15B_UR50D'],
+                    label='Model to use: ', default=3,
+                    help='ESM-2 model to extract the embeddings with. Larger models give richer embeddings '
+                         '(of 320 to 5120 dimensions) at a higher cost. The small models run fine on CPU')
+    mGroup.addParam('layer', params.IntParam, label='Representation layer: ', default=-1,
+                    help='Layer whose representations are extracted. Negative values count from the last one '
+                         '(-1 is the final layer)')
+    mGroup.addParam('tokensPerBatch', params.IntParam, label='Tokens per batch: ', default=4096,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='The sequences are sorted by length and embedded together in batches of at most this '
+                         'number of (padded) tokens. Batches running out of memory are split in half and retried')
+    mGroup.addParam('halfPrecision', params.BooleanParam, label='Store in half precision: ', default=False,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Store the embeddings as float16 instead of float32, halving the size of the store')
+
+    eGroup = form.addGroup('Execution')
+    self._defineDeviceParams(eGroup)
+    self._defineLMCacheParams(eGroup)
+
+    form.addParallelSection(threads=4, mpi=0)
+
+  def _insertAllSteps(self):
+    convertId = self._insertFunctionStep(self.convertInputStep)
+    embedIds = [self._insertFunctionStep(self.embedStep, shardId, device, prerequisites=[convertId])
+                for shardId, device in enumerate(self.getShardDevices())]
+    self._insertFunctionStep(self.createOutputStep, prerequisites=embedIds)
+
+  def convertInputStep(self):
+    for shardId, shardEntries in enumerate(splitInShards(self.getInputEntries(), len(self.getShardDevices()))):
+      writeFasta(shardEntries, self.getShardFasta(shardId))
+
+  def embedStep(self, shardId, device):
+    fastaFile = self.getShardFasta(shardId)
+    if os.path.getsize(fastaFile) == 0:
+      return
+
+    cwd = os.path.join(esmPlugin.getVar(ESM_DIC['home']), 'esm')
+    args = f' -if {os.path.abspath(fastaFile)} -o {os.path.abspath(self.getStorePrefix(shardId))}' \
+           f' -m {self.getEnumText("modelName")} -l {self.layer.get()} -tb {self.tokensPerBatch.get()}' \
+           f' -dt {"float16" if self.halfPrecision.get() else "float32"}'
+    args += self.getDeviceArgs(device) + self.getLMCacheArgs()
+    esmPlugin.runScript(self, scriptName, args, envDict=ESM_DIC, cwd=cwd)
+
+  def createOutputStep(self):
+    storeNames = {}
+    for shardId in range(len(self.getShardDevices())):
+      prefix = self.getStorePrefix(shardId)
+      if hasEmbeddingStore(prefix):
+        storeNames.update({name: (prefix, row) for name, (row, _, _) in EmbeddingStore(prefix).index.items()})
+
+    outSet = self._createSetOfSequences()
+    inputSequences = self.inputSequence.get() if self.isInputSet() else [self.inputSequence.get()]
+    for sequence, (name, _) in zip(inputSequences, self.getInputEntries()):
+      if name in storeNames:
+        outSeq = sequence.clone()
+        prefix, row = storeNames[name]
+        outSeq._embeddingStore = String(os.path.abspath(prefix))
+        outSeq._embeddingName = String(name)
+        outSeq._embeddingRow = Integer(row)
+        outSet.append(outSeq)
+
+    if len(outSet) > 0:
+      self._defineOutputs(**{self._OUTNAME: outSet})
+      self._defineSourceRelation(self.inputSequence, outSet)
+
+  def _validate(self):
+    errors = []
+    if self.tokensPerBatch.get() <= 0:
+      errors.append('The number of tokens per batch must be positive')
+    return errors
+
+  def _summary(self):
+    summary = []
+    if hasattr(self, self._OUTNAME):
+      outSet = getattr(self, self._OUTNAME)
+      store = EmbeddingStore(outSet.getFirstItem()._embeddingStore.get())
+      summary.append(f'Embedded sequences: {len(outSet)} with {store.info["model"]} '
+                     f'(layer {store.info["layer"]}, {store.getDimension()} dimensions)')
+    return summary
+
+  ########################### UTILS ###########################
+  def getStorePrefix(self, shardId):
+    """Prefix of the embedding store files written by a shard"""
+    return self._getExtraPath(f'embeddings_{shardId}')
+
+  def getEmbeddingStore(self, sequence):
+    """Returns the embedding store holding an output sequence embeddings,
+    to be read with getResidueEmbeddings/getMeanEmbedding(sequence._embeddingName.get())"""
+    return EmbeddingStore(sequence._embeddingStore.get())
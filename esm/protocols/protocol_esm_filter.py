@@ -0,0 +1,98 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+from pyworkflow.protocol import params
+from pwem.protocols import EMProtocol
+from pwem.objects import SetOfAtomStructs
+
+from .protocol_esm_structurePrediction import ProtESMFoldPrediction
+
+class ProtESMFoldFilter(EMProtocol):
+  """Select the ESMFold predicted structures of a set by their confidence (mean pLDDT, pTM) and length.
+  The values are read from the attributes stored in the structures by the prediction protocol, without opening
+  the structure files"""
+  _label = 'ESMFold confidence filter'
+  _OUTNAME = 'outputStructures'
+  _possibleOutputs = {_OUTNAME: SetOfAtomStructs}
+
+  def _defineParams(self, form):
+    form.addSection(label='Input')
+    form.addParam('inputStructures', params.PointerParam, pointerClass='SetOfAtomStructs',
+                  label='Input predicted structures: ',
+                  help='Set of structures predicted by the ESMFold protocol')
+
+    group = form.addGroup('Thresholds')
+    group.addParam('minPlddt', params.FloatParam, label='Minimum mean pLDDT: ', default=70.0,
+                   help='Keep the structures whose mean pLDDT (0-100) is at least this value')
+    group.addParam('minPtm', params.FloatParam, label='Minimum pTM: ', default=0.0,
+                   help='Keep the structures whose pTM (0-1) is at least this value. Predictions without pTM '
+                        '(e.g. folded as windows) are kept if this is 0')
+    group.addParam('minLength', params.IntParam, label='Minimum length: ', default=0,
+                   expertLevel=params.LEVEL_ADVANCED, help='Minimum number of residues (0 for no limit)')
+    group.addParam('maxLength', params.IntParam, label='Maximum length: ', default=0,
+                   expertLevel=params.LEVEL_ADVANCED, help='Maximum number of residues (0 for no limit)')
+    group.addParam('keepMissing', params.BooleanParam, label='Keep structures without scores: ', default=False,
+                   expertLevel=params.LEVEL_ADVANCED,
+                   help='Keep the structures that have no confidence attributes (e.g. predicted by older versions '
+                        'of the plugin) instead of discarding them')
+
+  def _insertAllSteps(self):
+    self._insertFunctionStep(self.createOutputStep)
+
+  def createOutputStep(self):
+    inputSet = self.inputStructures.get()
+    outSet = self._createSetOfPDBs()
+    for structure in inputSet:
+      if self.passesFilter(structure):
+        outSet.append(structure.clone())
+
+    self._defineOutputs(**{self._OUTNAME: outSet})
+    self._defineSourceRelation(self.inputStructures, outSet)
+
+  def _summary(self):
+    summary = []
+    if hasattr(self, self._OUTNAME):
+      summary.append(f'Selected structures: {len(getattr(self, self._OUTNAME))} / {len(self.inputStructures.get())}')
+    return summary
+
+  ########################### UTILS ###########################
+  def getScore(self, structure, column):
+    """Returns the value of a confidence summary column stored in a structure, None if missing"""
+    attr = getattr(structure, ProtESMFoldPrediction.getSummaryAttribute(column), None)
+    return None if attr is None else attr.get()
+
+  def passesFilter(self, structure):
+    meanPlddt, ptm, length = [self.getScore(structure, column) for column in ['meanPlddt', 'ptm', 'length']]
+    if meanPlddt is None:
+      return self.keepMissing.get()
+
+    if meanPlddt < self.minPlddt.get():
+      return False
+    if self.minPtm.get() > 0 and (ptm is None or ptm < self.minPtm.get()):
+      return False
+    if length is not None and (length < self.minLength.get() or 0 < self.maxLength.get() < length):
+      return False
+    return True
@@ -24,37 +24,110 @@
 # *
 # **************************************************************************
 
-import os, glob, shutil, subprocess
+import os, json, glob, time, resource
+import numpy as np
 
 from pyworkflow.protocol import params
-from pwem.protocols import EMProtocol
-from pwem.objects import AtomStruct
-from pwem.convert.atom_struct import toCIF, AtomicStructHandler, addScipionAttribute
+from pyworkflow.object import String, Integer, Float
+from pwem.objects import AtomStruct, SetOfAtomStructs
 
 from .. import Plugin as esmPlugin
-from ..constants import ESM_DIC
+from ..constants import ESM_DIC, WORKER_IDLE_TIMEOUT, CACHE_SIZE_VAR, JOB_ARRAY_POLL_INTERVAL, \
+  OUTPUT_POLL_INTERVAL
+from ..scripts.structureIO import getAtomSpecifiers
+from ..scripts.structureArchive import StructureArchive, findStructureArchives
+from ..utils import PredictionCache, linkOrCopy, writeFasta, readFasta, splitInShards, writeManifests, \
+  writeTaskScript, iterFinishedTasks, getManifestFile, getManifestIds, getExitFile, LocalArrayExecutor, \
+  QueueArrayExecutor, collapseDuplicates, clusterSequences
+from .protocol_esm_base import ProtESMBase
 
 scriptName = 'runESMFold.py'
 
-class ProtESMFoldPrediction(EMProtocol):
-  """Run a structural prediction using a ESMFold model over a protein sequence"""
+def getPlddtScoreDic(plddtFile):
+  """Returns the pLDDT of each atom as {'chain:resNumber@atomName': score} from the arrays written by runESMFold.py"""
+  with np.load(plddtFile) as data:
+    ids = getAtomSpecifiers(data)
+    scores = np.round(data['atomPlddt'].astype(np.float64), 2)
+  return dict(zip(ids.tolist(), scores.tolist()))
+
+def getPDBScoreDic(pdbFile):
+  """Returns the pLDDT of each atom as {'chain:resNumber@atomName': score} from the B-factors of an ESMFold PDB"""
+  from pwem.convert.atom_struct import AtomicStructHandler
+  ASH = AtomicStructHandler()
+  ASH.read(pdbFile)
+
+  esmDic = {}
+  for model in ASH.structure:
+    for atom in model.get_atoms():
+      fId = atom.get_full_id()
+      chainName, resNumber, atomName = fId[2], fId[3][1], fId[4][0]
+      atomId = '{}:{}@{}'.format(chainName, resNumber, atomName)
+      esmScore = atom.get_bfactor()
+      esmDic[atomId] = esmScore
+
+  return esmDic
+
+def getLaunchOverhead(wallTime, stats):
+  """Returns the launch overhead of a runESMFold.py run from the wall time of its runScript call and its run stats:
+  the environment activation and interpreter startup, outside of both the script run and its imports (importTime)"""
+  return max(0, wallTime - stats['totalTime'] - stats.get('importTime', 0))
+
+
+def writeScoredCIF(pdbFile, scoreDic, attrName, outStructFileName, tmpCifFile):
+  """Converts a predicted PDB to CIF, writing the per atom scores in its Scipion attributes section"""
+  from pwem.convert.atom_struct import toCIF, AtomicStructHandler, addScipionAttribute
+  ASH = AtomicStructHandler()
+  inpAS = toCIF(pdbFile, tmpCifFile)
+  cifDic = ASH.readLowLevel(inpAS)
+  cifDic = addScipionAttribute(cifDic, scoreDic, attrName, recipient='atoms')
+  ASH._writeLowLevel(outStructFileName, cifDic)
+  return outStructFileName
+
+class ProtESMFoldPrediction(ProtESMBase):
+  """Run a structural prediction using a ESMFold model over a protein sequence or a set of sequences"""
   _label = 'ESMFold structure prediction'
   _ATTRNAME = 'ESMFoldScore'
   _OUTNAME = 'outputStructure'
-  _possibleOutputs = {_OUTNAME: AtomStruct}
-
-  def __init__(self, **kwargs):
-    EMProtocol.__init__(self, **kwargs)
-    self.stepsExecutionMode = params.STEPS_PARALLEL
+  _OUTSETNAME = 'outputStructures'
+  _possibleOutputs = {_OUTNAME: AtomStruct, _OUTSETNAME: SetOfAtomStructs}
+  # Files written by runESMFold.py for each prediction, named <name><suffix>
+  _PREDICTION_SUFFIXES = ['.cif', '.pdb', '_plddt.npz', '_pae.npz']
+  # Columns of the confidence summary table, also stored as _esm<Column> attributes of the output structures
+  _SUMMARY_COLUMNS = ['name', 'length', 'meanPlddt', 'ptm', 'recycles', 'inferenceTime']
 
   def _defineParams(self, form):
     form.addHidden(params.GPU_LIST, params.StringParam, default='0', label="Choose GPU IDs",
-                   help="Add a list of GPU device that can be used")
+                   help="Add a list of GPU device that can be used. The input sequences are split among them, "
+                        "each GPU running its share in a parallel step (the protocol needs as many threads, plus "
+                        "one to add the structures to the output set as they are predicted)")
     form.addSection(label='Input')
     iGroup = form.addGroup('Input')
-    iGroup.addParam('inputSequence', params.PointerParam, pointerClass="Sequence",
-                    label='Input protein sequence: ',
-                    help="Protein sequences to perform the structur prediction on")
+    iGroup.addParam('inputSequence', params.PointerParam, pointerClass="Sequence, SetOfSequences",
+                    label='Input protein sequence(s): ',
+                    help="Protein sequence or set of sequences to perform the structure prediction on. "
+                         "All the sequences of a set are predicted by a single process that loads the model once")
+    iGroup.addParam('foldComplex', params.BooleanParam, label='Fold the set as a complex: ', default=False,
+                    help='Fold all the sequences of the input set together as a single complex, one chain per '
+                         'sequence (A, B, ... in the order of the set), instead of each one independently. '
+                         'The chains are joined by a poly-glycine linker with a residue index offset, as in '
+                         'ESMFold, and the linker is removed from the output structure. '
+                         'A single input sequence can also describe a complex with its chains separated by ":"')
+    iGroup.addParam('collapseDuplicates', params.BooleanParam, label='Fold duplicated sequences once: ',
+                    default=True, condition='not foldComplex', expertLevel=params.LEVEL_ADVANCED,
+                    help='Fold each distinct sequence of the input set once. Its prediction is then copied to every '
+                         'other entry with the same sequence, whose output structure has its name in the '
+                         '_esmDuplicateOf attribute')
+    iGroup.addParam('clusterSequences', params.BooleanParam, label='Fold only cluster representatives: ',
+                    default=False, condition='not foldComplex', expertLevel=params.LEVEL_ADVANCED,
+                    help='Cluster the sequences of the input set by identity and fold only one representative '
+                         'per cluster, the longest sequence. The identity of two sequences is the fraction of the '
+                         'shorter one aligned to identical residues of the longer one, so tag variants and '
+                         'truncations of a protein join its cluster. The members are listed in the '
+                         '_esmClusterMembers attribute of their representative structure and in the clusters.tsv '
+                         'file of the protocol, but get no structure of their own')
+    iGroup.addParam('clusterIdentity', params.FloatParam, label='Cluster identity: ', default=0.95,
+                    condition='clusterSequences and not foldComplex', expertLevel=params.LEVEL_ADVANCED,
+                    help='Minimum identity (0-1) of a sequence to the representative of a cluster to join it')
 
     mGroup = form.addGroup('Model')
     mGroup.addParam('modelName', params.EnumParam, choices=['esmfold_v0', 'esmfold_v1'],
@@ -63,63 +136,772 @@ class ProtESMFoldPrediction(EMProtocol):
 
     mGroup.addParam('nRecycles', params.IntParam, label='Number of recycles: ', default=4,
                     help='Number of recycles to run. Defaults to number used in training (4)')
+    mGroup.addParam('windowLength', params.IntParam, label='Long sequence window: ', default=0,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Single chain sequences longer than this are folded as overlapping windows of this length, '
+                         'stitched by superposing the CA atoms of their overlaps, so sequences too long to fit in '
+                         'memory can still be predicted. Long range contacts between windows are not modelled. '
+                         '0 to fold every sequence at once')
+    mGroup.addParam('windowOverlap', params.IntParam, label='Window overlap: ', default=200,
+                    condition='windowLength>0', expertLevel=params.LEVEL_ADVANCED,
+                    help='Number of residues shared by consecutive windows, used to superpose them')
+    mGroup.addParam('adaptiveRecycles', params.BooleanParam, label='Adaptive recycling: ', default=False,
+                    help='Stop recycling once the predicted structure converges, running at most the number of '
+                         'recycles above. Sequences are then folded one at a time, ignoring the batch residue budget, '
+                         'so each one stops at its own convergence. The number of recycles run for each prediction '
+                         'is stored in the output (_esmRecycles attribute)')
+    mGroup.addParam('rmsdTolerance', params.FloatParam, label='CA RMSD tolerance (A): ', default=0.5,
+                    condition='adaptiveRecycles',
+                    help='Recycling stops when the CA RMSD between the structures of consecutive recycles is below '
+                         'this value. 0 to disable this criterion')
+    mGroup.addParam('plddtTolerance', params.FloatParam, label='pLDDT tolerance: ', default=0.0,
+                    condition='adaptiveRecycles', expertLevel=params.LEVEL_ADVANCED,
+                    help='Recycling stops when the mean pLDDT change between consecutive recycles is below this '
+                         'value. 0 to disable this criterion')
+    mGroup.addParam('saveRecycles', params.BooleanParam, label='Save structure of each recycle: ', default=False,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Also write the predicted structure after every recycle, as <name>_recycle<n>.cif in the '
+                         'predictions folder of the protocol. Cached predictions are not reused, as they do not '
+                         'include them')
+    mGroup.addParam('autoChunkSize', params.BooleanParam, label='Automatic chunk size: ', default=True,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Estimate the memory needed by each batch from its sequence lengths and the available device '
+                         '(or host) memory, and use the largest chunk size that fits (or no chunking). If a sequence '
+                         'still runs out of memory, the chunk size is lowered and the prediction retried. '
+                         'The chosen plans are printed in the protocol log.')
     mGroup.addParam('chunkSize', params.IntParam, label='Chunk size: ', default=64, expertLevel=params.LEVEL_ADVANCED,
+                    condition='not autoChunkSize',
                     help='Chunks axial attention computation to reduce memory usage from O(L^2) to O(L). '
                          'Equivalent to running a for loop over chunks of of each dimension. '
                          'Lower values will result in lower memory usage at the cost of speed.')
+    mGroup.addParam('batchResidues', params.IntParam, label='Batch residue budget: ', default=1024,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='When predicting a set of sequences, they are sorted by length and folded together in '
+                         'batches. As the trunk memory grows quadratically with length, a batch of n sequences of '
+                         'maximum length L is accepted while n * L^2 <= budget^2.\n'
+                         'Batches running out of memory are split in half and retried. '
+                         'Set to 0 to fold one sequence at a time.')
 
+    eGroup = form.addGroup('Execution')
+    self._defineDeviceParams(eGroup)
+    eGroup.addParam('lmPrecision', params.EnumParam, choices=['none', 'bfloat16', 'int8'],
+                    label='Language model precision: ', default=0, expertLevel=params.LEVEL_ADVANCED,
+                    help='Precision of the ESM-2 language model trunk of ESMFold.\n'
+                         'none: ESMFold default (fp16 on GPU, fp32 on CPU).\n'
+                         'bfloat16: reduces memory and speeds up CPUs with bf16 support.\n'
+                         'int8: dynamic int8 quantization of its linear layers (CPU only).')
+    eGroup.addParam('useCache', params.BooleanParam, label='Use prediction cache: ', default=True,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Reuse the predictions of sequences already folded with the same model, number of '
+                         'recycles, language model precision and device type (GPU or CPU, as the language model '
+                         'numerics differ), in this or any other project, instead of running ESMFold again. '
+                         'With the auto device, the predictions of both device types are reused. '
+                         'New predictions are stored in the cache under ESM_HOME, whose size is limited by the '
+                         '%s variable (GB). Set to No to always run the prediction.' % CACHE_SIZE_VAR)
+    eGroup.addParam('autocast', params.EnumParam, choices=['none', 'float16', 'bfloat16'],
+                    label='Mixed precision: ', default=0, expertLevel=params.LEVEL_ADVANCED,
+                    help='Run the whole model with its operations autocast to this precision (torch.autocast), '
+                         'reducing its memory and time. bfloat16 is the one supported on most CPUs. '
+                         'Use the parity check to validate the predictions against the default precision.')
+    eGroup.addParam('inferenceMode', params.BooleanParam, label='Use inference mode: ', default=False,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Run the model under torch.inference_mode instead of torch.no_grad, skipping the autograd '
+                         'bookkeeping of its tensors. It does not change the predictions')
+    eGroup.addParam('compileModel', params.BooleanParam, label='Compile the model: ', default=False,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Compile the language model and folding trunk with torch.compile. Each new input shape is '
+                         'compiled on its first batch, so it only pays off on large sets. With adaptive recycling '
+                         'or saved recycles, the folding trunk runs in eager mode')
+    eGroup.addParam('parityCheck', params.BooleanParam, label='Check parity with default mode: ', default=True,
+                    condition='autocast!=0 or compileModel', expertLevel=params.LEVEL_ADVANCED,
+                    help='Before folding, predict a reference sequence (human ubiquitin) both in the default mode '
+                         '(eager, no autocast, with the language model precision above: ESMFold runs it in fp16 on '
+                         'GPU and fp32 on CPU) and in the chosen one, and compare their CA coordinates and pLDDT. '
+                         'A warning is shown in the log and the protocol summary if they differ beyond the '
+                         'tolerances')
+    eGroup.addParam('parityTolerance', params.FloatParam, label='Parity CA RMSD tolerance (A): ', default=0.5,
+                    condition='(autocast!=0 or compileModel) and parityCheck', expertLevel=params.LEVEL_ADVANCED,
+                    help='Maximum CA RMSD between the reference predictions')
+    eGroup.addParam('parityPlddtTolerance', params.FloatParam, label='Parity pLDDT tolerance: ', default=5.0,
+                    condition='(autocast!=0 or compileModel) and parityCheck', expertLevel=params.LEVEL_ADVANCED,
+                    help='Maximum difference of the residue pLDDT between the reference predictions')
+    eGroup.addParam('outputFormat', params.EnumParam, choices=['cif', 'archive'], label='Prediction storage: ',
+                    default=0, expertLevel=params.LEVEL_ADVANCED,
+                    help='cif: each prediction is written as a mmCIF file with its pLDDT and PAE arrays.\n'
+                         'archive: the predictions of each run are appended to a compressed structure archive '
+                         '(predictions/*.esmz, with a *_index.tsv index by name) holding their coordinates, atom '
+                         'types, pLDDT, PAE and scores as typed arrays, readable per chain with '
+                         'esm.scripts.structureArchive.StructureArchive. The CIF file of each output structure is '
+                         'exported from the archive when it is added to the output, so other protocols can use it. '
+                         'The prediction cache only stores predictions written as files.')
+    self._defineLMCacheParams(eGroup)
+    eGroup.addParam('useWorker', params.BooleanParam, label='Use persistent worker: ', default=False,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='If a persistent ESMFold worker is idle, submit the prediction to it. The worker keeps '
+                         'the model loaded, avoiding the environment activation and model loading of each run, which '
+                         'pays off for many small runs on a single device.\n'
+                         'The worker is a single process running one job at a time, holding a copy of the model for '
+                         'each device it was used with. So it is only used when the prediction runs as a single '
+                         'shard (one GPU or CPU worker): runs sharded over several devices, and runs finding the '
+                         'worker busy (e.g. with a job of another project), use new processes instead.')
+    eGroup.addParam('launchWorker', params.BooleanParam, label='Start worker if not running: ', default=False,
+                    condition='useWorker', expertLevel=params.LEVEL_ADVANCED,
+                    help='Start a persistent ESMFold worker if none is running, so this and later runs can use it. '
+                         'The worker exits after %d minutes without jobs, releasing its memory.'
+                         % (WORKER_IDLE_TIMEOUT // 60))
+    eGroup.addParam('useJobArray', params.BooleanParam, label='Submit as job array: ', default=False,
+                    condition='not foldComplex', expertLevel=params.LEVEL_ADVANCED,
+                    help='Split the input set in manifests of the task size below and run each one as a task of a '
+                         'job array, submitted through the queue system of the execution host (Scipion host '
+                         'configuration) if the protocol uses the queue. Otherwise, the tasks run as local '
+                         'processes, one at a time per listed GPU or CPU worker. The structures of each task are '
+                         'added to the output set as soon as it finishes, so they can be used while the rest are '
+                         'still running. If the submit template of the queue uses %(JOB_ARRAY)s (e.g. '
+                         '"#SBATCH --array=%(JOB_ARRAY)s"), the tasks are submitted as a single array job, and as '
+                         'one job each otherwise. The persistent worker is not used.')
+    eGroup.addParam('arrayTaskSize', params.IntParam, label='Sequences per task: ', default=100,
+                    condition='useJobArray and not foldComplex', expertLevel=params.LEVEL_ADVANCED,
+                    help='Approximate number of sequences in each task of the job array')
+
+    form.addParallelSection(threads=4, mpi=0)
 
   def _insertAllSteps(self):
-    self._insertFunctionStep(self.predictStep)
-    self._insertFunctionStep(self.createOutputStep)
+    convertId = self._insertFunctionStep(self.convertInputStep)
+    if self.isJobArray():
+      predictIds = [self._insertFunctionStep(self.jobArrayStep, prerequisites=[convertId])]
+    else:
+      predictIds = [self._insertFunctionStep(self.predictStep, shardId, device, prerequisites=[convertId])
+                    for shardId, device in enumerate(self.getShardDevices())]
+      if self.isInputSet() and not self.isComplex():
+        predictIds.append(self._insertFunctionStep(self.streamOutputStep, prerequisites=[convertId]))
+    self._insertFunctionStep(self.createOutputStep, prerequisites=predictIds)
+
+  def convertInputStep(self):
+    os.makedirs(self.getPredictionsDir(), exist_ok=True)
+    entries = self.getFoldEntries()
+    if self.isInputSet() and not self.isComplex():
+      entries = self.reduceRedundancy(entries)
+    if self.useCache.get() and not self.saveRecycles.get():
+      entries = self.retrieveCachedPredictions(entries)
 
-  def predictStep(self):
-    sequence = self.getInputSequence()
-    model = self.getEnumText('modelName')
-    seqName = self.getInputName()
-    cwd = os.path.join(esmPlugin.getVar(ESM_DIC['home']), 'esm')
+    if self.isJobArray():
+      writeManifests(entries, self.getJobArrayDir(), self.arrayTaskSize.get())
+      return
+    for shardId, shardEntries in enumerate(splitInShards(entries, len(self.getShardDevices()))):
+      writeFasta(shardEntries, self.getShardFasta(shardId))
+      # Left by a previous run, if the protocol is continued
+      if os.path.exists(self.getShardDoneFile(shardId)):
+        os.remove(self.getShardDoneFile(shardId))
 
-    args = f' -i {sequence} -m {model} -o {seqName} -od {os.path.abspath(self._getPath())}' \
-           f' -g {self.gpuList.get().split(",")[0]}' \
-           f' -cs {self.chunkSize.get()} -nr {self.nRecycles.get()}'
-    esmPlugin.runScript(self, scriptName, args, envDict=ESM_DIC, cwd=cwd)
+  def predictStep(self, shardId, device):
+    try:
+      self.predictShard(shardId, device)
+    finally:
+      # Tells the streaming step that no more predictions of this shard will come, even if it failed
+      open(self.getShardDoneFile(shardId), 'w').close()
+
+  def predictShard(self, shardId, device):
+    fastaFile = self.getShardFasta(shardId)
+    entries = readFasta(fastaFile)
+    if not entries:
+      return
+
+    args = self.getPredictionArgs(fastaFile, shardId, device)
+    if self.isWorkerUsed() and self.launchWorker.get():
+      esmPlugin.startWorker()
+    startTime = time.time()
+    esmPlugin.runScript(self, scriptName, args, envDict=ESM_DIC, cwd=self.getScriptCwd(),
+                        useWorker=self.isWorkerUsed())
+    self.addLaunchStats(shardId, time.time() - startTime)
+
+    if self.useCache.get():
+      self.storeCachedPredictions(entries, shardId)
+
+  def streamOutputStep(self):
+    """Adds each structure to the open output set as soon as its prediction is written, running alongside the
+    prediction steps until all of them finished"""
+    nShards, outputNames = len(self.getShardDevices()), self.getOutputNames()
+    inputNames = [name for name, _ in self.getInputEntries()]
+    while True:
+      # Checked before reading the logs, so the predictions logged by a shard before it finished are added
+      finished = all(os.path.exists(self.getShardDoneFile(shardId)) for shardId in range(nShards))
+      self.appendOutputStructures([entry['name'] for entry in self.getLogEntries() if entry['status'] == 'done'],
+                                  outputNames=outputNames, inputNames=inputNames)
+      if finished:
+        break
+      time.sleep(OUTPUT_POLL_INTERVAL)
+
+  def jobArrayStep(self):
+    """Submits the manifests as the tasks of a job array and adds the structures of each task to the output set
+    as soon as it finishes"""
+    jobDir = self.getJobArrayDir()
+    taskIds = getManifestIds(jobDir)
+    for taskId in taskIds:
+      # Left by a previous run of the step: the tasks run again, resuming their manifests
+      if os.path.exists(getExitFile(jobDir, taskId)):
+        os.remove(getExitFile(jobDir, taskId))
+
+    outputNames, inputNames = self.getOutputNames(), [name for name, _ in self.getInputEntries()]
+    self.appendOutputStructures([entry['name'] for entry in self.getLogEntries() if entry.get('cached')],
+                                outputNames=outputNames, inputNames=inputNames)
+
+    scriptFile = writeTaskScript(os.path.join(jobDir, 'runTask.sh'), self.getTaskCommand(), jobDir)
+    executor = self.getJobArrayExecutor(scriptFile)
+    executor.submit(taskIds)
+    self.info(f'Submitted job array of {len(taskIds)} tasks ({type(executor).__name__})')
+
+    for taskId, exitCode in iterFinishedTasks(executor, taskIds, jobDir, JOB_ARRAY_POLL_INTERVAL):
+      entries = readFasta(getManifestFile(jobDir, taskId))
+      logged = {entry['name'] for entry in self.getLogEntries()}
+      for name, sequence in entries:
+        if name not in logged:
+          self.writeLogEntry({'name': name, 'length': len(sequence), 'status': 'failed',
+                              'error': f'Job array task {taskId} exited with code {exitCode}'})
+      self.info(f'Job array task {taskId} finished with exit code {exitCode}')
+
+      self.appendOutputStructures([name for name, _ in entries], outputNames=outputNames, inputNames=inputNames)
+      if self.useCache.get():
+        self.storeCachedPredictions(entries, f'task{taskId}')
 
   def createOutputStep(self):
-    fnOut = self._getPath(f'{self.getInputName()}.pdb')
+    startTime, outputTimes, summaryRows = time.time(), {}, []
+    logEntries = {entry['name']: entry for entry in self.getLogEntries()}
+    if self.isInputSet() and not self.isComplex():
+      # Most structures were added while being predicted: the rest are added before closing the set
+      inputNames = [name for name, _ in self.getInputEntries()]
+      self.appendOutputStructures(inputNames, outputTimes, inputNames=inputNames)
+      self.closeOutputSet()
+      outputNames, archives = self.getOutputNames(), self.getArchivedPredictions(logEntries)
+      summaryRows = [self.getConfidenceRow(name, logEntries.get(name, {}), archives.get(name))
+                     for name in inputNames if name in outputNames]
+
+    else:
+      name = self.getFoldEntries()[0][0]
+      archived = self.getArchivedPredictions(logEntries).get(name)
+      outStructFileName = self.createStructureFile(name, self._getPath('outputStructureESMFold.cif'), archived)
+      outputTimes[name] = time.time() - startTime
+      if outStructFileName:
+        outAS = AtomStruct(filename=outStructFileName)
+        summaryRows.append(self.setConfidenceAttributes(outAS, name, logEntries.get(name, {}), archived))
+        self._defineOutputs(**{self._OUTNAME: outAS})
+        self._defineSourceRelation(self.inputSequence, outAS)
+
+    self.writeSummaryTable(summaryRows)
+    self.writeReport(outputTimes, time.time() - startTime)
+
+  def _validate(self):
+    errors = []
+    if self.foldComplex.get() and not self.isInputSet():
+      errors.append('Folding a complex needs a set of sequences as input, one per chain')
+    if self.clusterSequences.get() and not 0 < self.clusterIdentity.get() <= 1:
+      errors.append('The cluster identity must be between 0 and 1')
+    if self.useJobArray.get() and not self.foldComplex.get() and not self.isInputSet():
+      errors.append('Submitting a job array needs a set of sequences as input')
+    if self.windowLength.get() > 0 and self.windowOverlap.get() >= self.windowLength.get():
+      errors.append('The window overlap must be smaller than the window length')
+    if self.getEnumText('lmPrecision') == 'int8' and self.getEnumText('device') != 'cpu':
+      errors.append('int8 quantization of the language model is only available on CPU')
+    return errors
+
+  def _summary(self):
+    summary = []
+    logEntries = self.getLogEntries()
+    if logEntries:
+      failed = [entry['name'] for entry in logEntries if entry['status'] != 'done']
+      summary.append(f'Predicted structures: {len(logEntries) - len(failed)} / {len(logEntries)}')
+      if failed:
+        summary.append(f'Failed predictions ({len(failed)}): {", ".join(failed)}')
+
+      outSet = getattr(self, self._OUTSETNAME, None)
+      if outSet is not None and outSet.isStreamOpen():
+        summary.append(f'Structures in the output set so far: {outSet.getSize()}')
+
+      redundancy = self.getRedundancy()
+      if redundancy:
+        summary.append(f'Distinct sequences: {redundancy["unique"]} / {redundancy["sequences"]}')
+      if redundancy.get('clusters'):
+        nMembers = sum(len(members) for members in redundancy['clusters'].values())
+        summary.append(f'Clustered at {redundancy["identity"]:.2f} identity: {redundancy["folded"]} representatives '
+                       f'folded, {nMembers} members without structure')
+
+      recycles = [entry['recycles'] for entry in logEntries if entry.get('recycles') is not None]
+      if self.adaptiveRecycles.get() and recycles:
+        summary.append(f'Recycles run: mean {np.mean(recycles):.2f} (max {self.nRecycles.get()})')
+
+    for shardId, parity in self.getParityResults().items():
+      if not parity['passed']:
+        summary.append(f'WARNING: shard {shardId} predictions differ from the default mode beyond the parity '
+                       f'tolerance (CA RMSD {parity["rmsd"]:.3f} A, '
+                       f'max pLDDT difference {parity["maxPlddtDifference"]:.2f})')
+
+    if os.path.exists(self.getReportFile()):
+      summary += self.getTimingSummary()
+    return summary
+
+  ########################### UTILS ###########################
+  def getScriptCwd(self):
+    return os.path.join(esmPlugin.getVar(ESM_DIC['home']), 'esm')
+
+  def getPredictionArgs(self, fastaFile, shardId, device):
+    """Returns the runESMFold.py arguments to predict the sequences of a FASTA file in a shard device"""
+    # Resuming skips the sequences already predicted if the protocol is continued after a failure
+    args = f' -if {os.path.abspath(fastaFile)} -m {self.getEnumText("modelName")}' \
+           f' -od {os.path.abspath(self.getPredictionsDir())} -f {self.getEnumText("outputFormat")} --resume' \
+           f' -log {os.path.abspath(self.getLogFile(shardId))} -st {os.path.abspath(self.getStatsFile(shardId))}' \
+           f' -p {self.getEnumText("lmPrecision")} -ms {esmPlugin.getModelStoreDir()}' \
+           f' -cs {self.getChunkSize()} -nr {self.nRecycles.get()} -br {self.batchResidues.get()}'
+    if self.windowLength.get() > 0:
+      args += f' -wl {self.windowLength.get()} -wo {self.windowOverlap.get()}'
+    if self.adaptiveRecycles.get():
+      args += f' -ar -rt {self.rmsdTolerance.get()} -pt {self.plddtTolerance.get()}'
+    if self.saveRecycles.get():
+      args += ' -sr'
+    if self.getEnumText('outputFormat') == 'archive':
+      args += f' -an predictions_{shardId}'
+    if self.getEnumText('autocast') != 'none':
+      args += f' -ac {self.getEnumText("autocast")}'
+    if self.inferenceMode.get():
+      args += ' -im'
+    if self.compileModel.get():
+      args += ' -co'
+    if self.isParityChecked():
+      args += f' -pc -pr {self.parityTolerance.get()} -ppt {self.parityPlddtTolerance.get()}'
+    return args + self.getDeviceArgs(device) + self.getLMCacheArgs()
+
+  def isParityChecked(self):
+    return self.parityCheck.get() and (self.getEnumText('autocast') != 'none' or self.compileModel.get())
+
+  def getParityResults(self):
+    """Returns the parity check results of each shard (or job array task), from its run stats"""
+    results = {}
+    for statsFile in sorted(glob.glob(self.getStatsFile('*'))):
+      with open(statsFile) as f:
+        parity = json.load(f).get('parity')
+      if parity:
+        results[os.path.basename(statsFile)[len('runStats_'):-len('.json')]] = parity
+    return results
+
+  def isJobArray(self):
+    return self.useJobArray.get() and self.isInputSet() and not self.isComplex()
+
+  def isWorkerUsed(self):
+    """The persistent worker runs one job at a time, so it is only used for runs with a single shard: the shards of
+    several devices would otherwise run one after the other in the worker process"""
+    return self.useWorker.get() and len(self.getShardDevices()) == 1
+
+  def getJobArrayDir(self):
+    return self._getExtraPath('jobArray')
+
+  def getTaskCommand(self):
+    """Returns the command run by each task of the job array, with {task} standing for its task id. Each task
+    sees a single GPU, chosen by the queue system or by the local executor"""
+    device = 'cpu' if self.getEnumText('device') == 'cpu' else '0'
+    args = self.getPredictionArgs(getManifestFile(self.getJobArrayDir(), '{task}'), 'task{task}', device)
+    return f'cd {self.getScriptCwd()} && {esmPlugin.getEnvActivationCommand(ESM_DIC)} && ' \
+           f'python {esmPlugin.getScriptsDir(scriptName)}{args}'
+
+  def getJobArrayExecutor(self, scriptFile):
+    """Returns the executor of the job array tasks: the queue system of the host if the protocol uses the queue,
+    or local processes, one per shard device, otherwise"""
+    env = esmPlugin.getScriptEnviron()
+    if self.useQueue():
+      submitDict = self.getSubmitDict()
+      submitDict.update(JOB_THREADS=self.getShardThreads(), JOB_CORES=self.getShardThreads(), JOB_NODES=1,
+                        GPU_COUNT=0 if self.getEnumText('device') == 'cpu' else 1)
+      return QueueArrayExecutor(os.path.abspath(scriptFile), self.getHostConfig(), submitDict, env=env)
+
+    slots = [{} if device == 'cpu' else {'CUDA_VISIBLE_DEVICES': device} for device in self.getShardDevices()]
+    return LocalArrayExecutor(os.path.abspath(scriptFile), slots, self.getJobArrayDir(), env=env)
+
+  def getRedundancyFile(self):
+    return self._getExtraPath('redundancy.json')
+
+  def getClustersFile(self):
+    return self._getExtraPath('clusters.tsv')
+
+  def getRedundancy(self):
+    """Returns the duplicates and clusters found in the input set, empty if it was not reduced"""
+    if not os.path.exists(self.getRedundancyFile()):
+      return {}
+    with open(self.getRedundancyFile()) as f:
+      return json.load(f)
+
+  def reduceRedundancy(self, entries):
+    """Collapses the duplicated sequences of the entries and, optionally, clusters them by identity.
+    Returns the entries to fold, recording the duplicates and clusters found"""
+    nSequences, duplicates, clusters = len(entries), {}, {}
+    if self.collapseDuplicates.get():
+      entries, duplicates = collapseDuplicates(entries)
+    nUnique = len(entries)
+    if self.clusterSequences.get():
+      entries, clusters = clusterSequences(entries, self.clusterIdentity.get())
+      for members in clusters.values():
+        # The duplicates of a member are not folded either
+        for member, identity in list(members):
+          members += [(name, identity) for name in duplicates.pop(member, [])]
+
+    with open(self.getRedundancyFile(), 'w') as f:
+      json.dump({'sequences': nSequences, 'unique': nUnique, 'folded': len(entries),
+                 'identity': self.clusterIdentity.get(), 'duplicates': duplicates, 'clusters': clusters}, f, indent=2)
+    if clusters:
+      with open(self.getClustersFile(), 'w') as f:
+        f.write('member\trepresentative\tidentity\n')
+        for repName, members in clusters.items():
+          f.writelines(f'{member}\t{repName}\t{identity}\n' for member, identity in members)
+
+    self.info(f'Input sequences: {nSequences}, distinct: {nUnique}, to fold: {len(entries)}')
+    return entries
+
+  def fanOutDuplicates(self, names):
+    """Links the predictions of the given sequences to their duplicates, logging them as done.
+    Returns the names of those duplicates"""
+    duplicates = self.getRedundancy().get('duplicates', {})
+    logEntries = {entry['name']: entry for entry in self.getLogEntries()} if duplicates else {}
+    fannedOut = []
+    for name in names:
+      if name not in duplicates or logEntries.get(name, {}).get('status') != 'done':
+        continue
+      for duplicate in duplicates[name]:
+        if duplicate not in logEntries:
+          for suffix in self._PREDICTION_SUFFIXES:
+            if os.path.exists(self.getPredictionFile(name, suffix)):
+              linkOrCopy(self.getPredictionFile(name, suffix), self.getPredictionFile(duplicate, suffix))
+          self.writeLogEntry({'name': duplicate, 'length': logEntries[name].get('length'), 'status': 'done',
+                              'duplicateOf': name})
+        fannedOut.append(duplicate)
+    return fannedOut
+
+  def getOutputStructureFile(self, name):
+    return self._getExtraPath(f'{name}_ESMFold.cif')
+
+  def getOutputSet(self):
+    """Returns the output set of structures opened to append new ones, creating it if it was not defined yet"""
+    outSet = getattr(self, self._OUTSETNAME, None)
+    if outSet is None:
+      outSet = self._createSetOfPDBs()
+      outSet.setStreamState(outSet.STREAM_OPEN)
+    else:
+      outSet.enableAppend()
+    return outSet
+
+  def appendOutputStructures(self, names, outputTimes=None, outputNames=None, inputNames=None):
+    """Adds the structures of the given predictions to the output set, skipping the failed ones and those already
+    added. The set is kept open, so other protocols can use it while the rest are being predicted.
+    Structures are added in input order (see getInOrderNames), so a prediction finishing early waits for those of
+    the sequences before it.
+    Polling loops pass the names already in the output set as outputNames, updated here with the appended ones,
+    and the input names in order as inputNames, so neither set is read back on every poll"""
+    outputNames = self.getOutputNames() if outputNames is None else outputNames
+    inputNames = [name for name, _ in self.getInputEntries()] if inputNames is None else inputNames
+    # The duplicates of the names already added were fanned out with them
+    names = [name for name in dict.fromkeys(names) if name not in outputNames]
+    names = set(names + self.fanOutDuplicates(names))
+    logEntries = {entry['name']: entry for entry in self.getLogEntries()}
+    clusters = self.getRedundancy().get('clusters', {})
+    names = self.getInOrderNames(names, inputNames, outputNames, logEntries, clusters)
+    if not names:
+      return
+    archives = self.getArchivedPredictions(logEntries)
+    isNew, outSet, appended = not hasattr(self, self._OUTSETNAME), None, 0
+    for name in names:
+      structStartTime = time.time()
+      outStructFileName = self.createStructureFile(name, self.getOutputStructureFile(name), archives.get(name))
+      if outputTimes is not None:
+        outputTimes[name] = time.time() - structStartTime
+      if outStructFileName:
+        outSet = outSet or self.getOutputSet()
+        outAS = AtomStruct(filename=outStructFileName)
+        outAS._seqName = String(name)
+        self.setConfidenceAttributes(outAS, name, logEntries.get(name, {}), archives.get(name))
+        if logEntries.get(name, {}).get('duplicateOf'):
+          outAS._esmDuplicateOf = String(logEntries[name]['duplicateOf'])
+        if name in clusters:
+          outAS._esmClusterMembers = String(','.join(member for member, _ in clusters[name]))
+        outSet.append(outAS)
+        outputNames.add(name)
+        appended += 1
+
+    if appended:
+      self._updateOutputSet(self._OUTSETNAME, outSet, outSet.STREAM_OPEN)
+      if isNew:
+        self._defineSourceRelation(self.inputSequence, outSet)
+
+  def getInOrderNames(self, names, inputNames, outputNames, logEntries, clusters):
+    """Returns the predictions that can be added to the output set keeping the input order: the input names after
+    those already added, up to the first one neither given nor logged, as its prediction is still running.
+    Failed predictions and cluster members, which are not folded, are skipped"""
+    members = {member for clusterMembers in clusters.values() for member, _ in clusterMembers}
+    inOrderNames = []
+    for name in inputNames:
+      if name in outputNames or name in members or logEntries.get(name, {}).get('status') == 'failed':
+        continue
+      if name not in names and name not in logEntries:
+        break
+      inOrderNames.append(name)
+    return inOrderNames
+
+  def closeOutputSet(self):
+    outSet = getattr(self, self._OUTSETNAME, None)
+    if outSet is not None:
+      outSet.enableAppend()
+      self._updateOutputSet(self._OUTSETNAME, outSet, outSet.STREAM_CLOSED)
+
+  def getOutputNames(self):
+    """Returns the names of the predictions already in the output set"""
+    outSet = getattr(self, self._OUTSETNAME, None)
+    return set() if outSet is None else {outAS._seqName.get() for outAS in outSet.iterItems()}
+
+  def getArchivedPredictions(self, logEntries):
+    """Returns {name: (archive, archivedName)} for the predictions stored in the structure archives of the protocol,
+    including the duplicates of the archived ones"""
+    archives = {}
+    for prefix in findStructureArchives(self.getPredictionsDir()):
+      archive = StructureArchive(prefix)
+      archives.update({name: (archive, name) for name in archive.getNames()})
+    for name, entry in logEntries.items():
+      if entry.get('duplicateOf') in archives:
+        archives[name] = archives[entry['duplicateOf']]
+    return archives
+
+  def createStructureFile(self, name, outStructFileName, archived=None):
+    """Writes the ESMFold prediction of a sequence as a CIF file including the ESMFold scores, exporting it from its
+    structure archive if given as (archive, archivedName). Returns None if the prediction of this sequence failed."""
+    if archived is not None:
+      archive, archivedName = archived
+      return archive.exportCIF(archivedName, outStructFileName, attrName=self._ATTRNAME)
+
+    cifFile = self.getPredictionFile(name, '.cif')
+    if os.path.exists(cifFile):
+      # Written by runESMFold.py with the ESMFold scores already included
+      linkOrCopy(cifFile, outStructFileName)
+      return outStructFileName
+
+    fnOut = self.getPredictionFile(name)
+    if not os.path.exists(fnOut):
+      return None
+
+    return writeScoredCIF(fnOut, self.getESMFoldScoreDic(name), self._ATTRNAME, outStructFileName,
+                          self._getTmpPath(f'{name}.cif'))
+
+  def getESMFoldScoreDic(self, name=None):
+    """Returns the ESMFold pLDDT of each atom as {'chain:resNumber@atomName': score}.
+    It is built from the pLDDT arrays written by runESMFold.py, falling back to the PDB B-factors if missing"""
+    name = name or self.getFoldEntries()[0][0]
+    plddtFile = self.getPredictionFile(name, '_plddt.npz')
+    if not os.path.exists(plddtFile):
+      return self.getESMFoldScoreDicFromPDB(name)
+    return getPlddtScoreDic(plddtFile)
+
+  def getESMFoldScoreDicFromPDB(self, name):
+    return getPDBScoreDic(self.getPredictionFile(name))
+
+  def getChunkSize(self):
+    return 'auto' if self.autoChunkSize.get() else self.chunkSize.get()
+
+  def getCacheKey(self, sequence, deviceType):
+    """Returns the prediction cache key of a sequence predicted on a device type (cpu or cuda). As in the language
+    model cache, the key includes the language model numerics: its precision and the device type, as ESMFold runs it
+    in float16 on GPU and in float32 on CPU. The chunk size only changes memory use, not results"""
+    params = {'model': self.getEnumText('modelName'), 'nRecycles': self.nRecycles.get(),
+              'lmPrecision': self.getEnumText('lmPrecision'), 'device': deviceType}
+    if 0 < self.windowLength.get() < len(sequence):
+      params.update(windowLength=self.windowLength.get(), windowOverlap=self.windowOverlap.get())
+    if self.adaptiveRecycles.get():
+      params.update(rmsdTolerance=self.rmsdTolerance.get(), plddtTolerance=self.plddtTolerance.get())
+    if self.getEnumText('autocast') != 'none' or self.compileModel.get():
+      params.update(autocast=self.getEnumText('autocast'), compiled=self.compileModel.get())
+    return PredictionCache.getKey(sequence, **params)
+
+  def getCacheDeviceTypes(self):
+    """Returns the device types whose cached predictions can be used. auto runs on the GPU if available and on the
+    CPU otherwise, so it uses the predictions of both"""
+    device = self.getEnumText('device')
+    return ['cuda', 'cpu'] if device == 'auto' else [device]
+
+  def getRunDeviceType(self, shardId):
+    """Returns the device type (cpu or cuda) a shard or job array task ran on, from its run stats, None if unknown"""
+    if not os.path.exists(self.getStatsFile(shardId)):
+      return None
+    with open(self.getStatsFile(shardId)) as f:
+      device = json.load(f).get('device')
+    return device.split(':')[0] if device else None
+
+  def isComplex(self):
+    return self.isInputSet() and self.foldComplex.get()
+
+  def getFoldEntries(self):
+    """Returns the (name, sequence) entries to fold: the input entries, or a single complex entry whose chains
+    are the input sequences separated by ':'"""
+    entries = self.getInputEntries()
+    if self.isComplex():
+      return [('complex', ':'.join(sequence for _, sequence in entries))]
+    return entries
+
+  def getConfidenceRow(self, name, logEntry, archived=None):
+    """Returns the confidence of a prediction (mean pLDDT, pTM), its length, the recycles run and its inference time
+    as a row of the summary table"""
+    row = {'name': name, 'length': None, 'meanPlddt': None, 'ptm': None, 'recycles': None, 'inferenceTime': None}
+    plddtFile = self.getPredictionFile(name, '_plddt.npz')
+    if archived is not None:
+      archive, archivedName = archived
+      row.update({key: value for key, value in archive.getScores(archivedName).items() if key in row})
+    elif os.path.exists(plddtFile):
+      with np.load(plddtFile) as data:
+        row['length'] = len(data['residueId'])
+        for key in ['meanPlddt', 'ptm', 'recycles']:
+          if key in data and not np.isnan(data[key]):
+            row[key] = data[key].item()
+    row['inferenceTime'] = logEntry.get('inferenceTime')
+    return row
+
+  def setConfidenceAttributes(self, outAS, name, logEntry, archived=None):
+    """Stores the confidence row of a prediction and its PAE file (or structure archive) as _esm<Column> attributes
+    of its structure, so it can be filtered without parsing the structure. Returns the row"""
+    row = self.getConfidenceRow(name, logEntry, archived)
+    for column, value in row.items():
+      if column != 'name' and value is not None:
+        attrClass = Integer if column in ['length', 'recycles'] else Float
+        setattr(outAS, self.getSummaryAttribute(column), attrClass(value))
+    paeFile = self.getPredictionFile(name, '_pae.npz')
+    if os.path.exists(paeFile):
+      outAS._esmPAEFile = String(os.path.abspath(paeFile))
+    if archived is not None:
+      outAS._esmArchive = String(os.path.abspath(archived[0].prefix))
+      outAS._esmArchiveName = String(archived[1])
+    return row
+
+  @staticmethod
+  def getSummaryAttribute(column):
+    """Name of the output structure attribute of a summary table column, e.g. _esmMeanPlddt"""
+    return f'_esm{column[0].upper()}{column[1:]}'
+
+  def getSummaryFile(self):
+    return self._getExtraPath('confidenceSummary.csv')
+
+  def writeSummaryTable(self, rows):
+    """Writes the confidence summary of the predictions as a CSV table"""
+    with open(self.getSummaryFile(), 'w') as f:
+      f.write(','.join(self._SUMMARY_COLUMNS) + '\n')
+      for row in rows:
+        f.write(','.join('' if row[column] is None else str(row[column]) for column in self._SUMMARY_COLUMNS) + '\n')
+
+  def retrieveCachedPredictions(self, entries):
+    """Copies the cached predictions of the entries into the predictions directory.
+    Returns the entries that were not found in the cache"""
+    cache, missing = esmPlugin.getPredictionCache(), []
+    for name, sequence in entries:
+      if any(cache.get(self.getCacheKey(sequence, deviceType), self.getPredictionsDir(), name)
+             for deviceType in self.getCacheDeviceTypes()):
+        self.writeLogEntry({'name': name, 'length': len(sequence), 'status': 'done', 'cached': True})
+      else:
+        missing.append((name, sequence))
+
+    self.info(f'Predictions found in cache: {len(entries) - len(missing)} / {len(entries)}')
+    return missing
+
+  def storeCachedPredictions(self, entries, shardId):
+    """Stores the successful predictions of the entries, run by a shard or job array task, in the cache.
+    They are not stored if the device they ran on is unknown"""
+    deviceType = self.getRunDeviceType(shardId)
+    if deviceType is None:
+      return
+    cache = esmPlugin.getPredictionCache()
+    done = {entry['name'] for entry in self.getLogEntries() if entry['status'] == 'done'}
+    for name, sequence in entries:
+      files = [self.getPredictionFile(name, suffix) for suffix in self._PREDICTION_SUFFIXES]
+      files = [file for file in files if os.path.exists(file)]
+      # Archived predictions have no files of their own
+      if name in done and files:
+        cache.put(self.getCacheKey(sequence, deviceType), name, files)
+
+  def getPredictionsDir(self):
+    return self._getExtraPath('predictions')
+
+  def getPredictionFile(self, name, ext='.pdb'):
+    return os.path.join(self.getPredictionsDir(), name + ext)
+
+  def getShardDoneFile(self, shardId):
+    return self._getExtraPath(f'shard_{shardId}.done')
+
+  def getLogFile(self, shardId=None):
+    """Returns the JSON lines file with the status of the predictions of a shard, or of the cached predictions"""
+    return self._getExtraPath('predictions.jsonl' if shardId is None else f'predictions_{shardId}.jsonl')
+
+  def writeLogEntry(self, entry):
+    with open(self.getLogFile(), 'a') as f:
+      f.write(json.dumps(entry) + '\n')
+
+  def getLogEntries(self):
+    """Returns the last logged status of each prediction"""
+    entries = {}
+    for logFile in sorted(glob.glob(self._getExtraPath('predictions*.jsonl'))):
+      with open(logFile) as f:
+        for line in f:
+          # A line without its end is being written by a running prediction
+          if line.strip() and line.endswith('\n'):
+            entry = json.loads(line)
+            entries[entry['name']] = entry
+    return list(entries.values())
 
-    if os.path.exists(fnOut):
-      outStructFileName = self._getPath('outputStructureESMFold.cif')
-      # Write conservation in a section of the output cif file
-      ASH = AtomicStructHandler()
+  def getStatsFile(self, shardId):
+    return self._getExtraPath(f'runStats_{shardId}.json')
 
-      esmDic = self.getESMFoldScoreDic()
-      inpAS = toCIF(fnOut, self._getTmpPath('inputStruct.cif'))
-      cifDic = ASH.readLowLevel(inpAS)
-      cifDic = addScipionAttribute(cifDic, esmDic, self._ATTRNAME, recipient='atoms')
-      ASH._writeLowLevel(outStructFileName, cifDic)
+  def getReportFile(self):
+    return self._getExtraPath('esmfoldReport.json')
 
-      outAS = AtomStruct(filename=outStructFileName)
-      self._defineOutputs(outputStructure=outAS)
+  def addLaunchStats(self, shardId, wallTime):
+    """Adds to the stats written by runESMFold.py the wall time of the whole runScript call and the launch overhead
+    (see getLaunchOverhead)"""
+    stats = {}
+    if os.path.exists(self.getStatsFile(shardId)):
+      with open(self.getStatsFile(shardId)) as f:
+        stats = json.load(f)
+    stats['wallTime'] = wallTime
+    if 'totalTime' in stats:
+      stats['launchOverhead'] = getLaunchOverhead(wallTime, stats)
+    with open(self.getStatsFile(shardId), 'w') as f:
+      json.dump(stats, f, indent=2)
 
+  def writeReport(self, outputTimes, outputWallTime):
+    """Writes a JSON report with the time and memory of each stage of the run: per shard (launch, import, model
+    load, to device, inference, write), per sequence (inference, write, output creation) and of the output step"""
+    shards = {}
+    for statsFile in sorted(glob.glob(self.getStatsFile('*'))):
+      with open(statsFile) as f:
+        shards[os.path.basename(statsFile)[len('runStats_'):-len('.json')]] = json.load(f)
 
-  def getESMFoldScoreDic(self):
-    fnOut = self._getPath(f'{self.getInputName()}.pdb')
-    ASH = AtomicStructHandler()
-    ASH.read(fnOut)
+    sequences = {}
+    for entry in self.getLogEntries():
+      sequences[entry['name']] = {key: value for key, value in entry.items() if key != 'name'}
+      sequences[entry['name']]['outputTime'] = outputTimes.get(entry['name'])
 
-    esmDic = {}
-    for model in ASH.structure:
-      for atom in model.get_atoms():
-        fId = atom.get_full_id()
-        chainName, resNumber, atomName = fId[2], fId[3][1], fId[4][0]
-        atomId = '{}:{}@{}'.format(chainName, resNumber, atomName)
-        esmScore = atom.get_bfactor()
-        esmDic[atomId] = esmScore
+    report = {'protocol': self.getObjId(), 'model': self.getEnumText('modelName'), 'device': self.getEnumText('device'),
+              'shards': shards, 'sequences': sequences,
+              'createOutput': {'wallTime': outputWallTime,
+                               'peakRSS': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}}
+    with open(self.getReportFile(), 'w') as f:
+      json.dump(report, f, indent=2)
 
-    return esmDic
+  def getTimingSummary(self, maxListed=10):
+    """Summarizes the timings of the report: totals per stage and per sequence times"""
+    with open(self.getReportFile()) as f:
+      report = json.load(f)
 
-  def getInputSequence(self):
-    return self.inputSequence.get().getSequence()
+    summary = []
+    for shardId, stats in report['shards'].items():
+      stages = ', '.join(f'{stage} {stats[stage]:.1f} s' for stage in
+                         ['launchOverhead', 'importTime', 'modelLoad', 'toDevice', 'parity', 'inference', 'write']
+                         if stage in stats)
+      summary.append(f'Shard {shardId} ({stats.get("device")}): {stages}')
 
-  def getInputName(self):
-    return self.inputSequence.get().getSeqName()
\ No newline at end of file
+    sequences = {name: times for name, times in report['sequences'].items() if 'inferenceTime' in times}
+    if sequences:
+      inferenceTimes = [times['inferenceTime'] for times in sequences.values()]
+      summary.append(f'Inference time per sequence: mean {np.mean(inferenceTimes):.2f} s, '
+                     f'max {np.max(inferenceTimes):.2f} s')
+      if len(sequences) <= maxListed:
+        for name, times in sequences.items():
+          summary.append(f'  {name} ({times["length"]} res): inference {times["inferenceTime"]:.2f} s, '
+                         f'write {times["writeTime"]:.2f} s, output {times.get("outputTime") or 0:.2f} s')
+    summary.append(f'Output creation: {report["createOutput"]["wallTime"]:.1f} s')
+    return summary
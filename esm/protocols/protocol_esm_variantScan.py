@@ -0,0 +1,203 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import numpy as np
+
+from pyworkflow.protocol import params
+from pyworkflow.object import String
+from pwem.objects import AtomStruct, SetOfSequences
+
+from .. import Plugin as esmPlugin
+from ..constants import ESM_DIC
+from ..utils import writeFasta, splitInShards
+from .protocol_esm_base import ProtESMBase
+
+scriptName = 'runESMVariantScan.py'
+
+class ProtESMVariantScan(ProtESMBase):
+  """Zero-shot scoring of the effect of mutations of a protein sequence (or set of sequences) with an ESM language
+  model, as the log probability ratio of the mutant against the wild type residue. A full deep mutational scan
+  takes one (wild type marginals) or a few batched (masked marginals) forward passes per sequence"""
+  _label = 'ESM variant scan'
+  _ATTRNAME = 'ESMVariantScore'
+  _OUTNAME = 'outputSequences'
+  _OUTSTRUCTNAME = 'outputStructure'
+  _possibleOutputs = {_OUTNAME: SetOfSequences, _OUTSTRUCTNAME: AtomStruct}
+  _AGGREGATES = ['mean', 'min']
+
+  def _defineParams(self, form):
+    form.addHidden(params.GPU_LIST, params.StringParam, default='0', label="Choose GPU IDs",
+                   help="Add a list of GPU device that can be used. The input sequences are split among them, "
+                        "each GPU running its share in a parallel step (the protocol needs as many threads)")
+    form.addSection(label='Input')
+    iGroup = form.addGroup('Input')
+    iGroup.addParam('inputSequence', params.PointerParam, pointerClass="Sequence, SetOfSequences",
+                    label='Input protein sequence(s): ',
+                    help="Protein sequence or set of sequences whose mutations are scored")
+    iGroup.addParam('mutationMode', params.EnumParam, choices=['All single mutants', 'Mutation list'],
+                    label='Mutations to score: ', default=0,
+                    help='Score every single mutant, or only the ones in a list. The full L x 20 score matrix is '
+                         'written in both cases')
+    iGroup.addParam('mutations', params.TextParam, label='Mutations: ', condition='mutationMode==1',
+                    help='One mutation per line, as <wild type><position><mutant> (e.g. A23G). Multiple mutants are '
+                         'joined by ":" (e.g. A23G:K45R) and scored as the sum of their single mutations')
+    iGroup.addParam('offset', params.IntParam, label='First residue number: ', default=1,
+                    help='Number of the first residue of the sequence, used for the mutation positions and to map '
+                         'the scores onto the structure residues')
+    iGroup.addParam('mapOnStructure', params.BooleanParam, label='Map scores onto a structure: ', default=False,
+                    help='Add the aggregated score of each residue to a structure of the (single) input sequence')
+    iGroup.addParam('inputStructure', params.PointerParam, pointerClass='AtomStruct', condition='mapOnStructure',
+                    label='Structure to map the scores on: ',
+                    help='Optional structure of the (single) input sequence, e.g. an ESMFold prediction. The '
+                         'aggregated score of each residue is added as the %s attribute, to be displayed in '
+                         'Chimera' % self._ATTRNAME)
+    iGroup.addParam('chainName', params.StringParam, label='Structure chain: ', default='A',
+                    condition='mapOnStructure',
+                    help='Chain of the structure corresponding to the input sequence')
+    iGroup.addParam('aggregate', params.EnumParam, choices=self._AGGREGATES, label='Residue aggregate: ', default=0,
+                    condition='mapOnStructure',
+                    help='Score of each residue mapped onto the structure: the mean or the minimum of the scores of '
+                         'its 19 substitutions. Lower values mean less tolerated positions')
+
+    mGroup = form.addGroup('Model')
+    mGroup.addParam('modelName', params.EnumParam,
+                    choices=['esm2_t6_8M_UR50D', 'esm2_t12_35M_UR50D', 'esm2_t30_150M_UR50D', 'esm2_t33_650M_UR50D',
+                             'esm2_t36_3B_UR50D', 'esm1v_t33_650M_UR90S_1'],
+                    label='Model to use: ', default=3,
+                    help='ESM language model scoring the mutations')
+    mGroup.addParam('scoring', params.EnumParam, choices=['wt-marginals', 'masked-marginals'],
+                    label='Scoring: ', default=1,
+                    help='wt-marginals: the probabilities of every position are read from a single forward pass of '
+                         'the wild type sequence.\n'
+                         'masked-marginals: each position is masked and predicted from the rest of the sequence, '
+                         'batching the masked copies in a few forward passes. More accurate.')
+    mGroup.addParam('maskBatch', params.IntParam, label='Masked copies per pass: ', default=32,
+                    condition='scoring==1', expertLevel=params.LEVEL_ADVANCED,
+                    help='Number of masked copies of the sequence scored in each forward pass. Batches running out '
+                         'of memory are split in half')
+
+    eGroup = form.addGroup('Execution')
+    self._defineDeviceParams(eGroup)
+
+    form.addParallelSection(threads=4, mpi=0)
+
+  def _insertAllSteps(self):
+    convertId = self._insertFunctionStep(self.convertInputStep)
+    scanIds = [self._insertFunctionStep(self.scanStep, shardId, device, prerequisites=[convertId])
+               for shardId, device in enumerate(self.getShardDevices())]
+    self._insertFunctionStep(self.createOutputStep, prerequisites=scanIds)
+
+  def convertInputStep(self):
+    os.makedirs(self.getScansDir(), exist_ok=True)
+    for shardId, shardEntries in enumerate(splitInShards(self.getInputEntries(), len(self.getShardDevices()))):
+      writeFasta(shardEntries, self.getShardFasta(shardId))
+    if self.mutationMode.get() == 1:
+      with open(self.getMutationsFile(), 'w') as f:
+        # Not stripped at the start, so the warnings of skipped mutations name their line in the form
+        f.write(self.mutations.get().rstrip() + '\n')
+
+  def scanStep(self, shardId, device):
+    fastaFile = self.getShardFasta(shardId)
+    if os.path.getsize(fastaFile) == 0:
+      return
+
+    cwd = os.path.join(esmPlugin.getVar(ESM_DIC['home']), 'esm')
+    args = f' -if {os.path.abspath(fastaFile)} -od {os.path.abspath(self.getScansDir())}' \
+           f' -m {self.getEnumText("modelName")} -s {self.getEnumText("scoring")} -mb {self.maskBatch.get()}' \
+           f' -off {self.offset.get()}'
+    if self.mutationMode.get() == 1:
+      args += f' -mf {os.path.abspath(self.getMutationsFile())}'
+    args += self.getDeviceArgs(device)
+    esmPlugin.runScript(self, scriptName, args, envDict=ESM_DIC, cwd=cwd)
+
+  def createOutputStep(self):
+    outSet = self._createSetOfSequences()
+    inputSequences = self.inputSequence.get() if self.isInputSet() else [self.inputSequence.get()]
+    for sequence, (name, _) in zip(inputSequences, self.getInputEntries()):
+      scoresFile = self.getScanFile(name)
+      if os.path.exists(scoresFile):
+        outSeq = sequence.clone()
+        outSeq._variantScores = String(os.path.abspath(scoresFile))
+        outSeq._variantMutations = String(os.path.abspath(self.getScanFile(name, '_mutations.tsv')))
+        outSet.append(outSeq)
+
+    if len(outSet) > 0:
+      self._defineOutputs(**{self._OUTNAME: outSet})
+      self._defineSourceRelation(self.inputSequence, outSet)
+
+    if self.mapOnStructure.get() and os.path.exists(self.getScanFile(self.getInputName())):
+      outStructFile = self.createStructureFile(self.getInputName(), self._getPath('outputStructureVariants.cif'))
+      outAS = AtomStruct(filename=outStructFile)
+      self._defineOutputs(**{self._OUTSTRUCTNAME: outAS})
+      self._defineSourceRelation(self.inputStructure, outAS)
+
+  def _validate(self):
+    errors = []
+    if self.mapOnStructure.get() and self.isInputSet():
+      errors.append('The scores can only be mapped onto a structure for a single input sequence')
+    if self.mutationMode.get() == 1 and not (self.mutations.get() or '').strip():
+      errors.append('The list of mutations is empty')
+    return errors
+
+  def _summary(self):
+    summary = []
+    if hasattr(self, self._OUTNAME):
+      summary.append(f'Scanned sequences: {len(getattr(self, self._OUTNAME))} with {self.getEnumText("modelName")} '
+                     f'({self.getEnumText("scoring")})')
+    if hasattr(self, self._OUTSTRUCTNAME):
+      summary.append(f'Residue {self.getEnumText("aggregate")} scores mapped onto the structure as the '
+                     f'{self._ATTRNAME} attribute')
+    return summary
+
+  ########################### UTILS ###########################
+  def getScansDir(self):
+    return self._getExtraPath('variantScans')
+
+  def getScanFile(self, name, suffix='_variants.npz'):
+    return os.path.join(self.getScansDir(), name + suffix)
+
+  def getMutationsFile(self):
+    return self._getExtraPath('mutations.txt')
+
+  def getVariantScoreDic(self, name):
+    """Returns the aggregated score of each residue of the structure chain as {'chain:resNumber': score}"""
+    with np.load(self.getScanFile(name)) as data:
+      positions, residueScores = data['positions'], data[f'{self.getEnumText("aggregate")}Score']
+    chainName = self.chainName.get().strip()
+    return {f'{chainName}:{position}': round(float(score), 3)
+            for position, score in zip(positions, residueScores) if not np.isnan(score)}
+
+  def createStructureFile(self, name, outStructFileName):
+    """Writes the input structure as a CIF file with the aggregated variant score of each residue of the chain"""
+    from pwem.convert.atom_struct import toCIF, AtomicStructHandler, addScipionAttribute
+    ASH = AtomicStructHandler()
+    inpAS = toCIF(self.inputStructure.get().getFileName(), self._getTmpPath('inputStructure.cif'))
+    cifDic = ASH.readLowLevel(inpAS)
+    cifDic = addScipionAttribute(cifDic, self.getVariantScoreDic(name), self._ATTRNAME, recipient='residues')
+    ASH._writeLowLevel(outStructFileName, cifDic)
+    return outStructFileName
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'ddelhoyo@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""Memory-mapped store of ESM-2 embeddings written by runESMEmbeddings.py.
+Only depends on NumPy, so it can also be used by the protocols to read single sequence embeddings without loading
+the whole store."""
+
+import os, json
+import numpy as np
+
+# Files of an embedding store, named <prefix><suffix>
+RESIDUES_SUFFIX, MEAN_SUFFIX, INDEX_SUFFIX, INFO_SUFFIX = '_residues.npy', '_mean.npy', '_index.tsv', '_info.json'
+INDEX_HEADER = ['row', 'name', 'length', 'offset']
+
+
+def getStoreFiles(prefix):
+    return [prefix + suffix for suffix in [RESIDUES_SUFFIX, MEAN_SUFFIX, INDEX_SUFFIX, INFO_SUFFIX]]
+
+
+def hasEmbeddingStore(prefix):
+    return all(os.path.exists(storeFile) for storeFile in getStoreFiles(prefix))
+
+
+def writeIndex(index, indexFile):
+    """Writes the (row, name, length, offset) entries of the sequences of a store"""
+    with open(indexFile, 'w') as f:
+        f.write('\t'.join(INDEX_HEADER) + '\n')
+        for entry in index:
+            f.write('\t'.join(map(str, entry)) + '\n')
+
+
+def readIndex(indexFile):
+    """Returns a dictionary {name: (row, length, offset)} from the index of a store"""
+    index = {}
+    with open(indexFile) as f:
+        next(f)
+        for line in f:
+            row, name, length, offset = line.rstrip('\n').split('\t')
+            index[name] = (int(row), int(length), int(offset))
+    return index
+
+
+class EmbeddingStore:
+    """Read access to an embedding store. The arrays are memory-mapped, so reading the embedding of a sequence
+    only loads its rows"""
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.index = readIndex(prefix + INDEX_SUFFIX)
+        with open(prefix + INFO_SUFFIX) as f:
+            self.info = json.load(f)
+        self._residues, self._means = None, None
+
+    def getNames(self):
+        return list(self.index)
+
+    def getDimension(self):
+        return self.info['dim']
+
+    def getResidueEmbeddings(self, name):
+        """Returns the (length x dim) per residue embeddings of a sequence"""
+        if self._residues is None:
+            self._residues = np.load(self.prefix + RESIDUES_SUFFIX, mmap_mode='r')
+        _, length, offset = self.index[name]
+        return np.asarray(self._residues[offset:offset + length])
+
+    def getMeanEmbedding(self, name):
+        """Returns the (dim) mean pooled embedding of a sequence"""
+        if self._means is None:
+            self._means = np.load(self.prefix + MEAN_SUFFIX, mmap_mode='r')
+        return np.asarray(self._means[self.index[name][0]])
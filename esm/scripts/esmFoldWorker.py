@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'ddelhoyo@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os, sys, json, shlex, socket, argparse, traceback
+
+# Importing runESMFold loads torch and esm once for the whole life of the worker
+import runESMFold
+
+workerScripts = {'runESMFold.py': runESMFold}
+
+
+class SocketWriter:
+    """File-like object that forwards the output of a job, line by line, to the client.
+    If the client disconnects, the rest of the output is dropped and the job goes on, writing its results to files"""
+    def __init__(self, conn):
+        self.conn, self.buffer, self.connected = conn, '', True
+
+    def write(self, text):
+        self.buffer += text
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            self.send({'log': line})
+        return len(text)
+
+    def flush(self):
+        if self.buffer:
+            self.send({'log': self.buffer})
+            self.buffer = ''
+
+    def send(self, message):
+        if self.connected:
+            try:
+                self.conn.sendall((json.dumps(message) + '\n').encode())
+            except OSError:
+                self.connected = False
+
+
+def runJob(request, writer):
+    """Runs a script job inside the worker, reusing the models it already holds.
+    A failing job, including the SystemExit of invalid arguments, only fails the job: the worker keeps serving"""
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = writer
+    try:
+        script = workerScripts[request['script']]
+        script.run(script.parseArgs(shlex.split(request['args'])))
+        status = {'status': 'done'}
+    except SystemExit as e:
+        status = {'status': 'failed', 'error': f'{request["script"]} exited with code {e.code}'}
+    except Exception as e:
+        traceback.print_exc()
+        status = {'status': 'failed', 'error': str(e)}
+    finally:
+        writer.flush()
+        sys.stdout, sys.stderr = stdout, stderr
+    return status
+
+
+def serve(socketFile, idleTimeout):
+    if os.path.exists(socketFile):
+        os.remove(socketFile)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socketFile)
+    server.listen()
+    server.settimeout(idleTimeout if idleTimeout > 0 else None)
+    print(f'ESMFold worker listening on {socketFile}', flush=True)
+
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                print(f'No jobs received in {idleTimeout} s, stopping the worker', flush=True)
+                break
+
+            with conn:
+                conn.settimeout(None)
+                writer = SocketWriter(conn)
+                try:
+                    request = json.loads(conn.makefile().readline())
+                    command = request['cmd']
+                except (OSError, ValueError, KeyError, TypeError) as e:
+                    print(f'Invalid request: {e}', flush=True)
+                    writer.send({'status': 'failed', 'error': f'Invalid request: {e}'})
+                    continue
+                if command == 'ping':
+                    writer.send({'status': 'alive', 'pid': os.getpid()})
+                elif command == 'stop':
+                    writer.send({'status': 'stopped'})
+                    break
+                elif command == 'run':
+                    print(f'Running job: {request.get("script")} {request.get("args")}', flush=True)
+                    writer.send(runJob(request, writer))
+    finally:
+        server.close()
+        if os.path.exists(socketFile):
+            os.remove(socketFile)
+
+
+if __name__ == "__main__":
+    '''Use: python <scriptName> -s/--socket <socketFile> -t/--idleTimeout <seconds>
+    Starts a long-lived worker that keeps the ESMFold models in memory and runs the jobs received through a local
+    Unix socket. Each request is a JSON line ({"cmd": "run", "script": ..., "args": ...}, or "ping"/"stop" commands)
+    and the job output is streamed back as JSON lines, the last one holding its status.
+    The worker exits, releasing the model memory, after idleTimeout seconds without jobs.
+    '''
+    parser = argparse.ArgumentParser(description='Persistent ESMFold inference worker')
+    parser.add_argument('-s', '--socket', type=str, required=True, help='Unix socket file to listen on')
+    parser.add_argument('-t', '--idleTimeout', type=int, default=1800,
+                        help='Seconds without jobs before the worker exits. 0 to never exit')
+    args = parser.parse_args()
+    serve(args.socket, args.idleTimeout)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'ddelhoyo@cnb.csic.es'
+# *
+# **************************************************************************
+"""On-disk cache of ESM-2 language model representations, shared by runESMFold.py (whose first stage is the ESM-2
+trunk) and runESMEmbeddings.py. Only depends on NumPy."""
+
+import os, json, hashlib
+import numpy as np
+
+# Bump when the layout of the stored representations changes, so older entries are not reused
+LM_CACHE_VERSION = 1
+
+
+class LMCache:
+    """Cache of the representations of all the layers of an ESM-2 model for a token sequence, stored as a
+    (length x layers x dim) float16 .npy file named after the hash of the tokens, the model and its version key.
+    Entries are evicted in least recently used order when the cache exceeds maxSize (bytes)."""
+    def __init__(self, cacheDir, maxSize, version=''):
+        self.cacheDir, self.maxSize, self.version = cacheDir, maxSize, version
+        self.hits = self.misses = 0
+
+    def getKey(self, tokens, modelName):
+        """Returns the key of the representations of a token sequence (the ESM alphabet tokens as a string, without
+        BOS/EOS) computed by modelName. The version key (e.g. the esm package version and the model precision)
+        keeps apart representations that would not be interchangeable"""
+        content = json.dumps({'tokens': tokens, 'model': modelName, 'version': self.version,
+                              'format': LM_CACHE_VERSION}, sort_keys=True)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def getEntryFile(self, key):
+        return os.path.join(self.cacheDir, key[:2], key + '.npy')
+
+    def get(self, key):
+        """Returns the cached representations of key, or None"""
+        entryFile = self.getEntryFile(key)
+        try:
+            representations = np.load(entryFile)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        # Mark the entry as recently used
+        os.utime(entryFile)
+        self.hits += 1
+        return representations
+
+    def put(self, key, representations):
+        """Stores the (length x layers x dim) representations of key"""
+        entryFile = self.getEntryFile(key)
+        if os.path.exists(entryFile):
+            return
+        os.makedirs(os.path.dirname(entryFile), exist_ok=True)
+        # Written in a temporary file and renamed, so concurrent readers never see half-written entries
+        tmpFile = f'{entryFile}.{os.getpid()}.tmp'
+        with open(tmpFile, 'wb') as f:
+            np.save(f, representations.astype(np.float16))
+        os.replace(tmpFile, entryFile)
+
+    def getEntries(self):
+        """Returns a list of (lastUsedTime, size, entryFile) for the cache entries"""
+        entries = []
+        if not os.path.isdir(self.cacheDir):
+            return entries
+        for prefix in os.listdir(self.cacheDir):
+            prefixDir = os.path.join(self.cacheDir, prefix)
+            for fileName in os.listdir(prefixDir):
+                if fileName.endswith('.npy'):
+                    entryFile = os.path.join(prefixDir, fileName)
+                    entries.append((os.path.getmtime(entryFile), os.path.getsize(entryFile), entryFile))
+        return entries
+
+    def evict(self):
+        """Removes the least recently used entries until the cache size is under maxSize"""
+        entries = sorted(self.getEntries())
+        totalSize = sum(entry[1] for entry in entries)
+        for _, size, entryFile in entries:
+            if totalSize <= self.maxSize:
+                break
+            try:
+                os.remove(entryFile)
+            except OSError:
+                pass
+            totalSize -= size
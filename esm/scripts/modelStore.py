@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'ddelhoyo@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Local store of ESMFold weights in a memory-mappable format:
+    <storeDir>/<modelName>.bin: raw tensor data, each tensor 64-byte aligned
+    <storeDir>/<modelName>.json: index with the dtype, shape and offset of each tensor and the ESM-2 architecture
+    <storeDir>/<modelName>_config.yaml: ESMFold configuration (_config.pt, pickled, in stores of previous versions)
+Loading maps the data file instead of unpickling a checkpoint, so tensors are paged in lazily, no full copy is kept
+in RAM and concurrent processes on the same host share the page cache. It does not need the torch hub cache,
+so it also works on offline nodes.
+The module skeleton is only built without allocating its weights with torch >= 2.0 (meta device). With older torch
+versions, it is built with random weights that are then replaced by the stored ones, so the peak memory of loading
+is about twice the model size, as when loading a checkpoint.
+"""
+
+import os, json, inspect, argparse
+import numpy as np
+import torch, esm
+
+STORE_VERSION = 1
+ALIGNMENT = 64
+# Tensors whose dtype NumPy does not support are stored as same-size integers and viewed back by torch
+NUMPY_STORAGE = {torch.bfloat16: np.int16}
+
+
+def getStoreFiles(storeDir, modelName):
+    """Returns the data, index and configuration files of a stored model"""
+    prefix = os.path.join(storeDir, modelName)
+    configFile = prefix + '_config.yaml'
+    if not os.path.exists(configFile) and os.path.exists(prefix + '_config.pt'):
+        # Pickled configuration written by previous versions of the store
+        configFile = prefix + '_config.pt'
+    return [prefix + '.bin', prefix + '.json', configFile]
+
+
+def saveConfig(config, configFile):
+    from omegaconf import OmegaConf
+    OmegaConf.save(config, configFile)
+
+
+def loadConfig(configFile):
+    """Loads the ESMFold configuration, stored as YAML or pickled by previous versions of the store"""
+    if configFile.endswith('.yaml'):
+        from omegaconf import OmegaConf
+        return OmegaConf.load(configFile)
+    # The pickled configuration is an OmegaConf object, which torch >= 2.6 does not unpickle by default
+    kwargs = {'weights_only': False} if 'weights_only' in inspect.signature(torch.load).parameters else {}
+    return torch.load(configFile, **kwargs)
+
+
+def hasModelStore(storeDir, modelName):
+    return storeDir is not None and all(os.path.exists(f) for f in getStoreFiles(storeDir, modelName))
+
+
+def writeModelStore(model, modelName, storeDir):
+    """Writes the weights and configuration of a loaded ESMFold model in the store"""
+    os.makedirs(storeDir, exist_ok=True)
+    binFile, indexFile, _ = getStoreFiles(storeDir, modelName)
+    configFile = os.path.join(storeDir, modelName + '_config.yaml')
+    index = {'version': STORE_VERSION, 'model': modelName, 'tensors': {},
+             'esm': {'num_layers': model.esm.num_layers, 'embed_dim': model.esm.embed_dim,
+                     'attention_heads': model.esm.attention_heads, 'token_dropout': model.esm.token_dropout}}
+
+    with open(binFile + '.tmp', 'wb') as f:
+        for key, tensor in model.state_dict().items():
+            tensor = tensor.detach().cpu().contiguous()
+            array = tensor.view(NUMPY_STORAGE[tensor.dtype]).numpy() if tensor.dtype in NUMPY_STORAGE \
+                else tensor.numpy()
+            f.write(b'\0' * (-f.tell() % ALIGNMENT))
+            index['tensors'][key] = {'dtype': str(tensor.dtype).replace('torch.', ''), 'shape': list(tensor.shape),
+                                     'offset': f.tell()}
+            f.write(array.tobytes())
+
+    saveConfig(model.cfg, configFile)
+    with open(indexFile, 'w') as f:
+        json.dump(index, f)
+    # The data file is renamed last, so an interrupted build is never taken as a complete store
+    os.replace(binFile + '.tmp', binFile)
+
+
+def mapTensors(binFile, index):
+    """Returns the stored tensors, backed by a copy-on-write memory map of the data file"""
+    data = np.memmap(binFile, dtype=np.uint8, mode='c')
+    tensors = {}
+    for key, info in index['tensors'].items():
+        dtype = getattr(torch, info['dtype'])
+        npDtype = NUMPY_STORAGE.get(dtype) or torch.empty(0, dtype=dtype).numpy().dtype
+        array = np.ndarray(info['shape'], dtype=npDtype, buffer=data, offset=info['offset'])
+        tensor = torch.from_numpy(array)
+        tensors[key] = tensor.view(dtype) if dtype in NUMPY_STORAGE else tensor
+    return tensors
+
+
+def buildSkeleton(index, config, meta=True):
+    """Builds the ESMFold module without loading any weights: the ESM-2 language model, which ESMFold loads from
+    the torch hub when built, is replaced by an empty ESM-2 of the stored architecture.
+    If meta and supported (torch >= 2.0), parameters are created in the meta device, so no memory is allocated for
+    them. Otherwise they are allocated and randomly initialized"""
+    from esm.esmfold.v1 import esmfold as esmfoldModule
+    from esm.model.esm2 import ESM2
+
+    alphabet = esm.data.Alphabet.from_architecture('ESM-1b')
+    original = esmfoldModule.esm_registry.get(config.esm_type)
+    esmfoldModule.esm_registry[config.esm_type] = lambda: (ESM2(alphabet=alphabet, **index['esm']), alphabet)
+    try:
+        if meta and hasattr(torch.device, '__enter__'):
+            with torch.device('meta'):
+                return esmfoldModule.ESMFold(esmfold_config=config)
+        if meta:
+            print(f'torch {torch.__version__} cannot build the model in the meta device: it is allocated before '
+                  f'its weights are replaced by the stored ones, doubling the peak memory of loading', flush=True)
+        return esmfoldModule.ESMFold(esmfold_config=config)
+    finally:
+        esmfoldModule.esm_registry[config.esm_type] = original
+
+
+def assignTensors(model, tensors):
+    """Replaces the parameters and buffers of the model by the stored tensors, without copying them"""
+    for key, tensor in tensors.items():
+        moduleName, _, name = key.rpartition('.')
+        module = model.get_submodule(moduleName) if moduleName else model
+        if name in module._parameters:
+            module._parameters[name] = torch.nn.Parameter(tensor, requires_grad=False)
+        elif name in module._buffers:
+            module._buffers[name] = tensor
+
+
+def loadModelStore(storeDir, modelName):
+    """Loads an ESMFold model from the store, with its weights memory-mapped"""
+    binFile, indexFile, configFile = getStoreFiles(storeDir, modelName)
+    with open(indexFile) as f:
+        index = json.load(f)
+    config = loadConfig(configFile)
+    tensors = mapTensors(binFile, index)
+
+    model = buildSkeleton(index, config)
+    assignTensors(model, tensors)
+    if any(t.is_meta for t in list(model.parameters()) + list(model.buffers())):
+        # Some tensor is not in the store (e.g. a non persistent buffer): build it allocated and copy the weights
+        model = buildSkeleton(index, config, meta=False)
+        model.load_state_dict(tensors, strict=False)
+    return model.eval()
+
+
+if __name__ == "__main__":
+    '''Use: python <scriptName> -m/--models <modelName> [<modelName> ...] -o/--storeDir <storeDir>
+    Loads the ESMFold models from esm.pretrained (downloading them if needed) and writes them in the local store.
+    '''
+    parser = argparse.ArgumentParser(description='Builds the local memory-mappable store of ESMFold weights')
+    parser.add_argument('-m', '--models', type=str, nargs='+', default=['esmfold_v1'], help='ESMFold models to store')
+    parser.add_argument('-o', '--storeDir', type=str, required=True, help='Store directory')
+    args = parser.parse_args()
+
+    for modelName in args.models:
+        if hasModelStore(args.storeDir, modelName):
+            print(f'{modelName} already stored in {args.storeDir}')
+            continue
+        print(f'Storing {modelName} in {args.storeDir}', flush=True)
+        writeModelStore(getattr(esm.pretrained, modelName)(), modelName, args.storeDir)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'ddelhoyo@cnb.csic.es'
+# *
+# **************************************************************************
+
+import json, argparse, itertools
+import numpy as np
+import torch
+
+from runESMFold import iterFasta, getModelFactory, getDevice, setCPUThreads, isOutOfMemory, clearDeviceCache, \
+    getLMCache, getLMNumerics, getTokenString
+from embeddingStore import RESIDUES_SUFFIX, MEAN_SUFFIX, INDEX_SUFFIX, INFO_SUFFIX, writeIndex
+
+
+def indexRecords(fastaFile):
+    """Returns the (row, name, length, offset) of each input record, in input order. Only the lengths are kept, so the
+    output arrays can be allocated before the sequences are embedded"""
+    index, offset = [], 0
+    for row, (name, sequence) in enumerate(iterFasta(fastaFile)):
+        index.append((row, name, len(sequence), offset))
+        offset += len(sequence)
+    return index
+
+
+def makeTokenBatches(records, tokensPerBatch, sortWindow=0):
+    """Sorts the (row, name, sequence) records by length and groups them in batches of at most tokensPerBatch
+    (padded) tokens, counting the BOS and EOS tokens. Longer sequences get their own batch.
+    Records are consumed lazily, sorting windows of sortWindow records at a time (all of them if <= 0)"""
+    records = iter(records)
+    while True:
+        window = list(itertools.islice(records, sortWindow)) if sortWindow > 0 else list(records)
+        if not window:
+            return
+
+        batch = []
+        for record in sorted(window, key=lambda r: len(r[2])):
+            if batch and (len(batch) + 1) * (len(record[2]) + 2) > tokensPerBatch:
+                yield batch
+                batch = []
+            batch.append(record)
+        if batch:
+            yield batch
+        if sortWindow <= 0:
+            return
+
+
+def loadLanguageModel(modelName, device):
+    """Loads an ESM-2 model (an esm.pretrained name or <file.py>:<function>) and returns it with its alphabet"""
+    model, alphabet = getModelFactory(modelName)()
+    return model.to(device).eval(), alphabet
+
+
+def embedBatch(model, alphabet, batch, layer, device, lmCache=None, modelName=None):
+    """Returns the per residue representations of the given layer for each (row, name, sequence) of the batch,
+    without the BOS/EOS tokens nor the padding.
+    With a language model cache, cached sequences are not recomputed, and the representations of all the layers
+    of the computed ones are stored, as runESMFold.py needs them all"""
+    _, _, tokens = alphabet.get_batch_converter()([(name, sequence) for _, name, sequence in batch])
+    lengths = [len(sequence) for _, _, sequence in batch]
+    embeddings = [None] * len(batch)
+    if lmCache:
+        keys = [lmCache.getKey(getTokenString(row, alphabet), modelName) for row in tokens.tolist()]
+        for i, key in enumerate(keys):
+            representations = lmCache.get(key)
+            if representations is not None:
+                embeddings[i] = representations[:, layer].astype(np.float32)
+
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        reprLayers = list(range(model.num_layers + 1)) if lmCache else [layer]
+        with torch.no_grad():
+            reprs = model(tokens[missing].to(device), repr_layers=reprLayers)['representations']
+        for j, i in enumerate(missing):
+            embeddings[i] = reprs[layer][j, 1:lengths[i] + 1].float().cpu().numpy()
+            if lmCache:
+                lmCache.put(keys[i], torch.stack([reprs[l][j, 1:lengths[i] + 1] for l in reprLayers], dim=1)
+                            .float().cpu().numpy())
+    return embeddings
+
+
+def embedRecords(model, alphabet, batch, layer, device, lmCache=None, modelName=None):
+    """Embeds a batch, splitting it in half when it runs out of memory. The halves are embedded once the exception
+    handler exits, as its traceback keeps the activations of the failed forward pass alive"""
+    try:
+        return embedBatch(model, alphabet, batch, layer, device, lmCache, modelName)
+    except RuntimeError as e:
+        if not isOutOfMemory(e) or len(batch) == 1:
+            raise
+
+    clearDeviceCache()
+    print(f'Out of memory embedding a batch of {len(batch)} sequences, splitting it', flush=True)
+    half = len(batch) // 2
+    return embedRecords(model, alphabet, batch[:half], layer, device, lmCache, modelName) + \
+           embedRecords(model, alphabet, batch[half:], layer, device, lmCache, modelName)
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Extracts the per residue and mean pooled ESM-2 embeddings of a set '
+                                                 'of protein sequences into memory-mapped .npy files')
+    parser.add_argument('-if', '--inputFasta', type=str, required=True, help='Input (multi-)FASTA file')
+    parser.add_argument('-o', '--outputPrefix', type=str, required=True,
+                        help=f'Prefix of the output files: <prefix>{RESIDUES_SUFFIX} (residues x dim, all the '
+                             f'sequences concatenated), <prefix>{MEAN_SUFFIX} (sequences x dim) and '
+                             f'<prefix>{INDEX_SUFFIX} (row, name, length and residue offset of each sequence)')
+    parser.add_argument('-m', '--ESMModel', type=str, default='esm2_t33_650M_UR50D',
+                        help='ESM-2 model to use: an esm.pretrained model name or <file.py>:<function>')
+    parser.add_argument('-l', '--layer', type=int, default=-1,
+                        help='Layer whose representations are extracted (negative values count from the last one)')
+    parser.add_argument('-tb', '--tokensPerBatch', type=int, default=4096,
+                        help='Maximum number of (padded) tokens of each batch of sequences embedded together')
+    parser.add_argument('-sw', '--sortWindow', type=int, default=1000,
+                        help='Number of records read at a time to sort by length and batch. 0 to read all of them')
+    parser.add_argument('-dt', '--dtype', type=str, default='float32', choices=['float32', 'float16'],
+                        help='Data type of the stored embeddings')
+    parser.add_argument('-d', '--device', type=str, default='cuda', choices=['auto', 'cuda', 'cpu'],
+                        help='Device to run the model on. auto uses cuda if available')
+    parser.add_argument('-g', '--gpuId', type=int, default=0, help='GPU index to use')
+    parser.add_argument('-t', '--threads', type=int, default=0, help='Intra-op CPU threads (0: torch default)')
+    parser.add_argument('-it', '--interopThreads', type=int, default=0, help='Inter-op CPU threads (0: torch default)')
+    parser.add_argument('-lc', '--lmCache', type=str, default=None,
+                        help='Directory of the language model cache shared with runESMFold.py. Cached sequences are '
+                             'not recomputed and the representations of the computed ones are stored')
+    parser.add_argument('-lcs', '--lmCacheSize', type=float, default=50,
+                        help='Maximum size of the language model cache (GB), least recently used entries are evicted')
+    return parser.parse_args(argv)
+
+
+def run(args):
+    device = getDevice(args.device, args.gpuId)
+    if device.type == 'cpu':
+        setCPUThreads(args.threads, args.interopThreads)
+    model, alphabet = loadLanguageModel(args.ESMModel, device)
+    lmCache = getLMCache(args.lmCache, args.lmCacheSize, getLMNumerics(model, device)) if args.lmCache else None
+    layer = args.layer if args.layer >= 0 else model.num_layers + 1 + args.layer
+    dim = model.embed_dim
+
+    # First pass: lengths and offsets, so the arrays can be allocated on disk and filled as batches finish
+    index = indexRecords(args.inputFasta)
+    nResidues = sum(entry[2] for entry in index)
+    residues = np.lib.format.open_memmap(args.outputPrefix + RESIDUES_SUFFIX, mode='w+', dtype=args.dtype,
+                                         shape=(nResidues, dim))
+    means = np.lib.format.open_memmap(args.outputPrefix + MEAN_SUFFIX, mode='w+', dtype=args.dtype,
+                                      shape=(len(index), dim))
+
+    # Second pass: embed the sequences in length-sorted batches, writing each one to its rows
+    records = ((row, name, sequence) for row, (name, sequence) in enumerate(iterFasta(args.inputFasta)))
+    for batch in makeTokenBatches(records, args.tokensPerBatch, args.sortWindow):
+        embeddings = embedRecords(model, alphabet, batch, layer, device, lmCache, args.ESMModel)
+        for (row, name, sequence), embedding in zip(batch, embeddings):
+            offset = index[row][3]
+            residues[offset:offset + len(sequence)] = embedding
+            means[row] = embedding.mean(axis=0)
+        print(f'Embedded {len(batch)} sequences: {", ".join(record[1] for record in batch)}', flush=True)
+
+    if lmCache:
+        print(f'Language model cache: {lmCache.hits} hits, {lmCache.misses} misses', flush=True)
+        lmCache.evict()
+    residues.flush()
+    means.flush()
+    writeIndex(index, args.outputPrefix + INDEX_SUFFIX)
+    with open(args.outputPrefix + INFO_SUFFIX, 'w') as f:
+        json.dump({'model': args.ESMModel, 'layer': layer, 'dim': dim, 'dtype': args.dtype}, f, indent=2)
+
+
+if __name__ == "__main__":
+    '''Use: python <scriptName> -if <fastaFile> -o <outputPrefix> [-m <esm2 model>] [-l <layer>]
+    The model is loaded once and the input sequences are embedded in length-sorted batches. The per residue
+    embeddings of all the sequences are concatenated in <outputPrefix>_residues.npy and their mean in
+    <outputPrefix>_mean.npy, indexed by <outputPrefix>_index.tsv, so a single sequence can be read by memory-mapping
+    the arrays.
+    '''
+    run(parseArgs())
@@ -25,40 +25,918 @@
 # *
 # **************************************************************************
 
-import os, argparse
+import time
+_importStart = time.time()
+
+import os, sys, json, math, argparse, traceback, resource, itertools, importlib.util
+from contextlib import contextmanager
+import numpy as np
 import torch, esm
 
-if __name__ == "__main__":
-    '''Use: python <scriptName> -i/--inputFilename <sysFile> -o/--outputName <outputName> 
-    -t/--inputTraj [<trjFile>]
-    If only an MD system file is provided, then the script will convert the system to the required format,
-    based on outputName.
-    If a trajectory file is provided too, then the script will convert the trajectory to the required format,
-    based on outputName, using the system file to load it.
-    '''
-    parser = argparse.ArgumentParser(description='Handles the IO for molecule files using openbabel')
+from structureIO import toNumpy, getStructureArrays, writeMmCIF, stitchWindows, getSuperposition, getCAPositions
+from modelStore import hasModelStore, loadModelStore
+from lmCache import LMCache
+from structureArchive import StructureArchive
+
+# Time spent importing torch and esm, only paid by the first run of a process (not by the jobs of a worker)
+_importTime = time.time() - _importStart
+_runsInProcess = 0
+
+
+class StageTimer:
+    """Accumulates the wall time of the stages of a run"""
+    def __init__(self):
+        self.times = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0) + time.time() - start
+
+
+def getPeakRSS():
+    """Peak resident memory of this process (bytes)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def getPeakDeviceMemory(device):
+    """Peak memory allocated by torch on a cuda device since the last reset (bytes), None on cpu"""
+    return torch.cuda.max_memory_allocated(device) if device.type == 'cuda' else None
+
+
+def iterFasta(fastaFile):
+    """Lazily reads a (multi-)FASTA file ('-' for stdin), yielding its (name, sequence) records one by one,
+    so the whole input never needs to be in memory"""
+    f = sys.stdin if fastaFile == '-' else open(fastaFile)
+    try:
+        name, seqLines = None, []
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, ''.join(seqLines)
+                name, seqLines = line[1:].split()[0], []
+            else:
+                seqLines.append(line)
+        if name is not None:
+            yield name, ''.join(seqLines)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def getModelFactory(modelName):
+    """Returns the function building the model: an esm.pretrained function, or <file.py>:<function> to load a
+    custom model with the ESMFold interface (e.g. a stub model for testing)"""
+    if ':' in modelName:
+        fileName, funcName = modelName.rsplit(':', 1)
+        spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(fileName))[0], fileName)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return getattr(module, funcName)
+    return getattr(esm.pretrained, modelName)
+
+
+def getDevice(deviceName, gpuId=0):
+    """Returns the torch device for cuda, cpu or auto (cuda if available)"""
+    if deviceName == 'auto':
+        deviceName = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.device(f'cuda:{gpuId}' if deviceName == 'cuda' else 'cpu')
+
+
+def setCPUThreads(threads, interopThreads):
+    """Sets the intra-op and inter-op thread pools used on CPU"""
+    if threads > 0:
+        torch.set_num_threads(threads)
+    if interopThreads > 0:
+        try:
+            torch.set_num_interop_threads(interopThreads)
+        except RuntimeError:
+            # The inter-op pool can only be set once per process (e.g. in a persistent worker)
+            pass
+
+
+def setLanguageModelPrecision(model, device, precision):
+    """Sets the precision of the language model trunk (model.esm).
+    none keeps the ESMFold default (fp16) on GPU, and uses fp32 on CPU, where fp16 is not supported.
+    bfloat16 casts the trunk to bf16 and int8 applies dynamic int8 quantization to its linear layers (CPU only)"""
+    if precision == 'int8' and device.type != 'cpu':
+        raise ValueError('Dynamic int8 quantization is only supported on CPU')
+
+    if precision == 'bfloat16':
+        model.esm = model.esm.to(torch.bfloat16)
+    elif device.type == 'cpu':
+        model.esm = model.esm.float()
+        if precision == 'int8':
+            model.esm = torch.quantization.quantize_dynamic(model.esm, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+# Submodules of ESMFold compiled by compileModel: the language model and the folding trunk
+COMPILED_MODULES = ['esm', 'trunk']
+
+
+def compileModel(model):
+    """Compiles the language model and folding trunk of the model with torch.compile, keeping the eager modules to
+    run the parity check. Each new input shape is compiled on its first batch, so it pays off on large sets"""
+    if not hasattr(torch, 'compile'):
+        print('torch.compile is not available in this torch version, running in eager mode', flush=True)
+        return model
+    eagerModules = {}
+    for name in COMPILED_MODULES:
+        module = getattr(model, name, None)
+        if isinstance(module, torch.nn.Module):
+            eagerModules[name] = module
+            setattr(model, name, torch.compile(module, dynamic=True))
+    model._eagerModules = eagerModules
+    return model
+
+
+@contextmanager
+def eagerModel(model):
+    """Runs a compiled model with its eager modules"""
+    eagerModules = getattr(model, '_eagerModules', {})
+    compiledModules = {name: getattr(model, name) for name in eagerModules}
+    for name, module in eagerModules.items():
+        setattr(model, name, module)
+    try:
+        yield model
+    finally:
+        for name, module in compiledModules.items():
+            setattr(model, name, module)
+
+
+# Models already loaded in this process, so a persistent worker only pays the loading cost once
+_loadedModels = {}
+
+def loadModel(modelName, device, chunkSize, precision='none', timer=None, storeDir=None, compiled=False):
+    """Loads the ESMFold model once, so it can be reused for every sequence (and every job, in a worker).
+    If the model is in the local store, its weights are memory-mapped instead of loaded through the torch hub"""
+    timer = timer or StageTimer()
+    key = (modelName, str(device), precision, compiled)
+    if key not in _loadedModels:
+        with timer.stage('modelLoad'):
+            if hasModelStore(storeDir, modelName):
+                print(f'Loading {modelName} from the model store {storeDir}', flush=True)
+                model = loadModelStore(storeDir, modelName)
+            else:
+                model = getModelFactory(modelName)()
+        with timer.stage('toDevice'):
+            model = model.to(device)
+            model = setLanguageModelPrecision(model, device, precision)
+            model.eval()
+            if compiled:
+                model = compileModel(model)
+        _loadedModels[key] = model
+
+    model = _loadedModels[key]
+    model.set_chunk_size(chunkSize)
+    return model
+
+
+def getLanguageModelName(model):
+    """Returns the esm.pretrained name of the ESM-2 model ESMFold runs as its first stage, None for custom models.
+    Custom models may give theirs as a <file.py>:<function> esm_type, the name it is loaded with by the other scripts"""
+    esmType = getattr(getattr(model, 'cfg', None), 'esm_type', None)
+    if esmType is None:
+        return None
+    if ':' in esmType:
+        return esmType
+    from esm.esmfold.v1.esmfold import esm_registry
+    return esm_registry[esmType].__name__ if esmType in esm_registry else None
+
+
+def getLMNumerics(languageModel, device, precision='none', autocast='none'):
+    """Returns a description of the numerics a language model runs with: the dtype of its parameters, the device type,
+    and its quantization and autocast dtype if any (e.g. float16-cuda for the ESMFold default on GPU)"""
+    dtype = str(next(languageModel.parameters()).dtype).replace('torch.', '')
+    numerics = [dtype, device.type]
+    if precision == 'int8':
+        numerics.append('int8')
+    if autocast != 'none':
+        numerics.append(f'autocast-{autocast}')
+    return '-'.join(numerics)
+
+
+def getLMCache(cacheDir, maxSizeGB, numerics):
+    """Returns the language model cache, whose version key includes the esm version and the numerics of the language
+    model (see getLMNumerics), so representations computed with different dtypes or devices are never mixed"""
+    return LMCache(cacheDir, maxSizeGB * 1024 ** 3, version=f'{esm.__version__}-{numerics}') if cacheDir else None
+
+
+def getTokenString(tokens, alphabet):
+    """Returns the token sequence used as cache key from the token ids of a sequence, without BOS/EOS/padding"""
+    return ''.join(alphabet.all_toks[t] for t in tokens if t not in
+                   (alphabet.padding_idx, alphabet.cls_idx, alphabet.eos_idx))
+
+
+def setLanguageModelCache(model, cache):
+    """Makes the language model stage of ESMFold read the representations of the sequences from the cache, and store
+    the ones it computes. If every sequence of a batch is cached, the ESM-2 trunk is not run at all.
+    Passing no cache restores the original stage (models are reused among the jobs of a worker)"""
+    model.__dict__.pop('_compute_language_model_representations', None)
+    lmName = getLanguageModelName(model)
+    if cache is None or lmName is None:
+        return model
+
+    compute = type(model)._compute_language_model_representations.__get__(model)
+    alphabet = model.esm_dict
+
+    def computeCached(esmaa):
+        tokens = [getTokenString(row, alphabet) for row in esmaa.tolist()]
+        lengths = [int(n) for n in (esmaa != alphabet.padding_idx).sum(1).tolist()]
+        keys = [cache.getKey(tokenString, lmName) for tokenString in tokens]
+        cached = [cache.get(key) for key in keys]
+        if all(representations is not None for representations in cached):
+            esm_s = torch.zeros((esmaa.shape[0], esmaa.shape[1]) + cached[0].shape[1:], device=esmaa.device)
+            for i, representations in enumerate(cached):
+                esm_s[i, :lengths[i]] = torch.from_numpy(representations)
+            return esm_s
+
+        esm_s = compute(esmaa)
+        for i, (key, representations) in enumerate(zip(keys, cached)):
+            if representations is None:
+                cache.put(key, esm_s[i, :lengths[i]].float().cpu().numpy())
+        return esm_s
+
+    model._compute_language_model_representations = computeCached
+    return model
+
+
+class RecycleMonitor:
+    """Runs the recycles of the ESMFold folding trunk, stopping early once the structure converges: when the CA RMSD
+    or the mean pLDDT change between consecutive recycles falls below its tolerance for every sequence of the batch,
+    capped at the requested number of recycles. As the recycles are run for the whole batch, sequences are folded
+    one at a time with adaptive recycling, so each one stops at its own convergence (see run).
+    Optionally keeps the structure of every recycle"""
+    def __init__(self, model, rmsdTolerance=0.0, plddtTolerance=0.0, keepRecycles=False):
+        self.model, self.keepRecycles = model, keepRecycles
+        self.rmsdTolerance, self.plddtTolerance = rmsdTolerance, plddtTolerance
+        self.recycles, self.recycleOutputs = None, []
+
+    def getPlddt(self, structure, B, L):
+        from esm.esmfold.v1.categorical_mixture import categorical_lddt
+        model = self.model
+        lddtHead = model.lddt_head(structure['states']).reshape(structure['states'].shape[0], B, L, -1,
+                                                                   model.lddt_bins)
+        return 100 * categorical_lddt(lddtHead[-1], bins=model.lddt_bins)
+
+    def hasConverged(self, previous, current, mask):
+        """Whether every sequence of the batch converged between two recycles, given their CA positions and pLDDT"""
+        mask = mask.float()
+        nResidues = mask.sum(-1).clamp(min=1)
+        converged = torch.zeros(mask.shape[0], dtype=torch.bool, device=mask.device)
+        if self.rmsdTolerance > 0:
+            sqDist = ((current['ca'] - previous['ca']) ** 2).sum(-1)
+            rmsd = torch.sqrt((sqDist * mask).sum(-1) / nResidues)
+            converged |= rmsd < self.rmsdTolerance
+        if self.plddtTolerance > 0:
+            plddtChange = ((current['plddt'] - previous['plddt']).abs().mean(-1) * mask).sum(-1) / nResidues
+            converged |= plddtChange < self.plddtTolerance
+        return bool(converged.all())
+
+    def forward(self, seq_feats, pair_feats, true_aa, residx, mask, no_recycles=None):
+        """Same computation as FoldingTrunk.forward, checking the convergence after each recycle"""
+        # The eager module of a compiled trunk
+        trunk = getattr(self.model.trunk, '_orig_mod', self.model.trunk)
+        # As FoldingTrunk: max_recycles passes by default, or no_recycles + 1 (the first pass is not a recycle)
+        noPasses = trunk.cfg.max_recycles if no_recycles is None else no_recycles + 1
+        B, L = seq_feats.shape[:2]
+
+        def trunkIter(s, z):
+            z = z + trunk.pairwise_positional_embedding(residx, mask=mask)
+            for block in trunk.blocks:
+                s, z = block(s, z, mask=mask, residue_index=residx, chunk_size=trunk.chunk_size)
+            return s, z
+
+        recycle_s, recycle_z = torch.zeros_like(seq_feats), torch.zeros_like(pair_feats)
+        recycle_bins = torch.zeros(*pair_feats.shape[:-1], device=seq_feats.device, dtype=torch.int64)
+        self.recycleOutputs, previous = [], None
+        for recycleIdx in range(noPasses):
+            recycle_s = trunk.recycle_s_norm(recycle_s.detach())
+            recycle_z = trunk.recycle_z_norm(recycle_z.detach())
+            recycle_z += trunk.recycle_disto(recycle_bins.detach())
+            s_s, s_z = trunkIter(seq_feats + recycle_s, pair_feats + recycle_z)
+            structure = trunk.structure_module({'single': trunk.trunk2sm_s(s_s), 'pair': trunk.trunk2sm_z(s_z)},
+                                               true_aa, mask.float())
+            recycle_s, recycle_z = s_s, s_z
+            recycle_bins = type(trunk).distogram(structure['positions'][-1][:, :, :3], 3.375, 21.375,
+                                                 trunk.recycle_bins)
+
+            current = {'ca': structure['positions'][-1][:, :, 1]}
+            if self.plddtTolerance > 0 or self.keepRecycles:
+                current['plddt'] = self.getPlddt(structure, B, L)
+            if self.keepRecycles:
+                self.recycleOutputs.append({'positions': structure['positions'][-1:].cpu(),
+                                            'plddt': current['plddt'].cpu()})
+            if previous is not None and self.hasConverged(previous, current, mask):
+                break
+            previous = current
+
+        self.recycles = recycleIdx
+        structure['s_s'], structure['s_z'] = s_s, s_z
+        return structure
+
+
+def setRecycleMonitor(model, monitor):
+    """Makes the folding trunk run its recycles through the monitor. A compiled trunk is replaced by its eager module
+    while the monitor is installed, as the monitor runs the trunk layers itself. Passing no monitor restores the trunk
+    and its fixed number of recycles (models are reused among the jobs of a worker). Returns the installed monitor"""
+    trunk = getattr(model, 'trunk', None)
+    if trunk is None:
+        if monitor is not None:
+            print('The model has no folding trunk, adaptive recycling is disabled', flush=True)
+        return None
+    replacedModules = getattr(model, '_replacedModules', {})
+    if 'trunk' in replacedModules:
+        del trunk.forward
+        model.trunk = replacedModules.pop('trunk')
+    if monitor is not None:
+        replacedModules['trunk'] = model.trunk
+        model._replacedModules = replacedModules
+        model.trunk = getattr(model.trunk, '_orig_mod', model.trunk)
+        model.trunk.forward = monitor.forward
+    return monitor
+
+
+# Linker joining the chains of a complex (sequences with chains separated by ':'), as in ESMFold.infer
+CHAIN_LINKER_LENGTH = 25
+
+
+def getFoldLength(sequence):
+    """Number of residues ESMFold folds for a sequence, including the linkers between the chains of a complex"""
+    chains = sequence.split(':')
+    return sum(len(chain) for chain in chains) + CHAIN_LINKER_LENGTH * (len(chains) - 1)
+
+
+def makeBatches(records, residueBudget, sortWindow=0):
+    """Sorts the records by length and groups them in batches that fit the residue budget.
+    As the trunk memory grows quadratically with the (padded) length, a batch of n sequences with maximum
+    length L is accepted while n * L^2 <= residueBudget^2. Sequences longer than the budget get their own batch.
+    A budget <= 0 disables batching.
+    Records are consumed lazily, sorting windows of sortWindow records at a time (all of them if <= 0)"""
+    records = iter(records)
+    while True:
+        window = list(itertools.islice(records, sortWindow)) if sortWindow > 0 else list(records)
+        if not window:
+            return
+
+        batch = []
+        for record in sorted(window, key=lambda r: getFoldLength(r[1])):
+            length = getFoldLength(record[1])
+            if batch and (residueBudget <= 0 or (len(batch) + 1) * length ** 2 > residueBudget ** 2):
+                yield batch
+                batch = []
+            batch.append(record)
+        if batch:
+            yield batch
+        if sortWindow <= 0:
+            return
+
+
+def isOutOfMemory(error):
+    return isinstance(error, RuntimeError) and 'out of memory' in str(error).lower()
+
+
+def clearDeviceCache():
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+# Chunk sizes tried by the automatic memory planner, from fastest (no chunking) to lowest memory
+AUTO_CHUNK_SIZES = [None, 512, 256, 128, 64, 32, 16, 8, 4]
+# Fraction of the available memory the planner is allowed to use
+MEMORY_SAFETY_FACTOR = 0.8
+
+
+def getModelDevice(model):
+    return next(model.parameters()).device
+
+
+def getAvailableMemory(device):
+    """Returns the free memory (bytes) of a cuda device, or the available host memory for cpu"""
+    if device.type == 'cuda':
+        return torch.cuda.mem_get_info(device)[0]
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def estimateInferenceMemory(nSequences, length, chunkSize):
+    """Rough estimate of the peak activation memory (bytes) of folding a batch, on top of the model weights.
+    The folding trunk keeps several pair representations (L^2 x 128 channels) alive, and the triangular attention
+    builds L^3 x heads logits, reduced to chunkSize x L^2 x heads when chunked. The language model stores the
+    representations of its 37 layers (L x 2560)"""
+    pairMemory = 12 * length ** 2 * 128 * 4
+    attentionRows = length if chunkSize is None else min(chunkSize, length)
+    attentionMemory = 2 * attentionRows * length ** 2 * 4 * 4
+    lmMemory = 37 * length * 2560 * 4
+    return nSequences * (pairMemory + attentionMemory + lmMemory)
+
+
+def planChunkSize(device, nSequences, length):
+    """Returns the memory plan of a batch: the largest chunk size (None meaning no chunking) whose estimated memory
+    fits in the available memory, or the smallest one if none fits"""
+    available = getAvailableMemory(device)
+    for chunkSize in AUTO_CHUNK_SIZES:
+        estimate = estimateInferenceMemory(nSequences, length, chunkSize)
+        if estimate <= MEMORY_SAFETY_FACTOR * available:
+            break
+    return {'chunkSize': chunkSize, 'nSequences': nSequences, 'maxLength': length, 'device': str(device),
+            'availableMemory': available, 'estimatedMemory': estimate}
+
+
+def getSmallerChunkSize(chunkSize):
+    """Returns the next chunk size to try after running out of memory, None if already at the smallest"""
+    index = AUTO_CHUNK_SIZES.index(chunkSize) if chunkSize in AUTO_CHUNK_SIZES else len(AUTO_CHUNK_SIZES) - 1
+    return AUTO_CHUNK_SIZES[index + 1] if index + 1 < len(AUTO_CHUNK_SIZES) else None
+
+
+@contextmanager
+def inferenceContext(device, autocast='none', inferenceMode=False):
+    """Context of a forward pass: torch.no_grad, or torch.inference_mode if inferenceMode, with the operations autocast
+    to float16 or bfloat16 if autocast is not none"""
+    with torch.inference_mode() if inferenceMode else torch.no_grad():
+        if autocast == 'none':
+            yield
+        else:
+            with torch.autocast(device.type, dtype=getattr(torch, autocast)):
+                yield
+
+
+def predictBatch(model, sequences, nRecycles, toPDB=True, autocast='none', inferenceMode=False):
+    """Predicts the structures of a batch of sequences in a single forward pass.
+    Returns the model output and, if toPDB, the predictions as PDB strings"""
+    with inferenceContext(getModelDevice(model), autocast, inferenceMode):
+        output = model.infer(sequences, num_recycles=nRecycles)
+    return output, model.output_to_pdb(output) if toPDB else [None] * len(sequences)
+
+
+def checkParity(model, args):
+    """Folds the parity reference sequence in the default mode (eager, no autocast) and in the mode of the run,
+    and compares their CA coordinates after superposition and their pLDDT. The reference keeps the language model in
+    its loaded precision (see setLanguageModelPrecision: fp16 on GPU as in ESMFold, fp32 on CPU), recorded in the
+    comparison, and the folding trunk in fp32. Warns if the CA RMSD or the maximum residue pLDDT difference are above
+    their tolerances. Returns the comparison"""
+    reference = f'{getLMNumerics(model.esm, getModelDevice(model), args.lmPrecision)} language model, eager'
+    with eagerModel(model):
+        referenceOutput, _ = predictBatch(model, [args.paritySequence], args.numberRecycles, toPDB=False)
+    output, _ = predictBatch(model, [args.paritySequence], args.numberRecycles, toPDB=False, autocast=args.autocast,
+                             inferenceMode=args.inferenceMode)
+    referenceArrays, arrays = getStructureArrays(referenceOutput, 0), getStructureArrays(output, 0)
+
+    residues = np.arange(len(referenceArrays['residueId']))
+    referenceCA, ca = getCAPositions(referenceArrays, residues), getCAPositions(arrays, residues)
+    rotation, translation = getSuperposition(ca, referenceCA)
+    rmsd = float(np.sqrt((((ca @ rotation.T + translation) - referenceCA) ** 2).sum(-1).mean()))
+    plddtDifference = float(np.abs(arrays['residuePlddt'] - referenceArrays['residuePlddt']).max())
+    parity = {'reference': reference, 'rmsd': rmsd, 'maxPlddtDifference': plddtDifference,
+              'rmsdTolerance': args.parityTolerance, 'plddtTolerance': args.parityPlddtTolerance,
+              'passed': rmsd <= args.parityTolerance and plddtDifference <= args.parityPlddtTolerance}
+    print(f'Parity check against the default mode ({reference}): CA RMSD {rmsd:.3f} A, '
+          f'max pLDDT difference {plddtDifference:.2f}', flush=True)
+    if not parity['passed']:
+        print(f'WARNING: the predictions of this run (autocast {args.autocast}, compiled {args.compile}) differ from '
+              f'the default mode ones beyond the tolerance (CA RMSD {args.parityTolerance} A, pLDDT '
+              f'{args.parityPlddtTolerance})', flush=True)
+    return parity
+
+
+def writePlddt(arrays, outFile, **scores):
+    """Writes the pLDDT of a prediction as a compressed NumPy file, with the atoms in the same order as in the
+    structure file:
+        residuePlddt, residueId, residueChain: per residue mean pLDDT, residue number and chain id
+        atomPlddt, atomResidue, atomType: per atom pLDDT, index of its residue and atom37 index of its name
+    plus the given per prediction scores (e.g. recycles, meanPlddt, ptm), so the confidence of a prediction can be
+    read without parsing its structure"""
+    np.savez_compressed(outFile, **{key: arrays[key] for key in ['residuePlddt', 'residueId', 'residueChain',
+                                                                 'atomPlddt', 'atomResidue', 'atomType']},
+                        **{key: np.array(np.nan if value is None else value) for key, value in scores.items()})
+
+
+def getPAE(output, i):
+    """Returns the predicted aligned error matrix of the residues of a prediction, without the linkers of complexes"""
+    residues = toNumpy(output['atom37_atom_exists'][i]).any(-1)
+    return toNumpy(output['predicted_aligned_error'][i])[np.ix_(residues, residues)]
+
+
+def writePAE(output, i, arrays, outFile):
+    """Writes the predicted aligned error matrix of the residues of a prediction (without the linkers of complexes)
+    as a compressed float16 NumPy file, with their residue numbers and chain ids"""
+    pae = getPAE(output, i)
+    np.savez_compressed(outFile, pae=pae.astype(np.float16), residueId=arrays['residueId'],
+                        residueChain=arrays['residueChain'],
+                        maxPae=np.array(float(np.max(toNumpy(output.get('max_predicted_aligned_error', pae))))))
+
+
+def getPredictionScores(output, i):
+    """Returns the mean pLDDT and pTM of the i-th prediction of a batch output"""
+    return {'meanPlddt': float(toNumpy(output['mean_plddt'][i])),
+            'ptm': float(toNumpy(output['ptm'][i])) if 'ptm' in output else None}
+
+
+def writePrediction(output, i, pdb, outPrefix, args, recycles=None):
+    """Writes the i-th prediction of a batch output as PDB (the one written by ESMFold) or directly as mmCIF with
+    the pLDDT Scipion attribute, plus its pLDDT arrays, or appends it to the structure archive of the run.
+    Complexes are always written as mmCIF: ESMFold numbers the residues of their PDB by the folding residue index,
+    offset between chains, while the arrays (and the pLDDT specifiers) number each chain from 1.
+    If the structures of the recycles were kept, each one is written as <outPrefix>_recycle<n>.cif"""
+    name = os.path.basename(outPrefix)
+    arrays = getStructureArrays(output, i)
+    isComplex = len(np.unique(arrays['residueChain'])) > 1
+    if args.archive is not None:
+        pae = getPAE(output, i) if 'predicted_aligned_error' in output else None
+        args.archive.write(name, arrays, pae=pae, recycles=recycles, **getPredictionScores(output, i))
+    elif args.outputFormat == 'cif' or isComplex:
+        writeMmCIF(getOutputFile(args, name, isComplex), name, arrays)
+    else:
+        with open(getOutputFile(args, name), "w") as f:
+            f.write(pdb)
+    if args.archive is None:
+        writePlddt(arrays, outPrefix + '_plddt.npz', recycles=recycles, **getPredictionScores(output, i))
+    if 'predicted_aligned_error' in output and args.archive is None:
+        writePAE(output, i, arrays, outPrefix + '_pae.npz')
+
+    if args.recycleMonitor and args.saveRecycles:
+        for recycleIdx, recycleOutput in enumerate(args.recycleMonitor.recycleOutputs):
+            recycleArrays = getStructureArrays({**output, **recycleOutput}, i)
+            writeMmCIF(f'{outPrefix}_recycle{recycleIdx}.cif', f'{name}_recycle{recycleIdx}', recycleArrays)
+
+
+def foldBatch(model, batch, args, chunkSize='auto'):
+    """Folds a batch of (name, sequence) records, writing a structure file and a pLDDT file per record.
+    With automatic chunk size, the chunk size is planned from the batch size and length, and lowered on OOM.
+    If the batch runs out of memory, it is split in half and each half retried. If it fails for any other reason,
+    its sequences are retried one by one, so a single failing sequence does not take down the rest. Sequences whose
+    prediction cannot be written are logged as failed too."""
+    autoChunk = args.chunkSize == 'auto'
+    if autoChunk:
+        if chunkSize == 'auto':
+            plan = planChunkSize(getModelDevice(model), len(batch), max(getFoldLength(seq) for _, seq in batch))
+            print(f'Memory plan: {json.dumps(plan)}', flush=True)
+            chunkSize = plan['chunkSize']
+        model.set_chunk_size(chunkSize)
+    else:
+        chunkSize = args.chunkSize
+
+    device = getModelDevice(model)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    failed, outOfMemory = False, False
+    # A single sequence running out of memory with automatic chunk size is retried with the next smaller one
+    canLowerChunkSize = autoChunk and len(batch) == 1 and chunkSize != AUTO_CHUNK_SIZES[-1]
+    try:
+        startTime = time.time()
+        with args.timer.stage('inference'):
+            output, pdbs = predictBatch(model, [seq for _, seq in batch], args.numberRecycles,
+                                        toPDB=args.outputFormat == 'pdb', autocast=args.autocast,
+                                        inferenceMode=args.inferenceMode)
+        inferenceTime = time.time() - startTime
+    except Exception as e:
+        failed, outOfMemory = True, isOutOfMemory(e)
+        if len(batch) == 1 and not (outOfMemory and canLowerChunkSize):
+            logFailure(args, *batch[0], e)
+
+    if failed:
+        # Out of the handler, whose exception traceback keeps the frames of the failed forward pass (and so their
+        # activations) alive, the device memory can be released before retrying
+        clearDeviceCache()
+        if outOfMemory and canLowerChunkSize:
+            smallerChunkSize = getSmallerChunkSize(chunkSize)
+            print(f'Out of memory with chunk size {chunkSize}, retrying with {smallerChunkSize}', flush=True)
+            foldBatch(model, batch, args, smallerChunkSize)
+        elif len(batch) > 1 and outOfMemory:
+            half = len(batch) // 2
+            print(f'Out of memory folding a batch of {len(batch)} sequences, splitting it in two', flush=True)
+            foldBatch(model, batch[:half], args)
+            foldBatch(model, batch[half:], args)
+        elif len(batch) > 1:
+            for record in batch:
+                foldBatch(model, [record], args)
+        return
+
+    batchResidues = sum(getFoldLength(seq) for _, seq in batch)
+    peakDeviceMemory = getPeakDeviceMemory(device)
+    if peakDeviceMemory is not None:
+        args.peakDeviceMemory = max(args.peakDeviceMemory or 0, peakDeviceMemory)
+    recycles = args.recycleMonitor.recycles if args.recycleMonitor else args.numberRecycles
+    for i, ((name, sequence), pdb) in enumerate(zip(batch, pdbs)):
+        startTime = time.time()
+        try:
+            with args.timer.stage('write'):
+                writePrediction(output, i, pdb, os.path.join(args.outputDir, name), args, recycles)
+        except Exception as e:
+            # Only this sequence fails, without the partial files that would make --resume skip it
+            removePredictionFiles(args, name)
+            logFailure(args, name, sequence, e)
+            continue
+        # The batch inference time is shared among its sequences by length
+        writeLogEntry(args.logFile, {'name': name, 'length': len(sequence), 'status': 'done', 'chunkSize': chunkSize,
+                                     'batchSize': len(batch), 'recycles': recycles,
+                                     'inferenceTime': inferenceTime * getFoldLength(sequence) / batchResidues,
+                                     'writeTime': time.time() - startTime,
+                                     'peakDeviceMemory': peakDeviceMemory})
+        print(f'{name}: done', flush=True)
+
+
+def logFailure(args, name, sequence, error):
+    """Records the failure of a sequence in the log file, so the run goes on with the rest"""
+    traceback.print_exc()
+    writeLogEntry(args.logFile, {'name': name, 'length': len(sequence), 'status': 'failed', 'error': str(error)})
+    print(f'{name}: failed', flush=True)
+
+
+def removePredictionFiles(args, name):
+    """Removes the files written for a prediction (not its entry in a structure archive)"""
+    outPrefix = os.path.join(args.outputDir, name)
+    for outFile in [getOutputFile(args, name), getOutputFile(args, name, isComplex=True), outPrefix + '.cif',
+                    outPrefix + '_plddt.npz', outPrefix + '_pae.npz']:
+        if os.path.exists(outFile):
+            os.remove(outFile)
+
+
+def getWindows(length, windowLength, overlap):
+    """Returns the (start, end) of the overlapping windows covering a sequence, all of windowLength residues.
+    The fewest windows overlapping at least overlap residues are used, evenly spread along the sequence"""
+    if length <= windowLength:
+        return [(0, length)]
+    nWindows = math.ceil((length - overlap) / max(1, windowLength - overlap))
+    starts = [round(k * (length - windowLength) / (nWindows - 1)) for k in range(nWindows)]
+    return [(start, start + windowLength) for start in starts]
+
+
+def splitLongRecords(records, windowLength, longRecords):
+    """Yields the records that can be folded at once, appending the single chain sequences longer than windowLength
+    to longRecords, to be folded as windows"""
+    for name, sequence in records:
+        if 0 < windowLength < len(sequence) and ':' not in sequence:
+            longRecords.append((name, sequence))
+        else:
+            yield name, sequence
+
+
+def foldWindows(model, name, sequence, args):
+    """Folds a sequence longer than the window length as overlapping windows, one at a time, stitched by superposing
+    the CA atoms of their overlaps. The stitched prediction is always written as mmCIF"""
+    windows = getWindows(len(sequence), args.windowLength, args.windowOverlap)
+    print(f'{name}: folding {len(sequence)} residues as {len(windows)} windows', flush=True)
+    startTime, windowArrays, recycles, failed = time.time(), [], [], False
+    try:
+        for start, end in windows:
+            if args.chunkSize == 'auto':
+                model.set_chunk_size(planChunkSize(getModelDevice(model), 1, end - start)['chunkSize'])
+            with args.timer.stage('inference'):
+                output, _ = predictBatch(model, [sequence[start:end]], args.numberRecycles, toPDB=False,
+                                         autocast=args.autocast, inferenceMode=args.inferenceMode)
+            arrays = getStructureArrays(output, 0)
+            arrays['residueId'] += start
+            windowArrays.append(arrays)
+            recycles.append(args.recycleMonitor.recycles if args.recycleMonitor else args.numberRecycles)
+    except Exception as e:
+        logFailure(args, name, sequence, e)
+        failed = True
+    if failed:
+        clearDeviceCache()
+        return
+
+    inferenceTime = time.time() - startTime
+    startTime = time.time()
+    try:
+        with args.timer.stage('write'):
+            arrays = stitchWindows(windowArrays)
+            # The pTM and PAE of the windows are not comparable with those of a whole prediction and are not written
+            scores = {'recycles': max(recycles), 'meanPlddt': float(arrays['atomPlddt'].mean()), 'ptm': None}
+            if args.archive is not None:
+                args.archive.write(name, arrays, **scores)
+            else:
+                writeMmCIF(os.path.join(args.outputDir, name) + '.cif', name, arrays)
+                writePlddt(arrays, os.path.join(args.outputDir, name) + '_plddt.npz', **scores)
+    except Exception as e:
+        removePredictionFiles(args, name)
+        logFailure(args, name, sequence, e)
+        return
+    writeLogEntry(args.logFile, {'name': name, 'length': len(sequence), 'status': 'done', 'windows': len(windows),
+                                 'recycles': max(recycles), 'inferenceTime': inferenceTime,
+                                 'writeTime': time.time() - startTime})
+    print(f'{name}: done', flush=True)
+
+
+def writeLogEntry(logFile, entry):
+    """Appends the result of a prediction to the JSON lines log file"""
+    with open(logFile, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+
+def getOutputFile(args, name, isComplex=False):
+    """Structure file of a prediction. Complexes are written as mmCIF with any format (see writePrediction)"""
+    ext = '.pdb' if args.outputFormat == 'pdb' and not isComplex else '.cif'
+    return os.path.join(args.outputDir, name) + ext
+
+
+def readLoggedNames(logFile):
+    """Returns the names of the records already logged as done"""
+    names = set()
+    if os.path.exists(logFile):
+        with open(logFile) as f:
+            for line in f:
+                entry = json.loads(line) if line.strip() else {}
+                if entry.get('status') == 'done':
+                    names.add(entry['name'])
+    return names
+
+
+def getRecords(args):
+    """Yields the input records. When resuming, records whose outputs already exist are skipped"""
+    records = iterFasta(args.inputFasta) if args.inputFasta else [(args.outputName, args.inputSequence)]
+    loggedNames = readLoggedNames(args.logFile) if args.resume else set()
+    for name, sequence in records:
+        outputs = [getOutputFile(args, name, ':' in sequence), os.path.join(args.outputDir, name) + '.cif']
+        isPredicted = name in args.archive if args.archive is not None else \
+            any(map(os.path.exists, outputs)) and os.path.exists(os.path.join(args.outputDir, name) + '_plddt.npz')
+        if args.resume and isPredicted:
+            if name not in loggedNames:
+                writeLogEntry(args.logFile, {'name': name, 'length': len(sequence), 'status': 'done', 'resumed': True})
+            print(f'{name}: already predicted, skipping', flush=True)
+            continue
+        yield name, sequence
+
+
+# Reference sequence of the parity check: human ubiquitin
+PARITY_SEQUENCE = 'MQIFVKTLTGKTITLEVEPSDTIENVKAKIQDKEGIPPDQQRLIFAGKQLEDGRTLSDYNIQKESTLHLVLRLRGG'
+
+
+def chunkSizeArg(value):
+    return value if value == 'auto' else int(value)
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Predicts the structure of one or several protein sequences '
+                                                 'using ESMFold')
     parser.add_argument('-i', '--inputSequence', type=str, help='Input sequence')
-    parser.add_argument('-o', '--outputName', type=str, help='Output name')
+    parser.add_argument('-if', '--inputFasta', type=str,
+                        help='Input (multi-)FASTA file with the sequences to predict, - to read it from stdin. '
+                             'Records are read lazily and their outputs written as soon as each batch finishes')
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help='Skip the records whose outputs already exist (e.g. to restart a crashed run)')
+    parser.add_argument('-sw', '--sortWindow', type=int, default=1000,
+                        help='Number of records read at a time to sort by length and batch. '
+                             'Bounds the memory used by large inputs. 0 to read all of them at once')
+    parser.add_argument('-o', '--outputName', type=str, help='Output name (only used with a single input sequence)')
     parser.add_argument('-od', '--outputDir', type=str, help='Output directory')
-    parser.add_argument('-m', '--ESMModel', type=str, default='esmfold_v1', help='ESMFold model to use')
+    parser.add_argument('-log', '--logFile', type=str, default=None,
+                        help='JSON lines file where the status of each prediction is recorded. '
+                             'Defaults to <outputDir>/predictions.jsonl')
+    parser.add_argument('-f', '--outputFormat', type=str, default='pdb', choices=['pdb', 'cif', 'archive'],
+                        help='Format of the predicted structures: pdb as written by ESMFold (complexes are written '
+                             'as mmCIF, numbering each chain from 1), mmCIF written directly from the atom arrays, '
+                             'including the pLDDT as a Scipion attribute, or archive: all the '
+                             'predictions appended to a compressed structure archive (see structureArchive.py), '
+                             'with their pLDDT, PAE and scores')
+    parser.add_argument('-an', '--archiveName', type=str, default='predictions',
+                        help='Name of the structure archive in the output directory, with -f archive')
+    parser.add_argument('-st', '--statsFile', type=str, default=None,
+                        help='JSON file where the time of each stage (import, model load, to device, inference, '
+                             'write), the peak host and device memory and the language model cache hits of the run '
+                             'are written')
+    parser.add_argument('-m', '--ESMModel', type=str, default='esmfold_v1',
+                        help='ESMFold model to use: an esm.pretrained model name or <file.py>:<function> to load a '
+                             'custom model')
 
-    parser.add_argument('-nr', '--numberRecycles', type=int, default=4, help='Number of recycles')
-    parser.add_argument('-cs', '--chunkSize', type=int, default=128, help='Chunk size to use the model')
+    parser.add_argument('-ms', '--modelStore', type=str, default=None,
+                        help='Directory of the local memory-mapped model store (see modelStore.py). The model is '
+                             'loaded through esm.pretrained if it is not in the store')
+
+    parser.add_argument('-nr', '--numberRecycles', type=int, default=4,
+                        help='Number of recycles (maximum number with adaptive recycling)')
+    parser.add_argument('-ar', '--adaptiveRecycles', action='store_true',
+                        help='Stop recycling once the structure converges (see -rt and -pt). Sequences are then '
+                             'folded one at a time (-br is ignored), so each one runs its own number of recycles')
+    parser.add_argument('-rt', '--rmsdTolerance', type=float, default=0.5,
+                        help='Adaptive recycling stops when the CA RMSD between consecutive recycles is below this '
+                             'value (A). 0 to disable this criterion')
+    parser.add_argument('-pt', '--plddtTolerance', type=float, default=0,
+                        help='Adaptive recycling stops when the mean pLDDT change between consecutive recycles is '
+                             'below this value. 0 to disable this criterion')
+    parser.add_argument('-sr', '--saveRecycles', action='store_true',
+                        help='Also write the structure of every recycle as <name>_recycle<n>.cif')
+    parser.add_argument('-cs', '--chunkSize', type=chunkSizeArg, default=128,
+                        help='Chunk size to use the model, or auto to plan it from the sequence lengths and the '
+                             'available memory, lowering it on out of memory errors')
+    parser.add_argument('-br', '--batchResidues', type=int, default=0,
+                        help='Residue budget of each batch of sequences folded together. A batch of n sequences '
+                             'with maximum length L is accepted while n * L^2 <= budget^2. 0 folds one sequence '
+                             'at a time')
+    parser.add_argument('-wl', '--windowLength', type=int, default=0,
+                        help='Fold single chain sequences longer than this as overlapping windows of this length, '
+                             'stitched by superposing their overlaps. 0 to fold every sequence at once')
+    parser.add_argument('-wo', '--windowOverlap', type=int, default=200,
+                        help='Number of residues shared by consecutive windows')
+    parser.add_argument('-d', '--device', type=str, default='cuda', choices=['auto', 'cuda', 'cpu'],
+                        help='Device to run the model on. auto uses cuda if available')
     parser.add_argument('-g', '--gpuId', type=int, default=0, help='GPU index to use')
+    parser.add_argument('-t', '--threads', type=int, default=0, help='Intra-op CPU threads (0: torch default)')
+    parser.add_argument('-it', '--interopThreads', type=int, default=0, help='Inter-op CPU threads (0: torch default)')
+    parser.add_argument('-p', '--lmPrecision', type=str, default='none', choices=['none', 'bfloat16', 'int8'],
+                        help='Precision of the language model trunk: none (ESMFold default), bfloat16 or '
+                             'dynamic int8 quantization (CPU only)')
+    parser.add_argument('-ac', '--autocast', type=str, default='none', choices=['none', 'float16', 'bfloat16'],
+                        help='Run the model with its operations autocast to this precision (torch.autocast), '
+                             'reducing memory and time. bfloat16 is the one supported on most CPUs')
+    parser.add_argument('-im', '--inferenceMode', action='store_true',
+                        help='Run the model under torch.inference_mode instead of torch.no_grad')
+    parser.add_argument('-co', '--compile', action='store_true',
+                        help='Compile the language model and folding trunk with torch.compile')
+    parser.add_argument('-pc', '--parityCheck', action='store_true',
+                        help='Before folding, compare the prediction of the parity sequence in the mode of the run '
+                             '(autocast, compiled) with the default one (eager, no autocast, the language model in '
+                             'its -p precision: fp16 on GPU by default), warning if they differ beyond tolerance')
+    parser.add_argument('-ps', '--paritySequence', type=str, default=PARITY_SEQUENCE,
+                        help='Reference sequence of the parity check (human ubiquitin by default)')
+    parser.add_argument('-pr', '--parityTolerance', type=float, default=0.5,
+                        help='Maximum CA RMSD (A) of the parity check')
+    parser.add_argument('-ppt', '--parityPlddtTolerance', type=float, default=5,
+                        help='Maximum residue pLDDT difference of the parity check')
+    parser.add_argument('-lc', '--lmCache', type=str, default=None,
+                        help='Directory of the language model cache shared with runESMEmbeddings.py. The ESM-2 '
+                             'representations of cached sequences are reused and the computed ones stored')
+    parser.add_argument('-lcs', '--lmCacheSize', type=float, default=50,
+                        help='Maximum size of the language model cache (GB), least recently used entries are evicted')
+    return parser.parse_args(argv)
+
 
-    args = parser.parse_args()
-    sequence, modelName = args.inputSequence, args.ESMModel
-    outFile = os.path.join(args.outputDir, args.outputName) + '.pdb'
+def writeStats(args, device, startTime):
+    """Writes the stage timings and peak memory of the run as JSON"""
+    stats = {'importTime': _importTime if _runsInProcess == 1 else 0, **args.timer.times,
+             'totalTime': time.time() - startTime, 'runsInProcess': _runsInProcess,
+             'peakRSS': getPeakRSS(), 'device': str(device), 'peakDeviceMemory': args.peakDeviceMemory,
+             'parity': args.parity, 'lmCache': args.lmCacheStats}
+    with open(args.statsFile, 'w') as f:
+        json.dump(stats, f, indent=2)
 
-    model = getattr(esm.pretrained, modelName)()
-    model = model.to(torch.device(f'cuda:{args.gpuId}'))
-    model.set_chunk_size(args.chunkSize)
-    model.eval()
 
-    with torch.no_grad():
-      output = model.infer_pdb(sequence, num_recycles=args.numberRecycles)
+def run(args):
+    global _runsInProcess
+    _runsInProcess += 1
+    startTime = time.time()
+    args.timer, args.peakDeviceMemory, args.parity, args.lmCacheStats = StageTimer(), None, None, None
+    args.logFile = args.logFile or os.path.join(args.outputDir, 'predictions.jsonl')
+    args.archive = StructureArchive(os.path.join(args.outputDir, args.archiveName)) \
+        if args.outputFormat == 'archive' else None
+    device = getDevice(args.device, args.gpuId)
+    if device.type == 'cpu':
+        setCPUThreads(args.threads, args.interopThreads)
+    model = loadModel(args.ESMModel, device, None if args.chunkSize == 'auto' else args.chunkSize, args.lmPrecision,
+                      timer=args.timer, storeDir=args.modelStore, compiled=args.compile)
+    if args.parityCheck:
+        # The stages patched by a previous job of a worker are restored, so the parity check runs the plain model
+        setLanguageModelCache(model, None)
+        setRecycleMonitor(model, None)
+        with args.timer.stage('parity'):
+            args.parity = checkParity(model, args)
+    lmCache = getLMCache(args.lmCache, args.lmCacheSize,
+                         getLMNumerics(model.esm, device, args.lmPrecision, args.autocast)) if args.lmCache else None
+    setLanguageModelCache(model, lmCache)
+    monitor = None
+    if args.adaptiveRecycles or args.saveRecycles:
+        monitor = RecycleMonitor(model, args.rmsdTolerance if args.adaptiveRecycles else 0,
+                                 args.plddtTolerance if args.adaptiveRecycles else 0, args.saveRecycles)
+    args.recycleMonitor = setRecycleMonitor(model, monitor)
 
-    with open(outFile, "w") as f:
-      f.write(output)
+    longRecords = []
+    records = splitLongRecords(getRecords(args), args.windowLength, longRecords)
+    # The recycles are run for a whole batch, so with adaptive recycling each sequence is folded alone
+    batchResidues = 0 if args.adaptiveRecycles else args.batchResidues
+    for batch in makeBatches(records, batchResidues, args.sortWindow):
+        foldBatch(model, batch, args)
+    for name, sequence in longRecords:
+        foldWindows(model, name, sequence, args)
 
+    if lmCache:
+        print(f'Language model cache: {lmCache.hits} hits, {lmCache.misses} misses', flush=True)
+        args.lmCacheStats = {'hits': lmCache.hits, 'misses': lmCache.misses}
+        lmCache.evict()
 
+    if args.statsFile:
+        writeStats(args, device, startTime)
+
+
+if __name__ == "__main__":
+    '''Use: python <scriptName> -i/--inputSequence <sequence> -o/--outputName <outputName> -od <outputDir>
+    OR:  python <scriptName> -if/--inputFasta <fastaFile or - for stdin> -od <outputDir> [--resume]
+    The model is loaded once and the input sequences are predicted with it in length-sorted batches.
+    Complexes are given as a single sequence with the chains separated by ':'.
+    Each prediction is stored as <outputDir>/<name>.pdb (or .cif), with its pLDDT in <outputDir>/<name>_plddt.npz,
+    or appended to the archive <outputDir>/<archiveName>.esmz (-f archive), and its status (done/failed) is appended
+    to the log file.
+    '''
+    run(parseArgs())
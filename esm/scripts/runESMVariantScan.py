@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'ddelhoyo@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os, re, argparse
+import numpy as np
+import torch
+
+from runESMFold import iterFasta, getDevice, setCPUThreads, isOutOfMemory, clearDeviceCache
+from runESMEmbeddings import loadLanguageModel
+
+AMINOACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+VARIANTS_SUFFIX, MUTATIONS_SUFFIX = '_variants.npz', '_mutations.tsv'
+# Single mutation: <wild type><position><mutant>, e.g. A23G
+MUTATION_PATTERN = re.compile(r'([A-Z])(-?\d+)([A-Z])')
+
+
+def getLogProbabilities(model, tokens, device):
+    """Returns the log-softmax over the alphabet of the logits of a batch of tokens"""
+    with torch.no_grad():
+        logits = model(tokens.to(device))['logits']
+    return torch.log_softmax(logits.float(), dim=-1).cpu()
+
+
+def wildTypeMarginals(model, alphabet, sequence, device, maskBatch):
+    """Returns the (L x alphabet) log probabilities of each position in a single forward pass of the unmasked
+    wild type sequence"""
+    _, _, tokens = alphabet.get_batch_converter()([('wt', sequence)])
+    return getLogProbabilities(model, tokens, device)[0, 1:len(sequence) + 1]
+
+
+def maskedMarginals(model, alphabet, sequence, device, maskBatch):
+    """Returns the (L x alphabet) log probabilities of each position when it is masked. The L masked copies of the
+    sequence are scored in batches of maskBatch copies, ceil(L / maskBatch) forward passes in total.
+    Batches running out of memory are split in half"""
+    _, _, tokens = alphabet.get_batch_converter()([('wt', sequence)])
+    logProbs = torch.zeros((len(sequence), len(alphabet.all_toks)))
+    positions = list(range(len(sequence)))
+    pending = [positions[i:i + maskBatch] for i in range(0, len(positions), maskBatch)]
+    while pending:
+        batchPositions = pending.pop(0)
+        maskedTokens = tokens.repeat(len(batchPositions), 1)
+        # Position i of the sequence is token i + 1, after BOS
+        maskedTokens[range(len(batchPositions)), [i + 1 for i in batchPositions]] = alphabet.mask_idx
+        try:
+            batchLogProbs = getLogProbabilities(model, maskedTokens, device)
+        except RuntimeError as e:
+            if not isOutOfMemory(e) or len(batchPositions) == 1:
+                raise
+            batchLogProbs = None
+        if batchLogProbs is None:
+            # Cleared out of the handler, whose traceback keeps the activations of the failed forward pass alive
+            clearDeviceCache()
+            half = len(batchPositions) // 2
+            pending = [batchPositions[:half], batchPositions[half:]] + pending
+            continue
+        logProbs[batchPositions] = batchLogProbs[range(len(batchPositions)), [i + 1 for i in batchPositions]]
+    return logProbs
+
+
+SCORINGS = {'wt-marginals': wildTypeMarginals, 'masked-marginals': maskedMarginals}
+
+
+def getScoreMatrix(logProbs, alphabet, sequence):
+    """Returns the (L x 20) matrix of the log probability ratio of each amino acid against the wild type residue
+    at each position. Non standard wild type residues get NaN scores"""
+    aaIdxs = [alphabet.get_idx(aa) for aa in AMINOACIDS]
+    scores = np.full((len(sequence), len(AMINOACIDS)), np.nan, dtype=np.float32)
+    for i, wt in enumerate(sequence):
+        if wt in AMINOACIDS:
+            scores[i] = (logProbs[i, aaIdxs] - logProbs[i, alphabet.get_idx(wt)]).numpy()
+    return scores
+
+
+def getResidueAggregates(scores, sequence):
+    """Returns the mean and minimum score of the 19 substitutions of each position"""
+    substitutions = scores.copy()
+    for i, wt in enumerate(sequence):
+        if wt in AMINOACIDS:
+            substitutions[i, AMINOACIDS.index(wt)] = np.nan
+    with np.errstate(all='ignore'):
+        return np.nanmean(substitutions, axis=1), np.nanmin(substitutions, axis=1)
+
+
+def parseMutation(single, sequence, offset):
+    """Returns the (sequence index, mutant residue) of a single mutation like A23G (position numbered from offset).
+    Raises ValueError if it is malformed or does not match the sequence"""
+    match = MUTATION_PATTERN.fullmatch(single.strip().upper())
+    if match is None:
+        raise ValueError(f'"{single}" is not a mutation like A23G')
+    wt, position, mt = match.group(1), int(match.group(2)) - offset, match.group(3)
+    if not 0 <= position < len(sequence):
+        raise ValueError(f'position {position + offset} is out of the sequence ({offset}-{len(sequence) + offset - 1})')
+    if sequence[position] != wt:
+        raise ValueError(f'the wild type residue at position {position + offset} is {sequence[position]}, not {wt}')
+    if mt not in AMINOACIDS:
+        raise ValueError(f'{mt} is not a standard amino acid')
+    return position, mt
+
+
+def scoreMutations(scores, sequence, mutations, offset):
+    """Returns the (mutation, score) of a list of (line number, mutation), mutations like A23G (position numbered
+    from offset). Multiple mutants like A23G:K45R are scored as the sum of their single mutations. Malformed mutations
+    and those not matching the sequence are skipped with a warning naming their line"""
+    scored = []
+    for lineNumber, mutation in mutations:
+        try:
+            singles = [parseMutation(single, sequence, offset) for single in mutation.split(':')]
+        except ValueError as e:
+            print(f'WARNING: skipping mutation {mutation} (line {lineNumber} of the mutation list): {e}', flush=True)
+            continue
+        scored.append((mutation, sum(float(scores[position, AMINOACIDS.index(mt)]) for position, mt in singles)))
+    return scored
+
+
+def getAllSingles(sequence, offset):
+    """Returns every single mutant of the sequence as (line number, mutation), numbered in scanning order"""
+    singles = [f'{wt}{i + offset}{mt}' for i, wt in enumerate(sequence) if wt in AMINOACIDS
+               for mt in AMINOACIDS if mt != wt]
+    return list(enumerate(singles, 1))
+
+
+def readMutations(mutationsFile):
+    """Returns the (line number, mutation) of the mutations listed in a file, one per line"""
+    with open(mutationsFile) as f:
+        return [(lineNumber, line.split()[0]) for lineNumber, line in enumerate(f, 1)
+                if line.strip() and not line.startswith('#')]
+
+
+def writeVariantScan(outPrefix, sequence, scores, offset, scoring):
+    """Writes the L x 20 score matrix and its per residue aggregates as a compressed NumPy file"""
+    meanScores, minScores = getResidueAggregates(scores, sequence)
+    np.savez_compressed(outPrefix + VARIANTS_SUFFIX, scores=scores, meanScore=meanScores, minScore=minScores,
+                        aminoacids=np.array(list(AMINOACIDS)), wildType=np.array(list(sequence)),
+                        positions=np.arange(len(sequence)) + offset, scoring=np.array(scoring))
+
+
+def writeMutations(outPrefix, scored):
+    with open(outPrefix + MUTATIONS_SUFFIX, 'w') as f:
+        f.write('mutation\tscore\n')
+        for mutation, score in scored:
+            f.write(f'{mutation}\t{score:.4f}\n')
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Scores the effect of mutations of protein sequences with an ESM '
+                                                 'language model (zero-shot log probability ratios)')
+    parser.add_argument('-if', '--inputFasta', type=str, required=True, help='Input (multi-)FASTA file')
+    parser.add_argument('-od', '--outputDir', type=str, required=True,
+                        help=f'Output directory, where <name>{VARIANTS_SUFFIX} (L x 20 score matrix and per residue '
+                             f'aggregates) and <name>{MUTATIONS_SUFFIX} (score of each mutation) are written')
+    parser.add_argument('-m', '--ESMModel', type=str, default='esm2_t33_650M_UR50D',
+                        help='ESM model to use: an esm.pretrained model name (e.g. esm2_* or esm1v_*) or '
+                             '<file.py>:<function>')
+    parser.add_argument('-s', '--scoring', type=str, default='masked-marginals', choices=list(SCORINGS),
+                        help='wt-marginals: one forward pass of the wild type sequence. masked-marginals: each '
+                             'position is masked, in batched forward passes (more accurate)')
+    parser.add_argument('-mf', '--mutationsFile', type=str, default=None,
+                        help='File with a mutation per line (e.g. A23G, or A23G:K45R for multiple mutants). '
+                             'All the single mutants are scored if not given')
+    parser.add_argument('-off', '--offset', type=int, default=1, help='Number of the first residue in the mutations')
+    parser.add_argument('-mb', '--maskBatch', type=int, default=32,
+                        help='Number of masked copies of the sequence scored in each forward pass')
+    parser.add_argument('-d', '--device', type=str, default='cuda', choices=['auto', 'cuda', 'cpu'],
+                        help='Device to run the model on. auto uses cuda if available')
+    parser.add_argument('-g', '--gpuId', type=int, default=0, help='GPU index to use')
+    parser.add_argument('-t', '--threads', type=int, default=0, help='Intra-op CPU threads (0: torch default)')
+    parser.add_argument('-it', '--interopThreads', type=int, default=0, help='Inter-op CPU threads (0: torch default)')
+    return parser.parse_args(argv)
+
+
+def run(args):
+    device = getDevice(args.device, args.gpuId)
+    if device.type == 'cpu':
+        setCPUThreads(args.threads, args.interopThreads)
+    model, alphabet = loadLanguageModel(args.ESMModel, device)
+    mutations = readMutations(args.mutationsFile) if args.mutationsFile else None
+
+    for name, sequence in iterFasta(args.inputFasta):
+        logProbs = SCORINGS[args.scoring](model, alphabet, sequence, device, args.maskBatch)
+        scores = getScoreMatrix(logProbs, alphabet, sequence)
+        outPrefix = os.path.join(args.outputDir, name)
+        writeVariantScan(outPrefix, sequence, scores, args.offset, args.scoring)
+        writeMutations(outPrefix, scoreMutations(scores, sequence, mutations or getAllSingles(sequence, args.offset),
+                                                 args.offset))
+        print(f'{name}: done', flush=True)
+
+
+if __name__ == "__main__":
+    '''Use: python <scriptName> -if <fastaFile> -od <outputDir> [-m <esm model>] [-s wt-marginals|masked-marginals]
+    [-mf <mutationsFile>]
+    For each input sequence, the log probability ratio of every amino acid against the wild type is computed at each
+    position (in one forward pass, or ceil(L / maskBatch) with masked marginals) and written as an L x 20 matrix in
+    <outputDir>/<name>_variants.npz, with the score of the requested mutations in <outputDir>/<name>_mutations.tsv.
+    '''
+    run(parseArgs())
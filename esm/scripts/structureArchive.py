@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'ddelhoyo@cnb.csic.es'
+# *
+
+"""Compact archive of ESMFold predictions written by runESMFold.py (-f archive).
+The structure arrays (see structureIO.getStructureArrays), scores and PAE of the predictions are stored as zlib
+compressed NumPy chunks appended to a single data file, with a tab separated index of the chunks by prediction name.
+Each chain of a prediction is stored in chunks of its own, so a chain is read without decompressing the rest.
+Chunks are indexed once fully written, so an archive can be read while it is being written and a run that dies
+leaves it readable. Only depends on NumPy, so the protocols can read arrays and export CIF files on demand."""
+
+import os, io, json, zlib
+import numpy as np
+
+try:
+    from .structureIO import RESIDUE_KEYS, ATOM_KEYS, selectResidues, concatenateArrays, writeMmCIF
+except ImportError:
+    # Imported from the scripts directory
+    from structureIO import RESIDUE_KEYS, ATOM_KEYS, selectResidues, concatenateArrays, writeMmCIF
+
+# Files of an archive, named <prefix><suffix>
+DATA_SUFFIX, INDEX_SUFFIX = '.esmz', '_index.tsv'
+INDEX_HEADER = ['name', 'chain', 'key', 'offset', 'size']
+# Chain of the chunks of a whole prediction (scores, PAE)
+ALL_CHAINS = '*'
+
+
+def hasStructureArchive(prefix):
+    return os.path.exists(prefix + INDEX_SUFFIX)
+
+
+def findStructureArchives(directory):
+    """Returns the prefixes of the archives in a directory"""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, fileName[:-len(INDEX_SUFFIX)]) for fileName in os.listdir(directory)
+                  if fileName.endswith(INDEX_SUFFIX))
+
+
+def readIndex(indexFile):
+    """Returns a dictionary {name: {chain: {key: (offset, size)}}} from the index of an archive.
+    A last line without its end, being written, is ignored"""
+    index = {}
+    with open(indexFile) as f:
+        next(f)
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            name, chain, key, offset, size = line.rstrip('\n').split('\t')
+            index.setdefault(name, {}).setdefault(chain, {})[key] = (int(offset), int(size))
+    return index
+
+
+class StructureArchive:
+    """Archive of ESMFold predictions. Predictions are appended with write, and read lazily by name and chain"""
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.index = readIndex(prefix + INDEX_SUFFIX) if hasStructureArchive(prefix) else {}
+
+    def getNames(self):
+        return list(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def getChains(self, name):
+        return [chain for chain in self.index[name] if chain != ALL_CHAINS]
+
+    def _readChunk(self, name, chain, key):
+        offset, size = self.index[name][chain][key]
+        with open(self.prefix + DATA_SUFFIX, 'rb') as f:
+            f.seek(offset)
+            return zlib.decompress(f.read(size))
+
+    def _readArray(self, name, chain, key):
+        return np.load(io.BytesIO(self._readChunk(name, chain, key)), allow_pickle=False)
+
+    def getArrays(self, name, chains=None):
+        """Returns the structure arrays of a prediction, or only of the given chains"""
+        chains = chains or self.getChains(name)
+        chainArrays = [{key: self._readArray(name, chain, key) for key in RESIDUE_KEYS + ATOM_KEYS}
+                       for chain in chains]
+        return chainArrays[0] if len(chainArrays) == 1 else concatenateArrays(chainArrays)
+
+    def getScores(self, name):
+        """Returns the per prediction scores (e.g. meanPlddt, ptm, recycles) and its length"""
+        return json.loads(self._readChunk(name, ALL_CHAINS, 'scores'))
+
+    def getPAE(self, name):
+        """Returns the predicted aligned error matrix of the residues of a prediction, or None if not stored"""
+        if 'pae' not in self.index[name].get(ALL_CHAINS, {}):
+            return None
+        return self._readArray(name, ALL_CHAINS, 'pae')
+
+    def exportCIF(self, name, outFile, chains=None, attrName='ESMFoldScore'):
+        """Writes a prediction (or some of its chains) as a mmCIF file with its pLDDT Scipion attribute"""
+        return writeMmCIF(outFile, name, self.getArrays(name, chains), attrName=attrName)
+
+    def write(self, name, arrays, pae=None, **scores):
+        """Appends a prediction to the archive: its structure arrays split by chain, its PAE and its scores"""
+        chunks = []
+        chains = list(dict.fromkeys(arrays['residueChain'].tolist()))
+        for chain in chains:
+            chainArrays = selectResidues(arrays, np.nonzero(arrays['residueChain'] == chain)[0])
+            chunks += [(chain, key, chainArrays[key]) for key in RESIDUE_KEYS + ATOM_KEYS]
+        if pae is not None:
+            chunks.append((ALL_CHAINS, 'pae', pae.astype(np.float16)))
+        scores = dict(scores, length=len(arrays['residueId']))
+        chunks.append((ALL_CHAINS, 'scores', json.dumps(scores).encode()))
+
+        rows = []
+        with open(self.prefix + DATA_SUFFIX, 'ab') as f:
+            for chain, key, value in chunks:
+                if isinstance(value, np.ndarray):
+                    buffer = io.BytesIO()
+                    np.save(buffer, value, allow_pickle=False)
+                    value = buffer.getvalue()
+                data = zlib.compress(value)
+                rows.append((name, chain, key, f.tell(), len(data)))
+                f.write(data)
+
+        # Indexed after the data is written, in a single write
+        indexFile = self.prefix + INDEX_SUFFIX
+        header = '' if os.path.exists(indexFile) else '\t'.join(INDEX_HEADER) + '\n'
+        with open(indexFile, 'a') as f:
+            f.write(header + ''.join('\t'.join(map(str, row)) + '\n' for row in rows))
+        for _, chain, key, offset, size in rows:
+            self.index.setdefault(name, {}).setdefault(chain, {})[key] = (offset, size)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors: Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'ddelhoyo@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+NumPy only helpers to handle ESMFold predictions as atom arrays and write them as mmCIF files.
+They are used both by the prediction scripts and by the protocols, so they must not import torch nor Scipion.
+"""
+
+import numpy as np
+
+# Atom names of the atom37 representation used by ESMFold (openfold residue_constants.atom_types)
+ATOM37_NAMES = ['N', 'CA', 'C', 'CB', 'O', 'CG', 'CG1', 'CG2', 'OG', 'OG1', 'SG', 'CD', 'CD1', 'CD2', 'ND1', 'ND2',
+                'OD1', 'OD2', 'SD', 'CE', 'CE1', 'CE2', 'CE3', 'NE', 'NE1', 'NE2', 'OE1', 'OE2', 'CH2', 'NH1', 'NH2',
+                'OH', 'CZ', 'CZ2', 'CZ3', 'NZ', 'OXT']
+# Residue names in the order of the ESMFold aatype (openfold residue_constants.restypes + unknown)
+RESTYPES_3 = ['ALA', 'ARG', 'ASN', 'ASP', 'CYS', 'GLN', 'GLU', 'GLY', 'HIS', 'ILE',
+              'LEU', 'LYS', 'MET', 'PHE', 'PRO', 'SER', 'THR', 'TRP', 'TYR', 'VAL', 'UNK']
+PDB_CHAIN_IDS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+
+# Section of the Scipion attributes in the mmCIF files (as written by pwem addScipionAttribute)
+SCIPION_ATTRIBUTE = '_scipion_attributes'
+ATOM_SITE_FIELDS = ['group_PDB', 'id', 'type_symbol', 'label_atom_id', 'label_alt_id', 'label_comp_id',
+                    'label_asym_id', 'label_entity_id', 'label_seq_id', 'pdbx_PDB_ins_code', 'Cartn_x', 'Cartn_y',
+                    'Cartn_z', 'occupancy', 'B_iso_or_equiv', 'pdbx_formal_charge', 'auth_seq_id', 'auth_comp_id',
+                    'auth_asym_id', 'auth_atom_id', 'pdbx_PDB_model_num']
+
+
+def toNumpy(value):
+    """Converts a torch tensor (or any array like) to a NumPy array"""
+    if hasattr(value, 'detach'):
+        value = value.detach().float().cpu() if value.is_floating_point() else value.detach().cpu()
+        return value.numpy()
+    return np.asarray(value)
+
+
+def getStructureArrays(output, i):
+    """Returns the atoms of the i-th prediction of an ESMFold batch output as a dictionary of NumPy arrays:
+        residueId, residueChain, residueName, residuePlddt: residue number, chain id, name and mean pLDDT
+        atomPositions, atomPlddt, atomResidue, atomType: per atom coordinates, pLDDT, index of its residue and
+        index of its name in ATOM37_NAMES
+    Atoms are sorted as in the PDB files written by ESMFold (by residue, and in atom37 order within a residue)"""
+    mask = toNumpy(output['atom37_atom_exists'][i]) > 0
+    plddt = toNumpy(output['plddt'][i])
+    atom14 = toNumpy(output['positions'][-1][i])
+    atom37To14 = toNumpy(output['residx_atom37_to_atom14'][i])
+    positions = np.take_along_axis(atom14, atom37To14[..., None], axis=-2)
+    chainIndex = toNumpy(output['chain_index'][i]) if 'chain_index' in output else np.zeros(len(mask), int)
+
+    residues = np.nonzero(mask.any(-1))[0]
+    resIdx, atomType = np.nonzero(mask[residues])
+    residuePlddt = (plddt * mask).sum(-1) / np.maximum(mask.sum(-1), 1)
+    # Complexes are folded with a residue index offset between chains: residues are numbered from 1 in each chain
+    residueIndex, residueChainIndex = toNumpy(output['residue_index'][i])[residues], chainIndex[residues]
+    for chain in np.unique(residueChainIndex):
+        inChain = residueChainIndex == chain
+        residueIndex[inChain] -= residueIndex[inChain].min()
+    return {'residueId': residueIndex.astype(np.int32) + 1,
+            'residueChain': np.array(list(PDB_CHAIN_IDS))[residueChainIndex],
+            'residueName': np.array(RESTYPES_3)[toNumpy(output['aatype'][i])[residues]],
+            'residuePlddt': residuePlddt[residues].astype(np.float32),
+            'atomPositions': positions[residues][resIdx, atomType].astype(np.float32),
+            'atomPlddt': plddt[residues][resIdx, atomType].astype(np.float32),
+            'atomResidue': resIdx.astype(np.int32), 'atomType': atomType.astype(np.int8)}
+
+
+RESIDUE_KEYS = ['residueId', 'residueChain', 'residueName', 'residuePlddt']
+ATOM_KEYS = ['atomPositions', 'atomPlddt', 'atomResidue', 'atomType']
+
+
+def selectResidues(arrays, residues):
+    """Returns the structure arrays of the given residue indices (sorted), with their atoms"""
+    atoms = np.isin(arrays['atomResidue'], residues)
+    newIndex = np.full(len(arrays['residueId']), -1, dtype=np.int32)
+    newIndex[residues] = np.arange(len(residues))
+    selected = {key: arrays[key][residues] for key in RESIDUE_KEYS}
+    selected.update({key: arrays[key][atoms] for key in ATOM_KEYS})
+    selected['atomResidue'] = newIndex[selected['atomResidue']]
+    return selected
+
+
+def concatenateArrays(arraysList):
+    """Concatenates the residues and atoms of several structure arrays"""
+    offsets = np.cumsum([0] + [len(arrays['residueId']) for arrays in arraysList[:-1]])
+    concatenated = {key: np.concatenate([arrays[key] for arrays in arraysList]) for key in RESIDUE_KEYS + ATOM_KEYS}
+    concatenated['atomResidue'] = np.concatenate([arrays['atomResidue'] + offset
+                                                  for arrays, offset in zip(arraysList, offsets)]).astype(np.int32)
+    return concatenated
+
+
+def getSuperposition(mobile, target):
+    """Returns the rotation R and translation t minimizing the RMSD of mobile @ R.T + t to target (Kabsch)"""
+    mobileCenter, targetCenter = mobile.mean(0), target.mean(0)
+    u, _, vt = np.linalg.svd((mobile - mobileCenter).T @ (target - targetCenter))
+    # Avoid reflections
+    d = np.sign(np.linalg.det(vt.T @ u.T))
+    rotation = vt.T @ np.diag([1, 1, d]) @ u.T
+    return rotation, targetCenter - mobileCenter @ rotation.T
+
+
+def getCAPositions(arrays, residues):
+    """Returns the CA coordinates of the given residue indices"""
+    isCA = arrays['atomType'] == ATOM37_NAMES.index('CA')
+    caByResidue = dict(zip(arrays['atomResidue'][isCA], arrays['atomPositions'][isCA]))
+    return np.array([caByResidue[residue] for residue in residues])
+
+
+def stitchWindows(windowArrays):
+    """Stitches the structure arrays of overlapping windows of a single chain, numbered by their position in the
+    full sequence. Each window is superposed onto the stitched structure by the CA atoms of their overlap, and the
+    overlap residues are taken from the first window up to the middle of the overlap and from the second one after
+    it, so every residue comes from the window where it is furthest from the edges"""
+    stitched = windowArrays[0]
+    for arrays in windowArrays[1:]:
+        overlapIds = np.intersect1d(stitched['residueId'], arrays['residueId'])
+        if len(overlapIds) >= 3:
+            stitchedIdx = np.searchsorted(stitched['residueId'], overlapIds)
+            windowIdx = np.searchsorted(arrays['residueId'], overlapIds)
+            rotation, translation = getSuperposition(getCAPositions(arrays, windowIdx),
+                                                     getCAPositions(stitched, stitchedIdx))
+            arrays = dict(arrays, atomPositions=(arrays['atomPositions'] @ rotation.T + translation).astype(np.float32))
+        cutId = overlapIds[len(overlapIds) // 2] if len(overlapIds) else arrays['residueId'][0]
+        stitched = concatenateArrays([selectResidues(stitched, np.nonzero(stitched['residueId'] < cutId)[0]),
+                                      selectResidues(arrays, np.nonzero(arrays['residueId'] >= cutId)[0])])
+    return stitched
+
+
+def getAtomSpecifiers(arrays):
+    """Returns the Scipion specifier ('chain:resNumber@atomName') of each atom"""
+    atomRes = arrays['atomResidue']
+    ids = np.char.add(np.char.add(arrays['residueChain'][atomRes], ':'), arrays['residueId'][atomRes].astype(str))
+    return np.char.add(np.char.add(ids, '@'), np.array(ATOM37_NAMES)[arrays['atomType']])
+
+
+def formatLoop(category, fields, columns):
+    """Formats a mmCIF loop, with left-justified columns"""
+    columns = [np.asarray(column).astype(str) for column in columns]
+    widths = [int(np.char.str_len(column).max()) if len(column) else 0 for column in columns]
+    lines = ['loop_'] + [f'{category}.{field}' for field in fields]
+    padded = [np.char.ljust(column, width) for column, width in zip(columns, widths)]
+    rows = padded[0]
+    for column in padded[1:]:
+        rows = np.char.add(np.char.add(rows, ' '), column)
+    return '\n'.join(lines + [row.rstrip() for row in rows.tolist()]) + '\n#\n'
+
+
+def writeMmCIF(outFile, name, arrays, attrName='ESMFoldScore'):
+    """Writes the atoms of a prediction as a mmCIF file in a single pass, including its pLDDT as a Scipion atom
+    attribute section (so no conversion nor attribute merging is needed afterwards)"""
+    atomRes, nAtoms = arrays['atomResidue'], len(arrays['atomType'])
+    atomNames = np.array(ATOM37_NAMES)[arrays['atomType']]
+    resNames, resIds = arrays['residueName'][atomRes], arrays['residueId'][atomRes]
+    chains, elements = arrays['residueChain'][atomRes], np.array([n[0] for n in ATOM37_NAMES])[arrays['atomType']]
+    positions = arrays['atomPositions']
+    coords = [np.char.mod('%.3f', positions[:, k]) for k in range(3)]
+    plddt = np.char.mod('%.2f', arrays['atomPlddt'])
+
+    atomSite = formatLoop('_atom_site', ATOM_SITE_FIELDS, [
+        np.full(nAtoms, 'ATOM'), np.arange(1, nAtoms + 1), elements, atomNames,
+        np.full(nAtoms, '.'), resNames, chains, np.full(nAtoms, 1), resIds, np.full(nAtoms, '?'),
+        *coords, np.full(nAtoms, '1.0'), plddt, np.full(nAtoms, '?'), resIds, resNames, chains, atomNames,
+        np.full(nAtoms, 1)])
+    attributes = formatLoop(SCIPION_ATTRIBUTE, ['name', 'recipient', 'specifier', 'value'], [
+        np.full(nAtoms, attrName), np.full(nAtoms, 'atoms'), getAtomSpecifiers(arrays), plddt])
+
+    with open(outFile, 'w') as f:
+        f.write(f'data_{name}\n#\n')
+        f.write(atomSite)
+        f.write(attributes)
+    return outFile
@@ -24,4 +24,5 @@
 # *
 # **************************************************************************
 
-from esm.tests.test_esmfold import TestESMFold
+from esm.tests.test_esmfold import TestESMFold, TestESMFoldCPU, TestESMEmbeddingsCPU, TestESMFoldStreaming, \
+    TestESMForms, TestESMImport
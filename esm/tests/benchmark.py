@@ -0,0 +1,198 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Benchmark of the ESMFold pipeline of the plugin with the deterministic stub model (stubESMFold.py), so it measures
+the overhead of the plugin itself (script launch, startup, batching, writing, output conversion and score
+extraction) rather than the model. It runs on CPU, without a GPU nor the ESMFold weights:
+    scipion3 python -m esm.tests.benchmark -o results.json [-n 1 10 100] [-l 50 200 800] [-f pdb cif]
+                                           [-c baseline.json]
+The results are written as JSON, so they can be compared across releases: with --compare, the cases are compared
+against a baseline and the command fails if any overhead metric regressed.
+"""
+
+import os, json, time, random, socket, platform, argparse, subprocess
+from datetime import datetime
+
+from .. import Plugin as esmPlugin
+from ..constants import ESM_DIC
+from ..utils import writeFasta, linkOrCopy
+from ..protocols.protocol_esm_structurePrediction import getPlddtScoreDic, getPDBScoreDic, writeScoredCIF, \
+    getLaunchOverhead
+
+# 2: the launch overhead excludes the import time, as in the protocol run stats
+BENCHMARK_VERSION = 2
+AMINOACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+# Metrics compared against a baseline (seconds, lower is better)
+COMPARED_METRICS = ['wallTime', 'launchOverhead', 'importTime', 'scriptOverhead', 'outputTime', 'scoreTime']
+# Differences under this time (s) are not considered regressions, whatever their ratio
+MIN_REGRESSION_TIME = 0.05
+
+
+def makeSequences(nSequences, length, seed=0):
+    """Returns nSequences deterministic random (name, sequence) entries of the given length"""
+    rng = random.Random(seed)
+    return [(f'seq{i}', ''.join(rng.choice(AMINOACIDS) for _ in range(length))) for i in range(nSequences)]
+
+
+def getCaseName(case):
+    return f"n{case['nSequences']}_l{case['length']}_{case['outputFormat']}"
+
+
+def runCase(workDir, nSequences, length, outputFormat, threads=2):
+    """Folds nSequences of the given length with the stub model through Plugin.runScript, converts the predictions
+    to the output CIF files and extracts their scores as the protocol does. Returns the metrics of the case"""
+    case = {'nSequences': nSequences, 'length': length, 'outputFormat': outputFormat}
+    caseDir = os.path.join(workDir, getCaseName(case))
+    predictionsDir = os.path.join(caseDir, 'predictions')
+    os.makedirs(predictionsDir, exist_ok=True)
+    entries = makeSequences(nSequences, length)
+    fastaFile = writeFasta(entries, os.path.join(caseDir, 'input.fasta'))
+    statsFile = os.path.join(caseDir, 'runStats.json')
+
+    model = esmPlugin.getPluginHome('tests/stubESMFold.py') + ':createModel'
+    args = f'-if {fastaFile} -od {predictionsDir} -m {model} -d cpu -t {threads} -it 1 -f {outputFormat} ' \
+           f'-st {statsFile}'
+    startTime = time.time()
+    esmPlugin.runScript(None, 'runESMFold.py', args, ESM_DIC, isSubprocess=True)
+    launchTime = time.time() - startTime
+    with open(statsFile) as f:
+        stats = json.load(f)
+
+    # Output creation and score extraction, as in ProtESMFoldPrediction.createOutputStep
+    outputTime = scoreTime = pdbScoreTime = 0
+    for name, _ in entries:
+        prefix = os.path.join(predictionsDir, name)
+        startTime = time.time()
+        scoreDic = getPlddtScoreDic(prefix + '_plddt.npz')
+        scoreTime += time.time() - startTime
+
+        startTime = time.time()
+        outFile = os.path.join(caseDir, f'{name}_ESMFold.cif')
+        if outputFormat == 'cif':
+            linkOrCopy(prefix + '.cif', outFile)
+        else:
+            writeScoredCIF(prefix + '.pdb', scoreDic, 'ESMFoldScore', outFile, os.path.join(caseDir, f'{name}.cif'))
+        outputTime += time.time() - startTime
+
+        if outputFormat == 'pdb':
+            startTime = time.time()
+            getPDBScoreDic(prefix + '.pdb')
+            pdbScoreTime += time.time() - startTime
+
+    wallTime = launchTime + outputTime + scoreTime
+    case.update({'wallTime': wallTime, 'launchTime': launchTime,
+                 # Environment activation and interpreter startup, outside of the script run and its imports
+                 'launchOverhead': getLaunchOverhead(launchTime, stats), 'importTime': stats.get('importTime', 0),
+                 # Time of the script run not spent in the model
+                 'scriptOverhead': stats['totalTime'] - stats.get('inference', 0),
+                 'outputTime': outputTime, 'scoreTime': scoreTime, 'pdbScoreTime': pdbScoreTime,
+                 'sequencesPerSecond': nSequences / wallTime, 'residuesPerSecond': nSequences * length / wallTime,
+                 'scriptStats': stats})
+    return case
+
+
+def getGitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=esmPlugin.getPluginHome(),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runBenchmark(workDir, counts, lengths, formats, repeats=1, threads=2):
+    """Runs every combination of sequence count, length and output format, keeping the fastest of the repeats of
+    each case. Returns the results, with the environment they were measured in"""
+    cases = []
+    for nSequences in counts:
+        for length in lengths:
+            for outputFormat in formats:
+                runs = [runCase(os.path.join(workDir, f'run{i}'), nSequences, length, outputFormat, threads)
+                        for i in range(repeats)]
+                case = min(runs, key=lambda run: run['wallTime'])
+                print(f"{getCaseName(case)}: {case['wallTime']:.2f} s, {case['sequencesPerSecond']:.2f} seq/s, "
+                      f"{case['residuesPerSecond']:.0f} res/s (launch overhead {case['launchOverhead']:.2f} s, "
+                      f"imports {case['importTime']:.2f} s, output {case['outputTime']:.2f} s)", flush=True)
+                cases.append(case)
+
+    return {'benchmarkVersion': BENCHMARK_VERSION, 'date': datetime.now().isoformat(timespec='seconds'),
+            'host': socket.gethostname(), 'platform': platform.platform(), 'python': platform.python_version(),
+            'gitCommit': getGitCommit(), 'threads': threads, 'repeats': repeats, 'cases': cases}
+
+
+def compareResults(results, baseline, tolerance=0.2):
+    """Compares the overhead metrics of the cases run in both results. Returns the regressions, as
+    (case, metric, baseline value, value) for the metrics slower than the baseline by more than tolerance"""
+    baselineCases = {getCaseName(case): case for case in baseline['cases']}
+    regressions = []
+    for case in results['cases']:
+        baseCase = baselineCases.get(getCaseName(case))
+        if baseCase is None:
+            continue
+        # Metrics missing in baselines of older benchmark versions are not compared
+        for metric in [metric for metric in COMPARED_METRICS if metric in baseCase]:
+            value, baseValue = case[metric], baseCase[metric]
+            if value > baseValue * (1 + tolerance) and value - baseValue > MIN_REGRESSION_TIME:
+                regressions.append((getCaseName(case), metric, baseValue, value))
+    return regressions
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the overhead of the ESMFold pipeline of the plugin '
+                                                 'with a stub model')
+    parser.add_argument('-o', '--outputFile', type=str, default='esmfoldBenchmark.json', help='Results JSON file')
+    parser.add_argument('-w', '--workDir', type=str, default=None,
+                        help='Directory for the benchmark files (defaults to the output file directory)')
+    parser.add_argument('-n', '--counts', type=int, nargs='+', default=[1, 10, 100], help='Sequence counts')
+    parser.add_argument('-l', '--lengths', type=int, nargs='+', default=[50, 200, 800], help='Sequence lengths')
+    parser.add_argument('-f', '--formats', type=str, nargs='+', default=['pdb', 'cif'], choices=['pdb', 'cif'],
+                        help='Output formats of runESMFold.py')
+    parser.add_argument('-r', '--repeats', type=int, default=1, help='Runs of each case, the fastest one is kept')
+    parser.add_argument('-t', '--threads', type=int, default=2, help='CPU threads of the script')
+    parser.add_argument('-c', '--compare', type=str, default=None, help='Baseline results JSON file to compare with')
+    parser.add_argument('-tol', '--tolerance', type=float, default=0.2,
+                        help='Relative slowdown of an overhead metric considered a regression')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    workDir = args.workDir or os.path.join(os.path.dirname(os.path.abspath(args.outputFile)), 'esmfoldBenchmark')
+    results = runBenchmark(workDir, args.counts, args.lengths, args.formats, args.repeats, args.threads)
+    with open(args.outputFile, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compareResults(results, json.load(f), args.tolerance)
+        for caseName, metric, baseValue, value in regressions:
+            print(f'Regression in {caseName} {metric}: {baseValue:.3f} s -> {value:.3f} s')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
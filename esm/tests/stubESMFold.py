@@ -0,0 +1,301 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+"""
+Deterministic stub of the ESMFold model, with the same interface used by runESMFold.py (infer, output_to_pdb,
+infer_pdb, set_chunk_size, the language model trunk in model.esm, run by _compute_language_model_representations,
+and the folding trunk in model.trunk with its recycles, with the lddt_head used to score them).
+It only needs torch and the esm library (for its alphabet), so the prediction scripts can be tested on CPU without
+downloading the ESMFold weights:
+    python runESMFold.py -m <path>/stubESMFold.py:createModel ...
+Its language model can also be loaded alone, with the same weights, by the ESM-2 scripts:
+    python runESMEmbeddings.py -m <path>/stubESMFold.py:createLanguageModel ...
+Only backbone atoms (N, CA, C, O) are predicted, placed along an ideal alpha helix. Each recycle halves the distance
+of the helix to its final position, so the structure converges along the recycles. Batches with a sequence including
+FAILING_RESIDUE raise an error, to test the handling of the sequences the model cannot fold.
+"""
+
+import os, math
+from types import SimpleNamespace
+import torch
+
+RESTYPES = 'ARNDCQEGHILKMFPSTWYV'
+RESTYPES_3 = ['ALA', 'ARG', 'ASN', 'ASP', 'CYS', 'GLN', 'GLU', 'GLY', 'HIS', 'ILE',
+              'LEU', 'LYS', 'MET', 'PHE', 'PRO', 'SER', 'THR', 'TRP', 'TYR', 'VAL', 'UNK']
+# atom37 indexes of the backbone atoms N, CA, C, O (atom14 indexes 0 to 3)
+BACKBONE_ATOM37 = [0, 1, 2, 4]
+BACKBONE_NAMES = ['N', 'CA', 'C', 'O']
+# Backbone atom offsets from the CA position (A)
+BACKBONE_OFFSETS = [(-0.5, 1.3, -0.3), (0.0, 0.0, 0.0), (1.2, 0.6, 0.4), (1.3, 1.8, 0.6)]
+FAILING_RESIDUE = '#'
+
+
+def getAlphabet():
+    import esm
+    return esm.data.Alphabet.from_architecture('ESM-1b')
+
+
+class StubLanguageModel(torch.nn.Module):
+    """Tiny ESM-2 like language model: returns the logits and the representations of the requested layers"""
+    def __init__(self, alphabet, numLayers=2, embedDim=16):
+        super().__init__()
+        self.num_layers, self.embed_dim = numLayers, embedDim
+        self.embed_tokens = torch.nn.Embedding(len(alphabet.all_toks), embedDim, padding_idx=alphabet.padding_idx)
+        self.layers = torch.nn.ModuleList([torch.nn.Linear(embedDim, embedDim) for _ in range(numLayers)])
+        self.lm_head = torch.nn.Linear(embedDim, len(alphabet.all_toks))
+
+    def forward(self, tokens, repr_layers=(), **kwargs):
+        x = self.embed_tokens(tokens)
+        representations = {0: x} if 0 in repr_layers else {}
+        for i, layer in enumerate(self.layers, 1):
+            x = x + torch.relu(layer(x))
+            if i in repr_layers:
+                representations[i] = x
+        return {'logits': self.lm_head(x), 'representations': representations}
+
+
+class StubTrunkBlock(torch.nn.Module):
+    """Halves the single representation, so that it converges along the recycles to the trunk input"""
+    def forward(self, s, z, mask=None, residue_index=None, chunk_size=None):
+        return 0.5 * s, z
+
+
+class StubPairEmbedding(torch.nn.Module):
+    def __init__(self, pairDim):
+        super().__init__()
+        self.pairDim = pairDim
+
+    def forward(self, residx, mask=None):
+        return residx.new_zeros((*residx.shape, residx.shape[-1], self.pairDim), dtype=torch.float)
+
+
+class StubStructureModule(torch.nn.Module):
+    """Places the backbone along an ideal alpha helix, shifted along x by SHIFT times the first channel of the single
+    representation. The real structure module derives the positions from the representations only, the stub also
+    needs the residue index of the batch (set by infer)"""
+    SHIFT = 8.0
+
+    def __init__(self):
+        super().__init__()
+        self.residueIndex = None
+
+    def forward(self, representations, aatype, mask):
+        single = representations['single']
+        # Ideal alpha helix: 100 degrees and 1.5 A rise per residue, radius 2.3 A
+        residueIndex = self.residueIndex.float()
+        angle = residueIndex * math.radians(100)
+        ca = torch.stack([2.3 * torch.cos(angle) + self.SHIFT * single[..., 0].float(), 2.3 * torch.sin(angle),
+                          1.5 * residueIndex], dim=-1)
+        atom14 = ca.new_zeros((*ca.shape[:2], 14, 3))
+        for i, offset in enumerate(BACKBONE_OFFSETS):
+            atom14[:, :, i] = ca + torch.tensor(offset, device=ca.device)
+        return {'positions': atom14[None], 'states': single[None]}
+
+
+class StubFoldingTrunk(torch.nn.Module):
+    """Folding trunk with the attributes and forward of esm.esmfold.v1.trunk.FoldingTrunk, whose recycles converge
+    geometrically. The single representation has two channels: 1 and the pLDDT logit of the residue"""
+    def __init__(self, pairDim=2, maxRecycles=4):
+        super().__init__()
+        self.cfg = SimpleNamespace(max_recycles=maxRecycles)
+        self.chunk_size = None
+        self.recycle_bins = 15
+        self.pairwise_positional_embedding = StubPairEmbedding(pairDim)
+        self.blocks = torch.nn.ModuleList([StubTrunkBlock()])
+        self.recycle_s_norm, self.recycle_z_norm = torch.nn.Identity(), torch.nn.Identity()
+        self.recycle_disto = torch.nn.Embedding(self.recycle_bins, pairDim)
+        torch.nn.init.zeros_(self.recycle_disto.weight)
+        self.trunk2sm_s, self.trunk2sm_z = torch.nn.Identity(), torch.nn.Identity()
+        self.structure_module = StubStructureModule()
+
+    def forward(self, seq_feats, pair_feats, true_aa, residx, mask, no_recycles=None):
+        noRecycles = self.cfg.max_recycles if no_recycles is None else no_recycles + 1
+        recycle_s, recycle_z = torch.zeros_like(seq_feats), torch.zeros_like(pair_feats)
+        recycle_bins = torch.zeros(*pair_feats.shape[:-1], device=seq_feats.device, dtype=torch.int64)
+        for _ in range(noRecycles):
+            recycle_s = self.recycle_s_norm(recycle_s.detach())
+            recycle_z = self.recycle_z_norm(recycle_z.detach()) + self.recycle_disto(recycle_bins.detach())
+            s, z = seq_feats + recycle_s, pair_feats + recycle_z + self.pairwise_positional_embedding(residx, mask=mask)
+            for block in self.blocks:
+                s, z = block(s, z, mask=mask, residue_index=residx, chunk_size=self.chunk_size)
+            structure = self.structure_module({'single': self.trunk2sm_s(s), 'pair': self.trunk2sm_z(z)},
+                                              true_aa, mask.float())
+            recycle_s, recycle_z = s, z
+            recycle_bins = self.distogram(structure['positions'][-1][:, :, :3], 3.375, 21.375, self.recycle_bins)
+        structure['s_s'], structure['s_z'] = s, z
+        return structure
+
+    @staticmethod
+    def distogram(coords, min_bin, max_bin, num_bins):
+        """Bins of the CA distances (FoldingTrunk uses the virtual CB)"""
+        boundaries = torch.linspace(min_bin, max_bin, num_bins - 1, device=coords.device)
+        ca = coords[..., 1, :]
+        return torch.sum(torch.cdist(ca, ca)[..., None] > boundaries, dim=-1)
+
+
+class StubLDDTHead(torch.nn.Module):
+    """Logits of the lddt bins peaking at the pLDDT of the residue: 50 to 90 from the ratio of the channels of the
+    single representation, so it stays constant along the recycles"""
+    def __init__(self, lddtBins):
+        super().__init__()
+        self.lddtBins = lddtBins
+
+    def forward(self, states):
+        plddt = (50 + 40 * torch.sigmoid(states[..., 1] / states[..., 0].clamp(min=1e-6))) / 100
+        centers = (torch.arange(self.lddtBins, device=states.device) + 0.5) / self.lddtBins
+        logits = -1e4 * (centers - plddt[..., None]) ** 2
+        return logits[..., None, :].expand(*plddt.shape, 37, self.lddtBins).flatten(-2)
+
+
+class StubESMFold(torch.nn.Module):
+    def __init__(self, embedDim=16):
+        super().__init__()
+        # Tiny language model trunk, so the precision / quantization and cache options can be exercised. It is built
+        # first, so it gets the same weights as the one of createLanguageModel
+        self.esm_dict = getAlphabet()
+        self.esm = StubLanguageModel(self.esm_dict, embedDim=embedDim)
+        self.plddt_head = torch.nn.Linear(embedDim, 1)
+        self.trunk = StubFoldingTrunk()
+        self.lddt_bins = 50
+        self.lddt_head = StubLDDTHead(self.lddt_bins)
+        # The language model is named as the other scripts load it, so they share the language model cache
+        self.cfg = SimpleNamespace(esm_type=f'{os.path.abspath(__file__)}:createLanguageModel')
+        self.chunkSize = None
+
+    def set_chunk_size(self, chunkSize):
+        self.chunkSize = chunkSize
+        self.trunk.chunk_size = chunkSize
+
+    def _compute_language_model_representations(self, esmaa):
+        """Same as ESMFold: runs the language model on the tokens with BOS and EOS added, returning the
+        representations of all its layers (B x L x layers + 1 x dim)"""
+        B, padding = esmaa.shape[0], self.esm_dict.padding_idx
+        esmaa = torch.cat([esmaa.new_full((B, 1), self.esm_dict.cls_idx), esmaa, esmaa.new_full((B, 1), padding)],
+                          dim=1)
+        esmaa[range(B), (esmaa != padding).sum(1)] = self.esm_dict.eos_idx
+        res = self.esm(esmaa, repr_layers=range(self.esm.num_layers + 1))
+        esm_s = torch.stack([v for _, v in sorted(res['representations'].items())], dim=2)
+        return esm_s[:, 1:-1]
+
+    def infer(self, sequences, num_recycles=None, **kwargs):
+        if isinstance(sequences, str):
+            sequences = [sequences]
+        if any(FAILING_RESIDUE in seq for seq in sequences):
+            raise ValueError(f'The stub model does not fold sequences with {FAILING_RESIDUE}')
+        # Complexes (chains separated by ':') are joined by a linker, with a residue index offset between chains
+        encoded = [self.encodeComplex(seq) for seq in sequences]
+        B, L = len(sequences), max(len(seq) for seq, _, _, _ in encoded)
+        device = next(self.parameters()).device
+
+        aatype = torch.full((B, L), len(RESTYPES), dtype=torch.long, device=device)
+        mask = torch.zeros((B, L), device=device)
+        residueIndex = torch.arange(L, device=device).repeat(B, 1)
+        chainIndex = torch.zeros((B, L), dtype=torch.long, device=device)
+        linkerMask = torch.ones((B, L), device=device)
+        esmaa = torch.full((B, L), self.esm_dict.padding_idx, dtype=torch.long, device=device)
+        for i, (seq, residx, chains, linker) in enumerate(encoded):
+            aatype[i, :len(seq)] = torch.tensor([RESTYPES.find(aa) % (len(RESTYPES) + 1) for aa in seq.upper()])
+            esmaa[i, :len(seq)] = torch.tensor([self.esm_dict.get_idx(aa) for aa in seq.upper()])
+            mask[i, :len(seq)] = 1
+            residueIndex[i, :len(seq)] = torch.tensor(residx)
+            chainIndex[i, :len(seq)] = torch.tensor(chains)
+            linkerMask[i, :len(seq)] = torch.tensor(linker)
+        from esm.esmfold.v1.categorical_mixture import categorical_lddt
+        esm_s = self._compute_language_model_representations(esmaa).float()
+        s_s_0 = torch.stack([torch.ones_like(mask), self.plddt_head(esm_s[:, :, -1])[..., 0]], dim=-1)
+        s_z_0 = s_s_0.new_zeros((B, L, L, self.trunk.pairwise_positional_embedding.pairDim))
+        self.trunk.structure_module.residueIndex = residueIndex
+        structure = self.trunk(s_s_0, s_z_0, aatype, residueIndex, mask, no_recycles=num_recycles)
+        lddtHead = self.lddt_head(structure['states']).reshape(structure['states'].shape[0], B, L, -1,
+                                                               self.lddt_bins)
+        plddtRes = 100 * categorical_lddt(lddtHead[-1], bins=self.lddt_bins)[..., 0] * mask
+
+        atomExists = torch.zeros((B, L, 37), device=device)
+        atomExists[:, :, BACKBONE_ATOM37] = 1
+        atomExists *= (mask * linkerMask)[..., None]
+        atom37To14 = torch.zeros((B, L, 37), dtype=torch.long, device=device)
+        atom37To14[:, :, BACKBONE_ATOM37] = torch.arange(4, device=device)
+
+        pae = (torch.arange(L, device=device)[None] - torch.arange(L, device=device)[:, None]).abs().float() / 10
+        meanPlddt = (plddtRes * mask).sum(-1) / mask.sum(-1)
+        return {'positions': structure['positions'], 'aatype': aatype, 'residue_index': residueIndex,
+                'atom37_atom_exists': atomExists, 'residx_atom37_to_atom14': atom37To14,
+                'plddt': plddtRes[..., None].expand(B, L, 37).contiguous(),
+                'mean_plddt': meanPlddt, 'ptm': meanPlddt / 100,
+                'predicted_aligned_error': pae.expand(B, L, L).contiguous(),
+                'chain_index': chainIndex}
+
+    @staticmethod
+    def encodeComplex(sequence, residueIndexOffset=512, chainLinker='G' * 25):
+        """Joins the chains of a complex as ESMFold.infer does. Returns the joined sequence, the residue index,
+        chain index and linker mask (0 for the linker residues) of each position"""
+        chains = sequence.split(':')
+        residx, chainIdx, linker = [], [], []
+        for i, chain in enumerate(chains):
+            if i > 0:
+                residx += [residx[-1] + 1 + j for j in range(len(chainLinker))]
+                chainIdx += [i - 1] * len(chainLinker)
+                linker += [0] * len(chainLinker)
+            start = residx[-1] + 1 + residueIndexOffset if residx else 0
+            residx += list(range(start, start + len(chain)))
+            chainIdx += [i] * len(chain)
+            linker += [1] * len(chain)
+        return chainLinker.join(chains), residx, chainIdx, linker
+
+    def output_to_pdb(self, output):
+        pdbs = []
+        positions = output['positions'][-1].cpu()
+        for b in range(positions.shape[0]):
+            lines, atomId = [], 1
+            for r in range(positions.shape[1]):
+                if not output['atom37_atom_exists'][b, r].any():
+                    continue
+                resName = RESTYPES_3[output['aatype'][b, r]]
+                resId = int(output['residue_index'][b, r]) + 1
+                chain = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'[int(output['chain_index'][b, r])]
+                bFactor = float(output['plddt'][b, r, 1])
+                for a, atomName in enumerate(BACKBONE_NAMES):
+                    x, y, z = positions[b, r, a].tolist()
+                    lines.append(f'ATOM  {atomId:5d}  {atomName:<3s} {resName} {chain}{resId:4d}    '
+                                 f'{x:8.3f}{y:8.3f}{z:8.3f}{1.0:6.2f}{bFactor:6.2f}          {atomName[0]:>2s}')
+                    atomId += 1
+            lines += ['TER', 'END']
+            pdbs.append('\n'.join(lines) + '\n')
+        return pdbs
+
+    def infer_pdb(self, sequence, num_recycles=None, **kwargs):
+        return self.output_to_pdb(self.infer(sequence, num_recycles=num_recycles))[0]
+
+
+def createModel():
+    torch.manual_seed(0)
+    return StubESMFold().eval()
+
+
+def createLanguageModel():
+    """Returns the language model of the stub, with the same weights as in createModel, and its alphabet, as the
+    esm.pretrained functions do"""
+    torch.manual_seed(0)
+    alphabet = getAlphabet()
+    return StubLanguageModel(alphabet).eval(), alphabet
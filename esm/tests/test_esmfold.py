@@ -24,11 +24,23 @@
 # *
 # **************************************************************************
 
-from pyworkflow.tests import BaseTest, setupTestProject, DataSet
+import os, sys, json, time, random, shlex, socket, subprocess
+from unittest import mock
+import numpy as np
+
+from pyworkflow.tests import BaseTest, setupTestProject, setupTestOutput, DataSet
 from pwem.protocols import ProtImportSequence
 from pwem.tests.protocols.test_protocols_import_sequence import TestImportBase
 
-from ..protocols import ProtESMFoldPrediction
+from .. import Plugin as esmPlugin
+from ..constants import ESM_DIC
+from ..protocols import ProtESMFoldPrediction, ProtESMEmbeddings, ProtESMVariantScan, ProtESMFoldFilter
+from ..protocols.protocol_esm_structurePrediction import getPlddtScoreDic, getPDBScoreDic
+from ..scripts.embeddingStore import EmbeddingStore
+from ..scripts.structureArchive import StructureArchive
+from ..utils import collapseDuplicates, clusterSequences, writeManifests, writeTaskScript, getManifestFile, \
+    iterFinishedTasks, LocalArrayExecutor, PredictionCache
+from .benchmark import runBenchmark, compareResults
 
 class TestESMFold(TestImportBase):
     NAME = 'USER_SEQ'
@@ -67,3 +79,615 @@ class TestESMFold(TestImportBase):
         self.assertIsNotNone(getattr(protESMFold, 'outputStructure', None))
 
 
+class TestESMFoldCPU(BaseTest):
+    """Runs runESMFold.py on CPU with a deterministic stub model, so neither a GPU nor the ESMFold weights are needed"""
+    SEQUENCES = {'seqA': 'MKTAYIAKQRQISFVKSHFSRQLEERLGLIEVQ', 'seqB': 'GSHMLEDPVDAFQPLLQG', 'seqC': 'MKVB'}
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.fastaFile = cls.getOutputPath('input.fasta')
+        with open(cls.fastaFile, 'w') as f:
+            for name, sequence in cls.SEQUENCES.items():
+                f.write(f'>{name}\n{sequence}\n')
+
+    def _runStubESMFold(self, outName, extraArgs=''):
+        outDir = self.getOutputPath(outName)
+        os.makedirs(outDir, exist_ok=True)
+        model = esmPlugin.getPluginHome('tests/stubESMFold.py') + ':createModel'
+        args = f'-if {self.fastaFile} -od {outDir} -m {model} -d cpu -t 2 -it 1 -br 40 {extraArgs}'
+        esmPlugin.runScript(None, 'runESMFold.py', args, ESM_DIC, isSubprocess=True)
+
+        with open(os.path.join(outDir, 'predictions.jsonl')) as f:
+            entries = {entry['name']: entry for entry in map(json.loads, f)}
+        return outDir, entries
+
+    def _checkPredictions(self, outDir, entries, ext='.pdb'):
+        self.assertEqual(set(entries), set(self.SEQUENCES))
+        for name in self.SEQUENCES:
+            self.assertEqual(entries[name]['status'], 'done')
+            self.assertTrue(os.path.exists(os.path.join(outDir, f'{name}{ext}')))
+            self.assertTrue(os.path.exists(os.path.join(outDir, f'{name}_plddt.npz')))
+
+    def testCPU(self):
+        outDir, entries = self._runStubESMFold('cpu')
+        self._checkPredictions(outDir, entries)
+        # Without adaptive recycling, every prediction runs the requested recycles
+        with np.load(os.path.join(outDir, 'seqA_plddt.npz')) as data:
+            self.assertEqual(int(data['recycles']), entries['seqA']['recycles'])
+            self.assertAlmostEqual(float(data['meanPlddt']), float(data['atomPlddt'].mean()), places=3)
+        length = len(self.SEQUENCES['seqA'])
+        with np.load(os.path.join(outDir, 'seqA_pae.npz')) as data:
+            self.assertEqual(data['pae'].shape, (length, length))
+
+    def testAdaptiveRecycles(self):
+        # The stub structure moves 8 / 2^(n + 1) A from recycle n to n + 1: 2 A, 1 A, 0.5 A...
+        outDir, entries = self._runStubESMFold('adaptive', '-ar -rt 1.5 -nr 8 -sr')
+        self._checkPredictions(outDir, entries)
+        for name, entry in entries.items():
+            self.assertEqual(entry['recycles'], 2)
+            # Folded one at a time, so every sequence stops at its own convergence
+            self.assertEqual(entry['batchSize'], 1)
+            self.assertTrue(os.path.exists(os.path.join(outDir, f'{name}_recycle2.cif')))
+            self.assertFalse(os.path.exists(os.path.join(outDir, f'{name}_recycle3.cif')))
+
+        # Not converging, the requested recycles are run, giving the same structure as without the monitor
+        outDir, entries = self._runStubESMFold('adaptiveMax', '-ar -rt 0.001 -nr 4')
+        self.assertEqual({entry['recycles'] for entry in entries.values()}, {4})
+        fixedDir, _ = self._runStubESMFold('fixedRecycles', '-nr 4')
+        for name in self.SEQUENCES:
+            with open(os.path.join(outDir, f'{name}.pdb')) as f, open(os.path.join(fixedDir, f'{name}.pdb')) as g:
+                self.assertEqual(f.read(), g.read())
+
+    def testDirectCIF(self):
+        outDir, entries = self._runStubESMFold('cif', '-f cif')
+        self._checkPredictions(outDir, entries, ext='.cif')
+        with open(os.path.join(outDir, 'seqB.cif')) as f:
+            self.assertIn('_scipion_attributes.specifier', f.read())
+
+    def testArchive(self):
+        outDir, entries = self._runStubESMFold('archive', '-f archive -an run')
+        self.assertEqual({entry['status'] for entry in entries.values()}, {'done'})
+        archive = StructureArchive(os.path.join(outDir, 'run'))
+        self.assertEqual(set(archive.getNames()), set(self.SEQUENCES))
+        self.assertFalse(os.path.exists(os.path.join(outDir, 'seqA.pdb')))
+
+        arrays = archive.getArrays('seqA', chains=['A'])
+        self.assertEqual(len(arrays['residueId']), len(self.SEQUENCES['seqA']))
+        self.assertEqual(archive.getScores('seqA')['length'], len(self.SEQUENCES['seqA']))
+        self.assertEqual(archive.getPAE('seqA').shape, (len(self.SEQUENCES['seqA']),) * 2)
+        cifFile = archive.exportCIF('seqB', os.path.join(outDir, 'seqB.cif'))
+        with open(cifFile) as f:
+            self.assertIn('_scipion_attributes.specifier', f.read())
+
+    def testLMCache(self):
+        lmCache, statsFile = self.getOutputPath('stubLMCache'), self.getOutputPath('lmCacheStats.json')
+        languageModel = esmPlugin.getPluginHome('tests/stubESMFold.py') + ':createLanguageModel'
+        args = f'-if {self.fastaFile} -o {self.getOutputPath("stubEmbeddings")} -m {languageModel} -d cpu -lc {lmCache}'
+        esmPlugin.runScript(None, 'runESMEmbeddings.py', args, ESM_DIC, isSubprocess=True)
+
+        # The representations computed by the embedding run are reused, so the language model is not run when folding
+        outDir, entries = self._runStubESMFold('lmCache', f'-lc {lmCache} -st {statsFile}')
+        self._checkPredictions(outDir, entries)
+        with open(statsFile) as f:
+            self.assertEqual(json.load(f)['lmCache'], {'hits': len(self.SEQUENCES), 'misses': 0})
+
+    def testComplex(self):
+        outDir = self.getOutputPath('complex')
+        os.makedirs(outDir, exist_ok=True)
+        sequence = f"{self.SEQUENCES['seqA']}:{self.SEQUENCES['seqB']}"
+        model = esmPlugin.getPluginHome('tests/stubESMFold.py') + ':createModel'
+        # The default PDB format: complexes are written as mmCIF, numbered as their pLDDT arrays
+        args = f'-i {sequence} -o complex -od {outDir} -m {model} -d cpu'
+        esmPlugin.runScript(None, 'runESMFold.py', args, ESM_DIC, isSubprocess=True)
+        self.assertTrue(os.path.exists(os.path.join(outDir, 'complex.cif')))
+        self.assertFalse(os.path.exists(os.path.join(outDir, 'complex.pdb')))
+
+        with np.load(os.path.join(outDir, 'complex_plddt.npz')) as data:
+            chains, residueIds = data['residueChain'], data['residueId']
+        # The linker is removed and each chain is numbered from 1
+        self.assertEqual((chains == 'A').sum(), len(self.SEQUENCES['seqA']))
+        self.assertEqual((chains == 'B').sum(), len(self.SEQUENCES['seqB']))
+        self.assertEqual(residueIds[chains == 'B'][0], 1)
+
+    def testPDBSpecifiers(self):
+        # The pLDDT specifiers of the arrays name the atoms of the PDB written by the model
+        outDir, entries = self._runStubESMFold('pdbSpecifiers')
+        self._checkPredictions(outDir, entries)
+        for name in self.SEQUENCES:
+            plddtDic = getPlddtScoreDic(os.path.join(outDir, f'{name}_plddt.npz'))
+            pdbDic = getPDBScoreDic(os.path.join(outDir, f'{name}.pdb'))
+            self.assertEqual(set(plddtDic), set(pdbDic))
+
+    def testWindows(self):
+        outDir, entries = self._runStubESMFold('windows', '-f cif -wl 20 -wo 8')
+        self._checkPredictions(outDir, entries, ext='.cif')
+        self.assertEqual(entries['seqA']['windows'], 3)
+        with np.load(os.path.join(outDir, 'seqA_plddt.npz')) as data:
+            self.assertEqual(data['residueId'].tolist(), list(range(1, len(self.SEQUENCES['seqA']) + 1)))
+
+    def testJobArray(self):
+        jobDir, outDir = self.getOutputPath('jobArray'), self.getOutputPath('jobArrayPredictions')
+        os.makedirs(outDir, exist_ok=True)
+        taskIds = writeManifests(list(self.SEQUENCES.items()), jobDir, taskSize=2)
+        self.assertEqual(taskIds, [1, 2])
+
+        model = esmPlugin.getPluginHome('tests/stubESMFold.py') + ':createModel'
+        script = esmPlugin.getScriptsDir('runESMFold.py')
+        command = f'{esmPlugin.getEnvActivationCommand(ESM_DIC)} && python {script} ' \
+                  f'-if {getManifestFile(jobDir, "{task}")} -od {outDir} -m {model} -d cpu -t 1 -it 1 ' \
+                  f'-log {os.path.join(outDir, "predictions_{task}.jsonl")}'
+        scriptFile = writeTaskScript(os.path.join(jobDir, 'runTask.sh'), command, jobDir)
+        executor = LocalArrayExecutor(scriptFile, [{}, {}], jobDir, env=esmPlugin.getScriptEnviron())
+        executor.submit(taskIds)
+
+        finished = dict(iterFinishedTasks(executor, taskIds, jobDir, interval=1))
+        self.assertEqual(finished, {1: 0, 2: 0})
+        for name in self.SEQUENCES:
+            self.assertTrue(os.path.exists(os.path.join(outDir, f'{name}.pdb')))
+
+    def testJobArrayFailure(self):
+        jobDir = self.getOutputPath('jobArrayFailure')
+        taskIds = writeManifests(list(self.SEQUENCES.items()), jobDir, taskSize=1)
+        # Task 2 ends the shell itself and task 3 fails under set -e: both exit codes must still be recorded
+        command = 'set -e; if [ {task} = 2 ]; then exit 3; fi; if [ {task} = 3 ]; then false; fi; echo done'
+        scriptFile = writeTaskScript(os.path.join(jobDir, 'runTask.sh'), command, jobDir)
+        executor = LocalArrayExecutor(scriptFile, [{}, {}], jobDir)
+        executor.submit(taskIds)
+
+        finished = dict(iterFinishedTasks(executor, taskIds, jobDir, interval=1))
+        self.assertEqual(finished, {1: 0, 2: 3, 3: 1})
+
+    def testPredictionCache(self):
+        cacheDir, outDir = self.getOutputPath('predictionCache'), self.getOutputPath('predictionCacheFiles')
+        os.makedirs(outDir, exist_ok=True)
+        sequence = self.SEQUENCES['seqA']
+        key = PredictionCache.getKey(sequence, model='esmfold_v1', nRecycles=4)
+        # Keys ignore the case of the sequence and the order of the parameters, but not their values
+        self.assertEqual(key, PredictionCache.getKey(sequence.lower(), nRecycles=4, model='esmfold_v1'))
+        self.assertNotEqual(key, PredictionCache.getKey(sequence, model='esmfold_v1', nRecycles=3))
+
+        files = []
+        for suffix in ['.cif', '_plddt.npz']:
+            files.append(os.path.join(outDir, f'seqA{suffix}'))
+            with open(files[-1], 'w') as f:
+                f.write(suffix * 100)
+        cache = PredictionCache(cacheDir, maxSize=10 ** 6)
+        self.assertFalse(cache.get(key, outDir, 'copyA'))
+        cache.put(key, 'seqA', files)
+        # Entries are retrieved named after the requesting sequence
+        self.assertTrue(cache.get(key, outDir, 'copyA'))
+        for suffix in ['.cif', '_plddt.npz']:
+            with open(os.path.join(outDir, f'copyA{suffix}')) as f:
+                self.assertEqual(f.read(), suffix * 100)
+
+        # Beyond the maximum size, the least recently used entries are evicted
+        cache.maxSize = 2 * sum(map(os.path.getsize, files))
+        otherKeys = [PredictionCache.getKey(sequence, nRecycles=n) for n in range(2)]
+        cache.put(otherKeys[0], 'seqA', files)
+        for usedTime, usedKey in enumerate([key, otherKeys[0]], 1):
+            os.utime(cache.getEntryDir(usedKey), (usedTime, usedTime))
+        self.assertTrue(cache.get(key, outDir, 'copyA'))
+        cache.put(otherKeys[1], 'seqA', files)
+        self.assertEqual([os.path.isdir(cache.getEntryDir(k)) for k in [key] + otherKeys], [True, False, True])
+
+    def testRedundancy(self):
+        seqA = self.SEQUENCES['seqA']
+        entries = list(self.SEQUENCES.items()) + [('seqA_copy', seqA.lower()), ('seqA_tagged', 'HHHHHH' + seqA),
+                                                  ('seqA_truncated', seqA[5:])]
+        uniqueEntries, duplicates = collapseDuplicates(entries)
+        self.assertEqual(len(uniqueEntries), len(entries) - 1)
+        self.assertEqual(duplicates, {'seqA': ['seqA_copy']})
+
+        representatives, clusters = clusterSequences(uniqueEntries, threshold=0.9)
+        self.assertEqual([name for name, _ in representatives], ['seqB', 'seqC', 'seqA_tagged'])
+        self.assertEqual(sorted(clusters['seqA_tagged']), [('seqA', 1.0), ('seqA_truncated', 1.0)])
+
+        # Insertions in the longer sequence break shared k-mers without lowering the identity
+        rng = random.Random(0)
+        sequence = ''.join(rng.choice('ACDEFGHIKLMNPQRSTVWY') for _ in range(200))
+        inserted = list(sequence)
+        for position in sorted(rng.sample(range(1, len(sequence)), 22), reverse=True):
+            inserted.insert(position, 'W')
+        representatives, clusters = clusterSequences([('original', sequence), ('inserted', ''.join(inserted))],
+                                                     threshold=0.95)
+        self.assertEqual([name for name, _ in representatives], ['inserted'])
+        self.assertEqual(clusters, {'inserted': [('original', 1.0)]})
+
+    def testBenchmark(self):
+        results = runBenchmark(self.getOutputPath('benchmark'), counts=[2], lengths=[30], formats=['pdb', 'cif'])
+        self.assertEqual(len(results['cases']), 2)
+        for case in results['cases']:
+            self.assertGreater(case['sequencesPerSecond'], 0)
+            self.assertGreaterEqual(case['launchOverhead'], 0)
+        self.assertEqual(compareResults(results, results), [])
+
+    def testInferenceModes(self):
+        statsFile = self.getOutputPath('autocastStats.json')
+        outDir, entries = self._runStubESMFold('autocast', f'-ac bfloat16 -im -pc -st {statsFile}')
+        self._checkPredictions(outDir, entries)
+        with open(statsFile) as f:
+            parity = json.load(f)['parity']
+        # The reference runs the language model as loaded: fp32 on CPU
+        self.assertEqual(parity['reference'], 'float32-cpu language model, eager')
+        # The stub positions do not depend on the language model, only its pLDDT does
+        self.assertAlmostEqual(parity['rmsd'], 0, places=3)
+        self.assertLess(parity['maxPlddtDifference'], parity['plddtTolerance'])
+        self.assertTrue(parity['passed'])
+
+    def testCompiled(self):
+        statsFile = self.getOutputPath('compiledStats.json')
+        outDir, entries = self._runStubESMFold('compiled', f'-co -pc -st {statsFile}')
+        self._checkPredictions(outDir, entries)
+        with open(statsFile) as f:
+            self.assertTrue(json.load(f)['parity']['passed'])
+
+        # Adaptive recycling runs the eager folding trunk of the compiled model
+        outDir, entries = self._runStubESMFold('compiledAdaptive', '-co -ar -rt 1.5 -nr 8')
+        self._checkPredictions(outDir, entries)
+        self.assertEqual({entry['recycles'] for entry in entries.values()}, {2})
+
+    def testQuantizedCPU(self):
+        for precision in ['bfloat16', 'int8']:
+            self._checkPredictions(*self._runStubESMFold(precision, f'-p {precision}'))
+
+    def _runInESMEnv(self, code):
+        """Runs the python code in the ESM environment, where the script modules can be imported, and returns the
+        JSON it prints"""
+        command = f'{esmPlugin.getEnvActivationCommand(ESM_DIC)} && python -c {shlex.quote(code)}'
+        output = subprocess.check_output(command, shell=True, executable='/bin/bash', text=True,
+                                         cwd=esmPlugin.getScriptsDir(''), env=esmPlugin.getScriptEnviron())
+        return json.loads(output.strip().splitlines()[-1])
+
+    def testBatchBudget(self):
+        code = ('import json, random\n'
+                'from runESMFold import makeBatches\n'
+                'random.seed(0)\n'
+                'records = [(f"seq{i}", "A" * random.randint(10, 300)) for i in range(100)]\n'
+                'print(json.dumps({budget: [[len(seq) for _, seq in batch] for batch in makeBatches(records, budget)]\n'
+                '                  for budget in [0, 100, 400, 1000]}))')
+        for budget, batches in self._runInESMEnv(code).items():
+            budget = int(budget)
+            self.assertEqual(sum(map(len, batches)), 100)
+            for batch, nextBatch in zip(batches, batches[1:] + [None]):
+                if budget <= 0:
+                    self.assertEqual(len(batch), 1)
+                    continue
+                # n * L^2 <= budget^2, unless a single sequence is longer than the budget
+                self.assertTrue(len(batch) == 1 or len(batch) * max(batch) ** 2 <= budget ** 2, (budget, batch))
+                # Batches are closed only when the next sequence does not fit
+                if nextBatch is not None:
+                    self.assertGreater((len(batch) + 1) * nextBatch[0] ** 2, budget ** 2)
+
+    def testChunkSizePlan(self):
+        code = ('import json, torch, runESMFold as r\n'
+                'cpu, length = torch.device("cpu"), 1000\n'
+                'fits128 = 1.01 * r.estimateInferenceMemory(1, length, 128) / r.MEMORY_SAFETY_FACTOR\n'
+                'plans = {}\n'
+                'for name, memory in [("large", 1e15), ("fits128", fits128), ("small", 1)]:\n'
+                '    r.getAvailableMemory = lambda device: memory\n'
+                '    plans[name] = r.planChunkSize(cpu, 1, length)["chunkSize"]\n'
+                'fallbacks, chunkSize = [], None\n'
+                'while chunkSize != r.AUTO_CHUNK_SIZES[-1]:\n'
+                '    chunkSize = r.getSmallerChunkSize(chunkSize)\n'
+                '    fallbacks.append(chunkSize)\n'
+                'estimates = {str(c): r.estimateInferenceMemory(1, length, c) for c in r.AUTO_CHUNK_SIZES}\n'
+                'print(json.dumps({"plans": plans, "fallbacks": fallbacks, "estimates": estimates,\n'
+                '                  "autoChunkSizes": r.AUTO_CHUNK_SIZES, "last": r.getSmallerChunkSize(chunkSize),\n'
+                '                  "batchOf3": r.estimateInferenceMemory(3, length, 64),\n'
+                '                  "longChunk": r.estimateInferenceMemory(1, 100, 512),\n'
+                '                  "unchunked": r.estimateInferenceMemory(1, 100, None)}))')
+        result = self._runInESMEnv(code)
+        # The largest chunk size fitting the memory is chosen, the smallest one if none fits
+        self.assertEqual(result['plans'], {'large': None, 'fits128': 128, 'small': 4})
+        # After an out of memory error, the next smaller chunk size is tried, down to the smallest
+        self.assertEqual(result['fallbacks'], result['autoChunkSizes'][1:])
+        self.assertIsNone(result['last'])
+        estimates = [result['estimates'][str(chunkSize)] for chunkSize in result['autoChunkSizes']]
+        self.assertEqual(estimates, sorted(estimates, reverse=True))
+        self.assertEqual(result['batchOf3'], 3 * result['estimates']['64'])
+        # Chunks longer than the sequence do not chunk it
+        self.assertEqual(result['longChunk'], result['unchunked'])
+
+        # Folding with chunk sizes above 64 runs out of memory, and seqC ('MKVB') with any chunk size
+        calls, entries = self._runOutOfMemory('outOfMemoryChunks', 'model.chunkSize in [None, 512, 256, 128] or '
+                                                                   '"B" in sequences[0]', '-cs auto')
+        chunkSizes = [call['chunkSize'] for call in calls]
+        # Sequences are folded by length: seqC, seqB and seqA
+        self.assertEqual(chunkSizes, result['autoChunkSizes'] + 2 * [None, 512, 256, 128, 64])
+        # The smaller chunk size is tried once the handler of the error exits, releasing the failed forward pass
+        self.assertFalse(any(call['inHandler'] for call in calls))
+        self.assertEqual({name: entry['status'] for name, entry in entries.items()},
+                         {'seqA': 'done', 'seqB': 'done', 'seqC': 'failed'})
+        self.assertEqual(entries['seqA']['chunkSize'], 64)
+
+    def _runOutOfMemory(self, outName, condition, extraArgs):
+        """Runs the stub model in the ESM environment, raising an out of memory error for the batches meeting the
+        condition (of sequences and model), and returns the size, chunk size and exception state of every batch"""
+        outDir = self.getOutputPath(outName)
+        os.makedirs(outDir, exist_ok=True)
+        model = esmPlugin.getPluginHome('tests/stubESMFold.py') + ':createModel'
+        argv = ['-if', self.fastaFile, '-od', outDir, '-m', model, '-d', 'cpu'] + extraArgs.split()
+        code = ('import json, sys, runESMFold as r\n'
+                'predictBatch, calls = r.predictBatch, []\n'
+                'def outOfMemoryBatch(model, sequences, *args, **kwargs):\n'
+                '    calls.append({"size": len(sequences), "chunkSize": model.chunkSize,\n'
+                '                  "inHandler": sys.exc_info()[0] is not None})\n'
+                f'    if {condition}:\n'
+                '        raise RuntimeError("CUDA out of memory")\n'
+                '    return predictBatch(model, sequences, *args, **kwargs)\n'
+                'r.predictBatch = outOfMemoryBatch\n'
+                f'r.run(r.parseArgs({argv!r}))\n'
+                'print(json.dumps(calls))')
+        calls = self._runInESMEnv(code)
+        with open(os.path.join(outDir, 'predictions.jsonl')) as f:
+            return calls, {entry['name']: entry for entry in map(json.loads, f)}
+
+    def testOutOfMemorySplit(self):
+        calls, entries = self._runOutOfMemory('outOfMemorySplit', 'len(sequences) > 1', '-br 1000')
+        # The batch of 3 is split in 1 + 2, and the 2 in 1 + 1
+        self.assertEqual([call['size'] for call in calls], [3, 1, 2, 1, 1])
+        # The halves are folded once the handler of the error exits, releasing the failed forward pass
+        self.assertFalse(any(call['inHandler'] for call in calls))
+        self.assertEqual({entry['status'] for entry in entries.values()}, {'done'})
+
+    @staticmethod
+    def _workerRequest(socketFile, request, wait=True):
+        """Sends a request to the worker and returns its JSON line responses, or none if not waiting for them"""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(120)
+            sock.connect(socketFile)
+            sock.sendall((json.dumps(request) + '\n').encode())
+            return [json.loads(line) for line in sock.makefile()] if wait else []
+
+    def testWorker(self):
+        socketFile, outDir = self.getOutputPath('worker.sock'), self.getOutputPath('workerPredictions')
+        os.makedirs(outDir, exist_ok=True)
+        command = f'{esmPlugin.getEnvActivationCommand(ESM_DIC)} && python esmFoldWorker.py -s {socketFile} -t 300'
+        worker = subprocess.Popen(command, shell=True, executable='/bin/bash', cwd=esmPlugin.getScriptsDir(''),
+                                  env=esmPlugin.getScriptEnviron())
+        try:
+            for _ in range(120):
+                if os.path.exists(socketFile) or worker.poll() is not None:
+                    break
+                time.sleep(1)
+
+            # Invalid arguments (exiting the script) and malformed requests only fail their job
+            responses = self._workerRequest(socketFile, {'cmd': 'run', 'script': 'runESMFold.py', 'args': '-x'})
+            self.assertEqual(responses[-1]['status'], 'failed')
+            self.assertEqual(self._workerRequest(socketFile, ['run'])[-1]['status'], 'failed')
+
+            # A client disconnecting from its running job does not stop the worker, which finishes the job
+            model = esmPlugin.getPluginHome('tests/stubESMFold.py') + ':createModel'
+            self._workerRequest(socketFile, {'cmd': 'run', 'script': 'runESMFold.py',
+                                             'args': f'-if {self.fastaFile} -od {outDir} -m {model} -d cpu'},
+                                wait=False)
+            self.assertEqual(self._workerRequest(socketFile, {'cmd': 'ping'})[-1]['status'], 'alive')
+            with open(os.path.join(outDir, 'predictions.jsonl')) as f:
+                self.assertEqual({json.loads(line)['status'] for line in f}, {'done'})
+        finally:
+            if worker.poll() is None:
+                self._workerRequest(socketFile, {'cmd': 'stop'})
+                worker.wait(timeout=60)
+
+    def _runStubRecords(self, outName, records, extraArgs=''):
+        """Runs the stub model on the {name: sequence} records, returning the output directory and its log entries"""
+        outDir = self.getOutputPath(outName)
+        os.makedirs(outDir, exist_ok=True)
+        fastaFile = os.path.join(outDir, 'input.fasta')
+        with open(fastaFile, 'w') as f:
+            for name, sequence in records.items():
+                f.write(f'>{name}\n{sequence}\n')
+        model = esmPlugin.getPluginHome('tests/stubESMFold.py') + ':createModel'
+        args = f'-if {fastaFile} -od {outDir} -m {model} -d cpu {extraArgs}'
+        esmPlugin.runScript(None, 'runESMFold.py', args, ESM_DIC, isSubprocess=True)
+
+        with open(os.path.join(outDir, 'predictions.jsonl')) as f:
+            return outDir, [json.loads(line) for line in f]
+
+    def testSequenceFailures(self):
+        # The stub cannot fold seqFail, and the prediction of missingDir/seqW cannot be written
+        records = {'seqA': self.SEQUENCES['seqA'], 'seqFail': 'MKT#AYIAKQ', 'missingDir/seqW': self.SEQUENCES['seqB'],
+                   'seqC': self.SEQUENCES['seqC']}
+        outDir, entries = self._runStubRecords('failures', records, '-br 1000')
+        # The batch is retried one sequence at a time, so each failure only fails its sequence
+        self.assertEqual({entry['name']: entry['status'] for entry in entries},
+                         {'seqA': 'done', 'seqFail': 'failed', 'missingDir/seqW': 'failed', 'seqC': 'done'})
+        for entry in entries:
+            self.assertEqual('error' in entry, entry['status'] == 'failed')
+        self.assertTrue(os.path.exists(os.path.join(outDir, 'seqC.pdb')))
+
+    def testResume(self):
+        # The prediction of missingDir/seqW cannot be written until its directory exists
+        records = {'seqA': self.SEQUENCES['seqA'], 'missingDir/seqW': self.SEQUENCES['seqB'],
+                   'seqC': self.SEQUENCES['seqC']}
+        outDir, entries = self._runStubRecords('resume', records, '--resume')
+        self.assertEqual({entry['name']: entry['status'] for entry in entries},
+                         {'seqA': 'done', 'missingDir/seqW': 'failed', 'seqC': 'done'})
+
+        # Resuming skips the predicted sequences and retries the failed ones
+        os.makedirs(os.path.join(outDir, 'missingDir'))
+        _, allEntries = self._runStubRecords('resume', records, '--resume')
+        self.assertEqual([(entry['name'], entry['status']) for entry in allEntries[len(entries):]],
+                         [('missingDir/seqW', 'done')])
+        self.assertTrue(os.path.exists(os.path.join(outDir, 'missingDir', 'seqW_plddt.npz')))
+
+
+class TestESMEmbeddingsCPU(BaseTest):
+    """Runs the ESM-2 language model scripts on CPU with the smallest ESM-2 model"""
+    SEQUENCES = TestESMFoldCPU.SEQUENCES
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.fastaFile = cls.getOutputPath('input.fasta')
+        with open(cls.fastaFile, 'w') as f:
+            for name, sequence in cls.SEQUENCES.items():
+                f.write(f'>{name}\n{sequence}\n')
+
+    def testEmbeddings(self):
+        prefix = self.getOutputPath('embeddings')
+        args = f'-if {self.fastaFile} -o {prefix} -m esm2_t6_8M_UR50D -d cpu -t 2 -it 1 -tb 60'
+        esmPlugin.runScript(None, 'runESMEmbeddings.py', args, ESM_DIC, isSubprocess=True)
+
+        store = EmbeddingStore(prefix)
+        self.assertEqual(store.getNames(), list(self.SEQUENCES))
+        for name, sequence in self.SEQUENCES.items():
+            self.assertEqual(store.getResidueEmbeddings(name).shape, (len(sequence), store.getDimension()))
+            self.assertTrue(np.allclose(store.getMeanEmbedding(name), store.getResidueEmbeddings(name).mean(axis=0),
+                                        atol=1e-4))
+
+    def testLMCache(self):
+        lmCache = self.getOutputPath('lmCache')
+        args = f'-if {self.fastaFile} -m esm2_t6_8M_UR50D -d cpu -t 2 -it 1 -lc {lmCache}'
+        for outName in ['computed', 'cached']:
+            esmPlugin.runScript(None, 'runESMEmbeddings.py', f'{args} -o {self.getOutputPath(outName)}', ESM_DIC,
+                                isSubprocess=True)
+
+        computed, cached = EmbeddingStore(self.getOutputPath('computed')), EmbeddingStore(self.getOutputPath('cached'))
+        for name in self.SEQUENCES:
+            # Cached representations are stored in float16
+            self.assertTrue(np.allclose(computed.getMeanEmbedding(name), cached.getMeanEmbedding(name), atol=1e-2))
+
+    def testVariantScan(self):
+        outDir = self.getOutputPath('variants')
+        os.makedirs(outDir, exist_ok=True)
+        mutationsFile = self.getOutputPath('mutations.txt')
+        with open(mutationsFile, 'w') as f:
+            f.write('M1A\nK2R:T3S\nW2A\nA23\nX9999G\nM1A:K2\n')
+
+        for scoring in ['wt-marginals', 'masked-marginals']:
+            args = f'-if {self.fastaFile} -od {outDir} -m esm2_t6_8M_UR50D -s {scoring} -mb 8 -d cpu -t 2 -it 1'
+            esmPlugin.runScript(None, 'runESMVariantScan.py', f'{args} -mf {mutationsFile}', ESM_DIC,
+                                isSubprocess=True)
+            with np.load(os.path.join(outDir, 'seqA_variants.npz')) as data:
+                self.assertEqual(data['scores'].shape, (len(self.SEQUENCES['seqA']), 20))
+                # The wild type residue scores 0 at every position
+                self.assertTrue(np.allclose(data['scores'][0, 'ACDEFGHIKLMNPQRSTVWY'.index('M')], 0))
+            with open(os.path.join(outDir, 'seqA_mutations.tsv')) as f:
+                # Mutations not matching the sequence (W2A, X9999G) or malformed are skipped
+                self.assertEqual([line.split()[0] for line in f][1:], ['M1A', 'K2R:T3S'])
+
+
+class TestESMFoldStreaming(BaseTest):
+    """Runs the output and cache helpers of the prediction protocol on logged predictions, without running the model"""
+    NAMES = ['seqA', 'seqB', 'seqC']
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        cls.protImportSequence = cls.newProtocol(ProtImportSequence, inputSequenceName='USER_SEQ',
+                                                 inputRawSequence='MKTAYIAKQRQISFVKSHFSRQLEERLGLIEVQ')
+        cls.launchProtocol(cls.protImportSequence)
+
+    def _logPrediction(self, protocol, name):
+        with open(protocol.getPredictionFile(name, '.cif'), 'w') as f:
+            f.write(f'data_{name}\n')
+        protocol.writeLogEntry({'name': name, 'status': 'done'})
+
+    def testStreamOutput(self):
+        protocol = self.newProtocol(ProtESMFoldPrediction, inputSequence=self.protImportSequence.outputSequence)
+        self.proj.saveProtocol(protocol)
+        os.makedirs(protocol.getPredictionsDir(), exist_ok=True)
+        # As for a set of input sequences, in this order
+        inputEntries = [(name, 'MKTAYIAKQ') for name in self.NAMES]
+
+        outputNames = set()
+        with mock.patch.object(protocol, 'getInputEntries', return_value=inputEntries) as getInputEntries:
+            # seqB waits for seqA, so the structures are added in input order
+            self._logPrediction(protocol, 'seqB')
+            protocol.appendOutputStructures(['seqB'], outputNames=outputNames)
+            self.assertEqual(outputNames, set())
+            self._logPrediction(protocol, 'seqA')
+            protocol.appendOutputStructures(['seqA', 'seqB'], outputNames=outputNames)
+            self.assertEqual(outputNames, {'seqA', 'seqB'})
+
+            self._logPrediction(protocol, 'seqC')
+            with open(protocol.getShardDoneFile(0), 'w'):
+                pass
+            getInputEntries.reset_mock()
+            # The names in the input and output sets are read once, not on every poll
+            with mock.patch.object(protocol, 'getOutputNames', wraps=protocol.getOutputNames) as getOutputNames:
+                protocol.streamOutputStep()
+            self.assertEqual(getOutputNames.call_count, 1)
+            self.assertEqual(getInputEntries.call_count, 1)
+
+        outSet = getattr(protocol, protocol._OUTSETNAME)
+        self.assertEqual([outAS._seqName.get() for outAS in outSet], self.NAMES)
+
+
+    def testCacheKey(self):
+        protocol = self.newProtocol(ProtESMFoldPrediction, inputSequence=self.protImportSequence.outputSequence)
+        sequence = self.protImportSequence.outputSequence.getSequence()
+        # The language model runs in float16 on GPU and float32 on CPU, so their predictions are not shared
+        self.assertNotEqual(protocol.getCacheKey(sequence, 'cuda'), protocol.getCacheKey(sequence, 'cpu'))
+        self.assertEqual(protocol.getCacheDeviceTypes(), ['cuda', 'cpu'])
+        protocol.device.set(2)
+        self.assertEqual(protocol.getCacheDeviceTypes(), ['cpu'])
+
+        # Predictions are cached under the device type their run stats record
+        self.proj.saveProtocol(protocol)
+        os.makedirs(protocol._getExtraPath(), exist_ok=True)
+        with open(protocol.getStatsFile(0), 'w') as f:
+            json.dump({'device': 'cuda:1'}, f)
+        self.assertEqual(protocol.getRunDeviceType(0), 'cuda')
+        self.assertIsNone(protocol.getRunDeviceType(1))
+
+
+class TestESMForms(BaseTest):
+    """Builds the form of every protocol of the plugin, as the Scipion GUI does when a protocol is opened"""
+    PROTOCOLS = [ProtESMFoldPrediction, ProtESMEmbeddings, ProtESMVariantScan, ProtESMFoldFilter]
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+
+    def testForms(self):
+        for protocolClass in self.PROTOCOLS:
+            protocol = self.newProtocol(protocolClass)
+            self.assertGreater(len(list(protocol.getDefinition().iterParams())), 0, protocolClass.__name__)
+        protocol = self.newProtocol(ProtESMVariantScan)
+        self.assertEqual(protocol.getDefinition().getParam('aggregate').choices, ProtESMVariantScan._AGGREGATES)
+
+
+class TestESMImport(BaseTest):
+    """Checks that loading the plugin modules, as Scipion does on startup, stays fast and does not load heavy
+    dependencies, and that the scripts environment cannot import the plugin in place of the fair-esm library"""
+    # Time allowed to import each plugin module once the pwem modules it builds on are loaded (s)
+    IMPORT_TIME_BUDGET = 1.0
+    HEAVY_MODULES = ['matplotlib.pyplot', 'torch', 'Bio.PDB']
+    # Each plugin module, with the pwem modules loaded by its baseline
+    IMPORTS = [('esm.protocols', 'pwem.protocols, pwem.objects'), ('esm.viewers', 'pwem.viewers'),
+               ('esm.wizards', 'pwem.wizards')]
+
+    @staticmethod
+    def _importModules(code):
+        """Runs the import code in a fresh interpreter with -X importtime. Returns its output and the self import
+        time (s) of every module it loaded"""
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                                 check=True)
+        times = {}
+        # Lines as 'import time: <self us> | <cumulative us> | <module>', after a header
+        for line in process.stderr.splitlines():
+            fields = line.split('|')
+            selfTime = fields[0].split(':')[-1].strip()
+            if line.startswith('import time:') and selfTime.isdigit():
+                times[fields[2].strip()] = int(selfTime) / 1e6
+        return process.stdout.strip(), times
+
+    def testImportTime(self):
+        for pluginModule, dependencies in self.IMPORTS:
+            # The baseline is taken in its own interpreter, so only the modules loaded by the plugin are counted
+            _, baseline = self._importModules(f'import {dependencies}')
+            pluginFile, loaded = self._importModules(f'import {pluginModule}; print(esm.__file__)')
+            added = {module: time for module, time in loaded.items() if module not in baseline}
+
+            self.assertEqual(os.path.dirname(pluginFile), os.path.normpath(esmPlugin.getPluginHome()))
+            self.assertLess(sum(added.values()), self.IMPORT_TIME_BUDGET, pluginModule)
+            for module in self.HEAVY_MODULES:
+                self.assertNotIn(module, added, pluginModule)
+
+    def testScriptEnviron(self):
+        pluginRoot = os.path.dirname(os.path.normpath(esmPlugin.getPluginHome()))
+        paths = esmPlugin.getScriptEnviron().get('PYTHONPATH', '').split(os.pathsep)
+        self.assertNotIn(pluginRoot, [os.path.abspath(path) for path in paths if path])
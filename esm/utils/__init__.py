@@ -1 +1,5 @@
-from .utils import *
\ No newline at end of file
+from .utils import *
+from .cache import PredictionCache, linkOrCopy
+from .jobArray import writeManifests, writeTaskScript, iterFinishedTasks, getManifestFile, getManifestIds, \
+  getExitFile, LocalArrayExecutor, QueueArrayExecutor
+from .redundancy import collapseDuplicates, clusterSequences
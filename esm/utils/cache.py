@@ -0,0 +1,115 @@
+# **************************************************************************
+# *
+# * Authors:     Carlos Oscar Sorzano (coss@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+
+import os, json, shutil, hashlib
+
+
+class PredictionCache:
+  """On-disk content-addressed cache of ESMFold predictions.
+  Each entry is a directory named after the hash of the sequence and the parameters that affect the prediction,
+  holding the prediction files. Entries are evicted in least recently used order when the cache exceeds maxSize."""
+  _ENTRY_PREFIX = 'prediction'
+
+  def __init__(self, cacheDir, maxSize):
+    self.cacheDir, self.maxSize = cacheDir, maxSize
+
+  @staticmethod
+  def getKey(sequence, **params):
+    """Returns the cache key of a sequence predicted with the given parameters.
+    Only parameters that change the prediction must be passed (e.g. not the chunk size, which only changes memory)"""
+    content = json.dumps({'sequence': sequence.upper(), **params}, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+  def getEntryDir(self, key):
+    return os.path.join(self.cacheDir, key[:2], key)
+
+  def get(self, key, outDir, name):
+    """Hardlinks (or copies) the files of a cached entry into outDir, renamed after name.
+    Returns whether the entry was found"""
+    entryDir = self.getEntryDir(key)
+    if not os.path.isdir(entryDir):
+      return False
+
+    for fileName in os.listdir(entryDir):
+      outFile = os.path.join(outDir, name + fileName[len(self._ENTRY_PREFIX):])
+      if os.path.exists(outFile):
+        os.remove(outFile)
+      linkOrCopy(os.path.join(entryDir, fileName), outFile)
+    # Mark the entry as recently used
+    os.utime(entryDir)
+    return True
+
+  def put(self, key, name, files):
+    """Stores the prediction files of name (files named <name><suffix>) in the entry of key"""
+    entryDir = self.getEntryDir(key)
+    if os.path.isdir(entryDir):
+      return
+
+    # Written in a temporary directory and renamed, so concurrent readers never see half-written entries
+    tmpDir = f'{entryDir}.{os.getpid()}.tmp'
+    os.makedirs(tmpDir, exist_ok=True)
+    for file in files:
+      suffix = os.path.basename(file)[len(name):]
+      linkOrCopy(file, os.path.join(tmpDir, self._ENTRY_PREFIX + suffix))
+    try:
+      os.rename(tmpDir, entryDir)
+    except OSError:
+      # Stored meanwhile by another process
+      shutil.rmtree(tmpDir, ignore_errors=True)
+    self.evict()
+
+  def getEntries(self):
+    """Returns a list of (lastUsedTime, size, entryDir) for the cache entries"""
+    entries = []
+    if not os.path.isdir(self.cacheDir):
+      return entries
+
+    for prefix in os.listdir(self.cacheDir):
+      prefixDir = os.path.join(self.cacheDir, prefix)
+      for key in os.listdir(prefixDir):
+        entryDir = os.path.join(prefixDir, key)
+        if key.endswith('.tmp'):
+          continue
+        size = sum(os.path.getsize(os.path.join(entryDir, f)) for f in os.listdir(entryDir))
+        entries.append((os.path.getmtime(entryDir), size, entryDir))
+    return entries
+
+  def evict(self):
+    """Removes the least recently used entries until the cache size is under maxSize"""
+    entries = sorted(self.getEntries())
+    totalSize = sum(entry[1] for entry in entries)
+    for _, size, entryDir in entries:
+      if totalSize <= self.maxSize:
+        break
+      shutil.rmtree(entryDir, ignore_errors=True)
+      totalSize -= size
+
+
+def linkOrCopy(src, dst):
+  """Hardlinks src into dst, copying it if they are in different file systems"""
+  try:
+    os.link(src, dst)
+  except OSError:
+    shutil.copy(src, dst)
@@ -0,0 +1,192 @@
+# **************************************************************************
+# *
+# * Authors:     Carlos Oscar Sorzano (coss@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+
+
+import os, math, time, subprocess
+
+from .utils import writeFasta, splitInShards
+
+# Variables holding the (1-based) task index of a job array: ours, then those of SLURM, PBS Pro, Torque, SGE and LSF
+ARRAY_TASK_VARS = ['ESM_TASK_ID', 'SLURM_ARRAY_TASK_ID', 'PBS_ARRAY_INDEX', 'PBS_ARRAYID', 'SGE_TASK_ID',
+                   'LSB_JOBINDEX']
+
+
+def getManifestFile(jobDir, taskId):
+  return os.path.join(jobDir, f'manifest_{taskId}.fasta')
+
+
+def getExitFile(jobDir, taskId):
+  return os.path.join(jobDir, f'task_{taskId}.exit')
+
+
+def writeManifests(entries, jobDir, taskSize):
+  """Splits the (name, sequence) entries in manifests of about taskSize sequences with balanced total length,
+  written as FASTA files numbered from 1, one per task of the job array. Returns the task ids"""
+  os.makedirs(jobDir, exist_ok=True)
+  nTasks = math.ceil(len(entries) / max(1, taskSize))
+  taskIds = []
+  for taskId, taskEntries in enumerate(splitInShards(entries, nTasks), start=1):
+    writeFasta(taskEntries, getManifestFile(jobDir, taskId))
+    taskIds.append(taskId)
+  return taskIds
+
+
+def getManifestIds(jobDir):
+  """Returns the task ids of the manifests written in jobDir"""
+  return sorted(int(fileName[len('manifest_'):-len('.fasta')]) for fileName in os.listdir(jobDir)
+                if fileName.startswith('manifest_') and fileName.endswith('.fasta'))
+
+
+def getTaskExitCode(jobDir, taskId):
+  """Returns the exit code of a finished task, or None if it did not finish"""
+  try:
+    with open(getExitFile(jobDir, taskId)) as f:
+      return int(f.read())
+  except (OSError, ValueError):
+    return None
+
+
+def writeTaskScript(scriptFile, command, jobDir):
+  """Writes the bash script run by every task of the job array. The task id is its first argument or, when run by
+  a queue system, its array index variable. {task} in the command is replaced by the task id, and the exit code of
+  the command is written to task_<task>.exit in jobDir. It is written on the exit of the shell, so it is recorded
+  even if the command ends the shell itself (e.g. exit N, or a failing command under set -e)"""
+  taskExpr = ''
+  for var in reversed(ARRAY_TASK_VARS):
+    taskExpr = f'${{{var}:-{taskExpr}}}' if taskExpr else f'${{{var}}}'
+
+  with open(scriptFile, 'w') as f:
+    f.write('#!/bin/bash\n'
+            f'TASK=${{1:-{taskExpr}}}\n'
+            'if [ -z "$TASK" ]; then echo "No job array task id" >&2; exit 1; fi\n'
+            f"trap 'echo $? > \"{getExitFile(jobDir, '${TASK}')}\"' EXIT\n"
+            f'{command.replace("{task}", "${TASK}")}\n')
+  return scriptFile
+
+
+def getArrayRange(taskIds):
+  """Returns the task ids in the array range syntax of the queue systems, e.g. 1-3,5"""
+  ranges, taskIds = [], sorted(taskIds)
+  start = prev = taskIds[0]
+  for taskId in taskIds[1:] + [None]:
+    if taskId is None or taskId != prev + 1:
+      ranges.append(str(start) if start == prev else f'{start}-{prev}')
+      start = taskId
+    prev = taskId
+  return ','.join(ranges)
+
+
+def iterFinishedTasks(executor, taskIds, jobDir, interval):
+  """Yields (taskId, exitCode) for each task as it finishes, polling every interval seconds. The exit code is None
+  if the task ended without writing it (e.g. killed by the queue system)"""
+  pending = list(taskIds)
+  while pending:
+    executor.update()
+    for taskId in list(pending):
+      # Checked in this order, as a task writes its exit code before it stops being active
+      active = executor.isActive(taskId)
+      exitCode = getTaskExitCode(jobDir, taskId)
+      if exitCode is not None or not active:
+        pending.remove(taskId)
+        yield taskId, exitCode
+    if pending:
+      time.sleep(interval)
+
+
+class LocalArrayExecutor:
+  """Runs the tasks of a job array as local subprocesses, standing in for a queue system.
+  Each slot runs one task at a time, with its environment variables (e.g. CUDA_VISIBLE_DEVICES) added to the task's"""
+
+  def __init__(self, scriptFile, slots, logDir, env=None):
+    self.scriptFile, self.slots, self.logDir = scriptFile, slots, logDir
+    self.env = dict(os.environ if env is None else env)
+    self.pending, self.running = [], {}
+
+  def submit(self, taskIds):
+    self.pending += list(taskIds)
+    self.update()
+
+  def update(self):
+    """Reaps the finished tasks and starts the pending ones in the free slots"""
+    for slot, (taskId, process, log) in list(self.running.items()):
+      if process.poll() is not None:
+        log.close()
+        del self.running[slot]
+
+    for slot, slotEnv in enumerate(self.slots):
+      if slot not in self.running and self.pending:
+        taskId = self.pending.pop(0)
+        log = open(os.path.join(self.logDir, f'task_{taskId}.log'), 'w')
+        process = subprocess.Popen(['bash', self.scriptFile, str(taskId)], env={**self.env, **slotEnv},
+                                   stdout=log, stderr=subprocess.STDOUT)
+        self.running[slot] = (taskId, process, log)
+
+  def isActive(self, taskId):
+    return taskId in self.pending or any(running[0] == taskId for running in self.running.values())
+
+
+class QueueArrayExecutor:
+  """Submits the tasks of a job array through the queue system of a Scipion host configuration.
+  If its submit template uses %(JOB_ARRAY)s (e.g. '#SBATCH --array=%(JOB_ARRAY)s'), the tasks are submitted as a
+  single array job. Otherwise, each task is submitted as a job of its own"""
+
+  def __init__(self, scriptFile, hostConfig, submitDict, env=None):
+    self.scriptFile, self.hostConfig, self.submitDict = scriptFile, hostConfig, submitDict
+    self.env = env
+    self.jobIds, self.finishedJobs = {}, set()
+
+  def isArrayTemplate(self):
+    return '%(JOB_ARRAY)' in self.hostConfig.getSubmitTemplate()
+
+  def submit(self, taskIds):
+    if self.isArrayTemplate():
+      jobId = self._submitJob(self.submitDict['JOB_NAME'], f'bash {self.scriptFile}', JOB_ARRAY=getArrayRange(taskIds))
+      self.jobIds.update({taskId: jobId for taskId in taskIds})
+    else:
+      for taskId in taskIds:
+        jobName = f'{self.submitDict["JOB_NAME"]}_{taskId}'
+        self.jobIds[taskId] = self._submitJob(jobName, f'bash {self.scriptFile} {taskId}')
+
+  def _submitJob(self, jobName, command, **extraDict):
+    from pyworkflow.protocol.launch import _submit, UNKNOWN_JOBID
+    jobDir = os.path.dirname(self.scriptFile)
+    submitDict = dict(self.submitDict, JOB_NAME=jobName, JOB_COMMAND=command,
+                      JOB_SCRIPT=os.path.join(jobDir, f'{jobName}.job'), JOB_LOGS=os.path.join(jobDir, jobName),
+                      **extraDict)
+    jobId = _submit(self.hostConfig, submitDict, cwd=jobDir, env=self.env)
+    if jobId == UNKNOWN_JOBID:
+      raise Exception(f'The job array tasks could not be submitted to the queue: {command}')
+    return jobId
+
+  def update(self):
+    """Checks the status in the queue of the jobs not finished yet"""
+    from pyworkflow.protocol.launch import _checkJobStatus
+    from pyworkflow.protocol.constants import STATUS_FINISHED
+    for jobId in set(self.jobIds.values()) - self.finishedJobs:
+      if _checkJobStatus(self.hostConfig, jobId) == STATUS_FINISHED:
+        self.finishedJobs.add(jobId)
+
+  def isActive(self, taskId):
+    return self.jobIds.get(taskId) not in self.finishedJobs
@@ -0,0 +1,100 @@
+# **************************************************************************
+# *
+# * Authors:     Carlos Oscar Sorzano (coss@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+
+
+import hashlib
+from difflib import SequenceMatcher
+
+
+def getSequenceHash(sequence):
+  return hashlib.sha256(sequence.upper().encode()).hexdigest()
+
+
+def collapseDuplicates(entries):
+  """Collapses the (name, sequence) entries with the same sequence into the first of them.
+  Returns the unique entries and a dictionary {representativeName: [duplicateNames]}"""
+  representatives, uniqueEntries, duplicates = {}, [], {}
+  for name, sequence in entries:
+    seqHash = getSequenceHash(sequence)
+    if seqHash in representatives:
+      duplicates.setdefault(representatives[seqHash], []).append(name)
+    else:
+      representatives[seqHash] = name
+      uniqueEntries.append((name, sequence))
+  return uniqueEntries, duplicates
+
+
+def getKmers(sequence, k):
+  return {sequence[i:i + k] for i in range(len(sequence) - k + 1)}
+
+
+def countSharedKmers(sequence, kmers, k):
+  """Number of positions of the sequence starting a k-mer in kmers"""
+  return sum(sequence[i:i + k] in kmers for i in range(len(sequence) - k + 1))
+
+
+def getMinSharedKmers(length, repLength, threshold, k):
+  """Lower bound of the positions of a sequence starting a k-mer of a representative at least as long, if their
+  identity (getIdentity) reaches threshold. The m >= threshold * length matched residues form blocks, each one
+  starting at least its size - (k - 1) shared k-mers. Consecutive blocks are split by at least one unmatched residue
+  of either sequence, insertions in the representative included, so there are at most
+  (length - m) + (repLength - m) + 1 blocks"""
+  matched = threshold * length
+  maxBlocks = (length - matched) + (repLength - matched) + 1
+  return matched - (k - 1) * maxBlocks
+
+
+def getIdentity(seqA, seqB):
+  """Returns the fraction of the shorter sequence aligned to identical residues of the longer one, so truncations
+  and tag variants of a sequence keep a high identity with it"""
+  seqA, seqB = seqA.upper(), seqB.upper()
+  matcher = SequenceMatcher(None, seqA, seqB, autojunk=False)
+  matches = sum(block.size for block in matcher.get_matching_blocks())
+  return matches / max(1, min(len(seqA), len(seqB)))
+
+
+def clusterSequences(entries, threshold, k=3):
+  """Greedy clustering of the (name, sequence) entries by identity: from the longest to the shortest, each sequence
+  joins the first representative with an identity of at least threshold, or becomes a new representative.
+  Pairs sharing too few k-mers to reach the threshold (see getMinSharedKmers) are skipped without aligning them.
+  Returns the representative entries and a dictionary {representativeName: [(memberName, identity)]}"""
+  representatives, clusters = [], {}
+  for name, sequence in sorted(entries, key=lambda entry: len(entry[1]), reverse=True):
+    upperSequence = sequence.upper()
+    for repName, repSequence, repKmers in representatives:
+      # Sorted by length, so the representative is at least as long as the sequence
+      minShared = getMinSharedKmers(len(sequence), len(repSequence), threshold, k)
+      if countSharedKmers(upperSequence, repKmers, k) < minShared:
+        continue
+      identity = getIdentity(sequence, repSequence)
+      if identity >= threshold:
+        clusters.setdefault(repName, []).append((name, round(identity, 4)))
+        break
+    else:
+      representatives.append((name, sequence, getKmers(upperSequence, k)))
+
+  order = {name: i for i, (name, _) in enumerate(entries)}
+  repEntries = sorted(((name, sequence) for name, sequence, _ in representatives), key=lambda e: order[e[0]])
+  return repEntries, clusters
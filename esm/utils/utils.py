@@ -22,4 +22,40 @@
 # *  All comments concerning this program package may be sent to the
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
-# **************************************************************************
\ No newline at end of file
+# **************************************************************************
+def writeFasta(entries, fastaFile):
+  """Writes a list of (name, sequence) entries in a FASTA file"""
+  with open(fastaFile, 'w') as f:
+    for name, sequence in entries:
+      f.write(f'>{name}\n{sequence}\n')
+  return fastaFile
+
+
+def readFasta(fastaFile):
+  """Reads a (multi-)FASTA file and returns a list of (name, sequence) entries"""
+  entries, name, seqLines = [], None, []
+  with open(fastaFile) as f:
+    for line in f:
+      line = line.strip()
+      if not line:
+        continue
+      if line.startswith('>'):
+        if name is not None:
+          entries.append((name, ''.join(seqLines)))
+        name, seqLines = line[1:].split()[0], []
+      else:
+        seqLines.append(line)
+  if name is not None:
+    entries.append((name, ''.join(seqLines)))
+  return entries
+
+
+def splitInShards(entries, nShards):
+  """Splits a list of (name, sequence) entries in nShards lists with balanced total length.
+  Longest sequences are assigned first, each to the shard with the lowest load"""
+  shards, loads = [[] for _ in range(nShards)], [0] * nShards
+  for entry in sorted(entries, key=lambda e: len(e[1]), reverse=True):
+    iShard = loads.index(min(loads))
+    shards[iShard].append(entry)
+    loads[iShard] += len(entry[1])
+  return shards
@@ -25,13 +25,13 @@
 # **************************************************************************
 
 import os
-import numpy as np
-import matplotlib.pyplot as plt
 
 from pyworkflow.protocol import params
+from pwem.objects import SetOfAtomStructs
 from pwem.viewers import ChimeraAttributeViewer
 
-from .protocols import ProtESMFoldPrediction
+from .protocols import ProtESMFoldPrediction, ProtESMVariantScan
+from .protocols.protocol_esm_base import sanitizeName
 
 class ESMFoldStructureViewer(ChimeraAttributeViewer):
     """ Viewer for ESMFold protocol.
@@ -49,3 +49,71 @@ class ESMFoldStructureViewer(ChimeraAttributeViewer):
         group = form.addGroup('Color settings')
         ColorScaleWizardBase.defineColorScaleParams(group, defaultLowest=0, defaultHighest=100, defaultIntervals=21,
                                                     defaultColorMap='RdBu')
+        if isinstance(self._getOutputObject(), SetOfAtomStructs):
+            group = form.addGroup('Displayed structure')
+            group.addParam('structureName', params.StringParam, label='Structure to display: ', default='',
+                           help='Name of the predicted sequence whose structure is displayed (the first one if '
+                                'empty or not found)')
+
+    def _getOutputObject(self):
+        return getattr(self.protocol, self.protocol._OUTSETNAME, None) or getattr(self.protocol, self.protocol._OUTNAME)
+
+    def getAtomStructObject(self):
+        """Returns the structure to display: the one chosen by name in a set of structures, the first one otherwise"""
+        outObj, structureName = self._getOutputObject(), getattr(self, 'structureName', None)
+        structure = None
+        if isinstance(outObj, SetOfAtomStructs) and structureName is not None and structureName.get():
+            name = sanitizeName(structureName.get().strip())
+            structure = next((outAS.clone() for outAS in outObj.iterItems() if outAS._seqName.get() == name), None)
+        return structure or super().getAtomStructObject()
+
+
+class ESMVariantScanViewer(ChimeraAttributeViewer):
+    """ Viewer for the ESM variant scan protocol.
+      Includes the residue scores mapped on the structure in chimera and the score matrix of each sequence"""
+    _targets = [ProtESMVariantScan]
+    _label = 'ESM variant scan viewer'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+    def _defineParams(self, form):
+        super()._defineParams(form)
+        from pwem.wizards.wizard import ColorScaleWizardBase
+        group = form.addGroup('Color settings')
+        ColorScaleWizardBase.defineColorScaleParams(group, defaultLowest=-10, defaultHighest=0, defaultIntervals=11,
+                                                    defaultColorMap='RdBu')
+
+        group = form.addGroup('Score matrix')
+        group.addParam('scanSequence', params.StringParam, label='Sequence name: ', default='',
+                       help='Name of the scanned sequence whose score matrix is displayed (the first one if empty)')
+        group.addParam('displayScoreMatrix', params.LabelParam, label='Display score matrix: ',
+                       help='Heatmap of the log probability ratio of each amino acid against the wild type residue '
+                            'at each position')
+
+    def _getVisualizeDict(self):
+        visDic = super()._getVisualizeDict()
+        visDic['displayScoreMatrix'] = self._showScoreMatrix
+        return visDic
+
+    def _showScoreMatrix(self, paramName=None):
+        outSet = getattr(self.protocol, self.protocol._OUTNAME)
+        name = sanitizeName(self.scanSequence.get() or outSet.getFirstItem().getSeqName())
+        scoresFile = self.protocol.getScanFile(name)
+        if not os.path.exists(scoresFile):
+            return [self.errorMessage(f'No score matrix found for sequence {name}', title='Missing scores')]
+
+        # Imported here, so loading the viewers (done by Scipion on startup) does not load matplotlib
+        import numpy as np
+        import matplotlib.pyplot as plt
+        with np.load(scoresFile) as data:
+            scores, aminoacids, positions = data['scores'], data['aminoacids'], data['positions']
+        fig, ax = plt.subplots(figsize=(max(6, len(positions) / 10), 4))
+        image = ax.imshow(scores.T, aspect='auto', cmap='RdBu', vmin=-10, vmax=0, interpolation='nearest',
+                          extent=(positions[0] - 0.5, positions[-1] + 0.5, len(aminoacids) - 0.5, -0.5))
+        ax.set_yticks(range(len(aminoacids)))
+        ax.set_yticklabels(aminoacids)
+        ax.set_xlabel('Residue')
+        ax.set_title(f'{name}: {self.protocol.getEnumText("scoring")} scores')
+        fig.colorbar(image, ax=ax, label='log(p(mutant) / p(wild type))')
+        plt.show()